@@ -7,9 +7,69 @@
 #include <numpy/arrayobject.h>
 #include "load_libs.h"
 #include "dyn_mat.h"
+#include "structure_factor.h"
+#include "debye_waller.h"
 #include "py_util.h"
 #include "util.h"
 
+// The LAPACK zheevd and cheevd functions are found once when the module is
+// imported, and the library they are loaded from is kept open for the
+// lifetime of the process
+static ZheevdFunc zheevd = NULL;
+static CheevdFunc cheevd = NULL;
+static char lapack_lib[300] = "";
+
+static int load_lapack(void) {
+    PyObject *py_scipy;
+    PyObject *py_scipy_path;
+    PyObject *py_scipy_dir;
+    const char *scipy_dir;
+    char single_lib[300];
+
+    py_scipy = PyImport_ImportModule("scipy");
+    if (py_scipy == NULL) {
+        return 1;
+    }
+    py_scipy_path = PyObject_GetAttrString(py_scipy, "__path__");
+    Py_DECREF(py_scipy);
+    if (py_scipy_path == NULL) {
+        return 1;
+    }
+    py_scipy_dir = PySequence_GetItem(py_scipy_path, 0);
+    Py_DECREF(py_scipy_path);
+    if (py_scipy_dir == NULL) {
+        return 1;
+    }
+#if PY_MAJOR_VERSION >= 3
+    scipy_dir = PyUnicode_AsUTF8(py_scipy_dir);
+#else
+    scipy_dir = PyString_AsString(py_scipy_dir);
+#endif
+    if (scipy_dir == NULL) {
+        Py_DECREF(py_scipy_dir);
+        return 1;
+    }
+    // If zheevd or cheevd can't be found, the module can still be imported
+    // and calculate_phonons raises an error
+    zheevd = (ZheevdFunc) get_lapack_func(scipy_dir, "zheevd_", lapack_lib,
+        sizeof(lapack_lib));
+    cheevd = (CheevdFunc) get_lapack_func(scipy_dir, "cheevd_", single_lib,
+        sizeof(single_lib));
+    Py_DECREF(py_scipy_dir);
+    return 0;
+}
+
+static PyObject *get_lapack_library(PyObject *self, PyObject *args) {
+    if (zheevd == NULL) {
+        Py_RETURN_NONE;
+    }
+#if PY_MAJOR_VERSION >= 3
+    return PyUnicode_FromString(lapack_lib);
+#else
+    return PyString_FromString(lapack_lib);
+#endif
+}
+
 static PyObject *calculate_phonons(PyObject *self, PyObject *args) {
 
     // Define input args
@@ -28,26 +88,28 @@ static PyObject *calculate_phonons(PyObject *self, PyObject *args) {
     int reciprocal_asr;
     int splitting;
     int n_threads = 1;
-    const char *scipy_dir;
+    int return_evecs = 1;
+    int single = 0;
 
-    // Define vars to be obtained from ForceConstants attributes
-    PyObject *py_crystal; // Crystal object
-    PyArrayObject *py_n_sc_ims;
-    PyArrayObject *py_sc_im_idx;
-    PyArrayObject *py_cell_ogs;
+    // Define vars to be obtained from ForceConstants attributes. These
+    // are new references, which are released at cleanup
+    PyObject *py_crystal = NULL; // Crystal object
+    PyArrayObject *py_sc_im_offsets = NULL;
+    PyArrayObject *py_sc_im_idx = NULL;
+    PyArrayObject *py_cell_ogs = NULL;
     // Extra vars only required if dipole = True
-    PyArrayObject *py_born;
-    PyArrayObject *py_dielectric;
+    PyArrayObject *py_born = NULL;
+    PyArrayObject *py_dielectric = NULL;
     double eta;
-    PyArrayObject *py_H_ab;
-    PyArrayObject *py_dipole_cells;
-    PyArrayObject *py_gvec_phases;
-    PyArrayObject *py_gvecs_cart;
-    PyArrayObject *py_dipole_q0;
+    PyArrayObject *py_H_ab = NULL;
+    PyArrayObject *py_dipole_cells = NULL;
+    PyArrayObject *py_gvec_phases = NULL;
+    PyArrayObject *py_gvecs_cart = NULL;
+    PyArrayObject *py_dipole_q0 = NULL;
 
     // Vars to be obtained from Crystal attributes
     int n_atoms;
-    PyArrayObject *py_atom_r;
+    PyArrayObject *py_atom_r = NULL;
 
     // Define pointers to Python array data
     double *cell_vec;
@@ -60,7 +122,8 @@ static PyObject *calculate_phonons(PyObject *self, PyObject *args) {
     double *dmat_weighting;
     double *evals;
     double *dmats;
-    int *n_sc_ims;
+    float *dmats_single;
+    int *sc_im_offsets;
     int *sc_im_idx;
     int *cell_ogs;
     // Extra vars only required if dipole = True
@@ -75,18 +138,20 @@ static PyObject *calculate_phonons(PyObject *self, PyObject *args) {
 
     // Other vars
     int n_cells;
+    int n_sc;
+    int origin_min[3], origin_len[3];
     int n_rqpts;
     int n_qpts;
-    int q, i, qpos;
-    int max_ims;
+    int q;
     int dmat_elems;
     // Extra vars only required if dipole = True
     int n_dipole_cells;
     int n_gvecs;
-    double q_dir[3];
+    // NULL unless the calculation succeeds
+    PyObject *result = NULL;
 
     // Parse inputs
-    if (!PyArg_ParseTuple(args, "OO!O!O!O!O!O!O!O!iiiO!O!is",
+    if (!PyArg_ParseTuple(args, "OO!O!O!O!O!O!O!O!iiiO!O!i|ii",
                           &py_idata,
                           &PyArray_Type, &py_cell_vec,
                           &PyArray_Type, &py_recip_vec,
@@ -102,18 +167,29 @@ static PyObject *calculate_phonons(PyObject *self, PyObject *args) {
                           &PyArray_Type, &py_evals,
                           &PyArray_Type, &py_dmats,
                           &n_threads,
-                          &scipy_dir)) {
+                          &return_evecs,
+                          &single)) {
+        return NULL;
+    }
+
+    // Check the LAPACK functions before taking any references
+    if (zheevd == NULL) {
+        PyErr_Format(PyExc_RuntimeError, "Could not load zheevd function\n");
+        return NULL;
+    }
+    if (single && cheevd == NULL) {
+        PyErr_Format(PyExc_RuntimeError, "Could not load cheevd function\n");
         return NULL;
     }
 
     // Get rest of vars from ForceConstants object
     if (attr_from_pyobj(py_idata, "crystal", &py_crystal) ||
-        attr_from_pyobj(py_idata, "_n_sc_images", &py_n_sc_ims) ||
+        attr_from_pyobj(py_idata, "_sc_image_offsets", &py_sc_im_offsets) ||
         attr_from_pyobj(py_idata, "_sc_image_i", &py_sc_im_idx) ||
         attr_from_pyobj(py_idata, "cell_origins", &py_cell_ogs)) {
             PyErr_Format(PyExc_RuntimeError,
                          "Failed to read attributes from object\n");
-            return NULL;
+            goto cleanup;
     }
     if (dipole) {
         if (attr_from_pyobj(py_idata, "_born", &py_born) ||
@@ -126,7 +202,7 @@ static PyObject *calculate_phonons(PyObject *self, PyObject *args) {
             attr_from_pyobj(py_idata, "_dipole_q0", &py_dipole_q0)) {
                 PyErr_Format(PyExc_RuntimeError,
                              "Failed to read dipole attributes from object\n");
-                return NULL;
+                goto cleanup;
         }
     }
     // Get vars from Crystal object
@@ -134,7 +210,7 @@ static PyObject *calculate_phonons(PyObject *self, PyObject *args) {
         attr_from_pyobj(py_crystal, "atom_r", &py_atom_r)) {
             PyErr_Format(PyExc_RuntimeError,
                          "Failed to read attributes from Crystal object\n");
-            return NULL;
+            goto cleanup;
     }
 
     // Point to Python array data
@@ -147,14 +223,17 @@ static PyObject *calculate_phonons(PyObject *self, PyObject *args) {
     asr_correction = (double*) PyArray_DATA(py_asr_correction);
     dmat_weighting = (double*) PyArray_DATA(py_dmat_weighting);
     evals = (double*) PyArray_DATA(py_evals);
+    // If single is set the dynamical matrices are stored in single
+    // precision (complex64), otherwise double precision (complex128)
     dmats = (double*) PyArray_DATA(py_dmats);
-    n_sc_ims = (int*) PyArray_DATA(py_n_sc_ims);
+    dmats_single = (float*) PyArray_DATA(py_dmats);
+    sc_im_offsets = (int*) PyArray_DATA(py_sc_im_offsets);
     sc_im_idx = (int*) PyArray_DATA(py_sc_im_idx);
     cell_ogs = (int*) PyArray_DATA(py_cell_ogs);
     n_cells = PyArray_DIMS(py_fc)[0];
+    n_sc = PyArray_DIMS(py_sc_ogs)[0];
     n_rqpts = PyArray_DIMS(py_rqpts)[0];
     n_qpts = PyArray_DIMS(py_qpts_i)[0];
-    max_ims = PyArray_DIMS(py_sc_im_idx)[3];
     dmat_elems = 2*9*n_atoms*n_atoms;
     if (dipole) {
         atom_r = (double*) PyArray_DATA(py_atom_r);
@@ -169,30 +248,69 @@ static PyObject *calculate_phonons(PyObject *self, PyObject *args) {
         n_gvecs = PyArray_DIMS(py_gvec_phases)[0];
     }
 
-    // Load library functions
-    ZheevdFunc zheevd;
-    zheevd = get_zheevd(scipy_dir);
-    if (zheevd == NULL) {
-        PyErr_Format(PyExc_RuntimeError, "Could not load zheevd function\n");
-        return NULL;
-    }
+    // Range of integer supercell/cell origin coordinates along each
+    // axis, used to size the per-axis phase tables
+    get_origin_ranges(n_sc, sc_ogs, n_cells, cell_ogs, origin_min,
+        origin_len);
 
+    // Release the GIL for the calculation, so other Python threads can
+    // run. Only C data is used from here, and the attribute arrays are
+    // kept alive by the references from attr_from_pyobj
+    Py_BEGIN_ALLOW_THREADS
     omp_set_num_threads(n_threads);
     #pragma omp parallel
     {
-        double *corr;
+        // Buffers and zheevd work arrays are allocated once per thread
+        // and reused for each q-point
+        double *corr = NULL;
+        // If eigenvectors aren't required, only store one dynamical
+        // matrix per thread rather than one per q-point
+        double *dmat_buf = NULL;
+        ZheevdWork zwork = {NULL, NULL, NULL, 0, 0, 0};
+        // In single precision mode, the dynamical matrix is calculated in
+        // double precision in dmat_buf, then converted to single precision
+        // for diagonalisation
+        float *dmat_single_buf = NULL;
+        float *eval_single = NULL;
+        CheevdWork cwork = {NULL, NULL, NULL, 0, 0, 0};
+        // Phase tables for each axis, supercell image and cell origin
+        double *axis_phases = (double*) malloc(
+            2*(origin_len[0] + origin_len[1] + origin_len[2])*sizeof(double));
+        double *sc_phases = (double*) malloc(2*n_sc*sizeof(double));
+        double *cell_phases = (double*) malloc(2*n_cells*sizeof(double));
         if (dipole) {
             corr = (double*) malloc(dmat_elems*sizeof(double));
         }
+        if (!return_evecs || single) {
+            dmat_buf = (double*) malloc(dmat_elems*sizeof(double));
+        }
+        if (single) {
+            eval_single = (float*) malloc(3*n_atoms*sizeof(float));
+            if (!return_evecs) {
+                dmat_single_buf = (float*) malloc(dmat_elems*sizeof(float));
+            }
+        }
         #pragma omp for
         for (q = 0; q < n_rqpts; q++) {
             double *qpt, *dmat, *eval;
+            float *dmat_single;
+            double q_dir[3];
+            int i, qpos;
             qpt = (rqpts + 3*q);
-            dmat = (dmats + q*dmat_elems);
+            if (return_evecs && !single) {
+                dmat = (dmats + q*dmat_elems);
+            } else {
+                dmat = dmat_buf;
+            }
+            // The output array may not be zeroed (e.g. if provided by
+            // the caller), and the dynamical matrix is summed into dmat
+            memset(dmat, 0, dmat_elems*sizeof(double));
             eval = (evals + q*3*n_atoms);
 
-            calculate_dyn_mat_at_q(qpt, n_atoms, n_cells, max_ims, n_sc_ims,
-                sc_im_idx, cell_ogs, sc_ogs, fc, dmat);
+            calculate_phases(qpt, n_sc, sc_ogs, n_cells, cell_ogs,
+                origin_min, origin_len, axis_phases, sc_phases, cell_phases);
+            calculate_dyn_mat_at_q(n_atoms, n_cells, sc_im_offsets,
+                sc_im_idx, sc_phases, cell_phases, fc, dmat);
 
             if (dipole) {
                 calculate_dipole_correction(qpt, n_atoms, cell_vec, recip_vec,
@@ -245,16 +363,251 @@ static PyObject *calculate_phonons(PyObject *self, PyObject *args) {
             }
 
             mass_weight_dyn_mat(dmat_weighting, n_atoms, dmat);
-            diagonalise_dyn_mat_zheevd(n_atoms, qpt, dmat, eval, zheevd);
+            if (single) {
+                if (return_evecs) {
+                    dmat_single = (dmats_single + q*dmat_elems);
+                } else {
+                    dmat_single = dmat_single_buf;
+                }
+                copy_array_to_float(dmat_elems, dmat, dmat_single);
+                diagonalise_dyn_mat_cheevd(n_atoms, qpt, dmat_single,
+                    eval_single, cheevd, return_evecs, &cwork);
+                copy_array_from_float(3*n_atoms, eval_single, eval);
+            } else {
+                diagonalise_dyn_mat_zheevd(n_atoms, qpt, dmat, eval, zheevd,
+                    return_evecs, &zwork);
+            }
             evals_to_freqs(n_atoms, eval);
         }
+        free((void*)corr);
+        free((void*)dmat_buf);
+        free((void*)dmat_single_buf);
+        free((void*)eval_single);
+        free((void*)axis_phases);
+        free((void*)sc_phases);
+        free((void*)cell_phases);
+        free_zheevd_work(&zwork);
+        free_cheevd_work(&cwork);
+    }
+    Py_END_ALLOW_THREADS
+
+    Py_INCREF(Py_None);
+    result = Py_None;
+
+cleanup:
+    Py_XDECREF(py_crystal);
+    Py_XDECREF(py_sc_im_offsets);
+    Py_XDECREF(py_sc_im_idx);
+    Py_XDECREF(py_cell_ogs);
+    Py_XDECREF(py_atom_r);
+    Py_XDECREF(py_born);
+    Py_XDECREF(py_dielectric);
+    Py_XDECREF(py_H_ab);
+    Py_XDECREF(py_dipole_cells);
+    Py_XDECREF(py_gvec_phases);
+    Py_XDECREF(py_gvecs_cart);
+    Py_XDECREF(py_dipole_q0);
+    return result;
+}
+
+static PyObject *calculate_structure_factor(PyObject *self, PyObject *args) {
+
+    // Define input args
+    PyArrayObject *py_qpts;
+    PyArrayObject *py_q_cart;
+    PyArrayObject *py_atom_r;
+    PyArrayObject *py_norm_factor;
+    PyArrayObject *py_freqs;
+    PyArrayObject *py_evecs;
+    PyArrayObject *py_dw;
+    PyArrayObject *py_sf;
+    int use_dw;
+    int n_threads = 1;
+
+    // Define vars to be obtained from Python arrays
+    double *qpts;
+    double *q_cart;
+    double *atom_r;
+    double *norm_factor;
+    double *freqs;
+    double *evecs;
+    float *evecs_single;
+    double *dw;
+    double *sf;
+
+    // Other vars
+    int n_qpts;
+    int n_atoms;
+    int evec_elems;
+    int single;
+    int q;
+    // NULL unless the calculation succeeds
+    PyObject *result = NULL;
+
+    // Parse inputs. The arrays are borrowed references, so there are no
+    // references to release at cleanup
+    if (!PyArg_ParseTuple(args, "O!O!O!O!O!O!O!iO!|i",
+                          &PyArray_Type, &py_qpts,
+                          &PyArray_Type, &py_q_cart,
+                          &PyArray_Type, &py_atom_r,
+                          &PyArray_Type, &py_norm_factor,
+                          &PyArray_Type, &py_freqs,
+                          &PyArray_Type, &py_evecs,
+                          &PyArray_Type, &py_dw,
+                          &use_dw,
+                          &PyArray_Type, &py_sf,
+                          &n_threads)) {
+        goto cleanup;
+    }
+
+    // Point to Python array data
+    qpts = (double*) PyArray_DATA(py_qpts);
+    q_cart = (double*) PyArray_DATA(py_q_cart);
+    atom_r = (double*) PyArray_DATA(py_atom_r);
+    norm_factor = (double*) PyArray_DATA(py_norm_factor);
+    freqs = (double*) PyArray_DATA(py_freqs);
+    // Eigenvectors may be complex64 if they were calculated in single
+    // precision, in which case they are converted per q-point
+    single = (PyArray_TYPE(py_evecs) == NPY_COMPLEX64);
+    evecs = (double*) PyArray_DATA(py_evecs);
+    evecs_single = (float*) PyArray_DATA(py_evecs);
+    dw = (double*) PyArray_DATA(py_dw);
+    sf = (double*) PyArray_DATA(py_sf);
+    n_qpts = PyArray_DIMS(py_qpts)[0];
+    n_atoms = PyArray_DIMS(py_atom_r)[0];
+    evec_elems = 2*9*n_atoms*n_atoms;
+
+    Py_BEGIN_ALLOW_THREADS
+    omp_set_num_threads(n_threads);
+    #pragma omp parallel
+    {
+        // Per-atom phase, normalisation and Debye-Waller factors,
+        // allocated once per thread
+        double *atom_factors = (double*) malloc(2*n_atoms*sizeof(double));
+        double *evec_buf = NULL;
+        if (single) {
+            evec_buf = (double*) malloc(evec_elems*sizeof(double));
+        }
+        #pragma omp for
+        for (q = 0; q < n_qpts; q++) {
+            double *evec;
+            if (single) {
+                copy_array_from_float(evec_elems,
+                    evecs_single + evec_elems*q, evec_buf);
+                evec = evec_buf;
+            } else {
+                evec = evecs + evec_elems*q;
+            }
+            calculate_atom_factors(qpts + 3*q, q_cart + 3*q, n_atoms,
+                atom_r, norm_factor, dw, use_dw, atom_factors);
+            calculate_sf_at_q(q_cart + 3*q, n_atoms, evec,
+                freqs + 3*n_atoms*q, atom_factors, sf + 3*n_atoms*q);
+        }
+        free((void*)atom_factors);
+        free((void*)evec_buf);
     }
+    Py_END_ALLOW_THREADS
+
+    Py_INCREF(Py_None);
+    result = Py_None;
 
-    return Py_None;
+cleanup:
+    return result;
+}
+
+static PyObject *calculate_debye_waller(PyObject *self, PyObject *args) {
+
+    // Define input args
+    PyArrayObject *py_evecs;
+    PyArrayObject *py_coeffs;
+    PyArrayObject *py_dw;
+    int n_threads = 1;
+
+    // Define vars to be obtained from Python arrays
+    double *evecs;
+    float *evecs_single;
+    double *coeffs;
+    double *dw;
+
+    // Other vars
+    int n_qpts;
+    int n_atoms;
+    int evec_elems;
+    int single;
+    int q;
+    // NULL unless the calculation succeeds
+    PyObject *result = NULL;
+
+    // Parse inputs. The arrays are borrowed references, so there are no
+    // references to release at cleanup
+    if (!PyArg_ParseTuple(args, "O!O!O!|i",
+                          &PyArray_Type, &py_evecs,
+                          &PyArray_Type, &py_coeffs,
+                          &PyArray_Type, &py_dw,
+                          &n_threads)) {
+        goto cleanup;
+    }
+
+    // Point to Python array data
+    // Eigenvectors may be complex64 if they were calculated in single
+    // precision, in which case they are converted per q-point
+    single = (PyArray_TYPE(py_evecs) == NPY_COMPLEX64);
+    evecs = (double*) PyArray_DATA(py_evecs);
+    evecs_single = (float*) PyArray_DATA(py_evecs);
+    coeffs = (double*) PyArray_DATA(py_coeffs);
+    dw = (double*) PyArray_DATA(py_dw);
+    n_qpts = PyArray_DIMS(py_evecs)[0];
+    n_atoms = PyArray_DIMS(py_dw)[0];
+    evec_elems = 2*9*n_atoms*n_atoms;
+
+    Py_BEGIN_ALLOW_THREADS
+    omp_set_num_threads(n_threads);
+    #pragma omp parallel
+    {
+        // Each thread sums into its own array, which are then added
+        // to the output
+        double *dw_thread = (double*) calloc(9*n_atoms, sizeof(double));
+        double *evec_buf = NULL;
+        if (single) {
+            evec_buf = (double*) malloc(evec_elems*sizeof(double));
+        }
+        #pragma omp for
+        for (q = 0; q < n_qpts; q++) {
+            double *evec;
+            if (single) {
+                copy_array_from_float(evec_elems,
+                    evecs_single + evec_elems*q, evec_buf);
+                evec = evec_buf;
+            } else {
+                evec = evecs + evec_elems*q;
+            }
+            add_debye_waller_at_q(n_atoms, evec, coeffs + 3*n_atoms*q,
+                dw_thread);
+        }
+        #pragma omp critical
+        {
+            add_arrays(9*n_atoms, dw_thread, dw);
+        }
+        free((void*)dw_thread);
+        free((void*)evec_buf);
+    }
+    Py_END_ALLOW_THREADS
+
+    Py_INCREF(Py_None);
+    result = Py_None;
+
+cleanup:
+    return result;
 }
 
 static PyMethodDef _euphonic_methods[] = {
     {"calculate_phonons", calculate_phonons, METH_VARARGS, NULL},
+    {"calculate_structure_factor", calculate_structure_factor, METH_VARARGS,
+     NULL},
+    {"calculate_debye_waller", calculate_debye_waller, METH_VARARGS, NULL},
+    {"get_lapack_library", get_lapack_library, METH_NOARGS,
+     "Return the path of the LAPACK library zheevd was loaded from, or None "
+     "if it couldn't be loaded"},
     {NULL, NULL, 0, NULL}
 };
 
@@ -269,11 +622,17 @@ static struct PyModuleDef _euphonic_module_def = {
 
 PyMODINIT_FUNC PyInit__euphonic(void) {
     import_array();
+    if (load_lapack()) {
+        return NULL;
+    }
     return PyModule_Create(&_euphonic_module_def);
 }
 #else
 PyMODINIT_FUNC init_euphonic() {
     import_array();
+    if (load_lapack()) {
+        return;
+    }
     Py_InitModule3("_euphonic", _euphonic_methods, NULL);
 }
 #endif
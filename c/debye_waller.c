@@ -0,0 +1,26 @@
+void add_debye_waller_at_q(const int n_atoms, const double *eigenvecs,
+    const double *coeffs, double *dw) {
+
+    int nu, k, a, b, ia, ib;
+    double c;
+
+    // Add coeff*Re(e_a*conj(e_b)) for each mode to the 3x3 Debye-Waller
+    // exponent of each atom
+    for (nu = 0; nu < 3*n_atoms; nu++) {
+        c = coeffs[nu];
+        if (c == 0) {
+            continue;
+        }
+        for (k = 0; k < n_atoms; k++) {
+            for (a = 0; a < 3; a++) {
+                ia = 2*(3*(nu*n_atoms + k) + a);
+                for (b = 0; b < 3; b++) {
+                    ib = 2*(3*(nu*n_atoms + k) + b);
+                    dw[9*k + 3*a + b] += c*(
+                        eigenvecs[ia]*eigenvecs[ib]
+                        + eigenvecs[ia + 1]*eigenvecs[ib + 1]);
+                }
+            }
+        }
+    }
+}
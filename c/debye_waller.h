@@ -0,0 +1,7 @@
+#ifndef __debye_waller_H__
+#define __debye_waller_H__
+
+void add_debye_waller_at_q(const int n_atoms, const double *eigenvecs,
+    const double *coeffs, double *dw);
+
+#endif
@@ -6,18 +6,97 @@
 #include <string.h>
 #include "util.h"
 #include "load_libs.h"
+#include "dyn_mat.h"
 
 #define PI 3.14159265358979323846
 
-void calculate_dyn_mat_at_q(const double *qpt, const int n_atoms,
-    const int n_cells, const int max_images, const int *n_sc_images,
-    const int *sc_image_i, const int *cell_origins, const int *sc_origins,
+void get_origin_ranges(const int n_sc, const int *sc_origins,
+    const int n_cells, const int *cell_origins, int origin_min[3],
+    int origin_len[3]) {
+
+    int i, k, origin_max[3];
+    for (k = 0; k < 3; k++) {
+        origin_min[k] = sc_origins[k];
+        origin_max[k] = sc_origins[k];
+    }
+    for (i = 0; i < n_sc; i++) {
+        for (k = 0; k < 3; k++) {
+            if (sc_origins[3*i + k] < origin_min[k]) {
+                origin_min[k] = sc_origins[3*i + k];
+            } else if (sc_origins[3*i + k] > origin_max[k]) {
+                origin_max[k] = sc_origins[3*i + k];
+            }
+        }
+    }
+    for (i = 0; i < n_cells; i++) {
+        for (k = 0; k < 3; k++) {
+            if (cell_origins[3*i + k] < origin_min[k]) {
+                origin_min[k] = cell_origins[3*i + k];
+            } else if (cell_origins[3*i + k] > origin_max[k]) {
+                origin_max[k] = cell_origins[3*i + k];
+            }
+        }
+    }
+    for (k = 0; k < 3; k++) {
+        origin_len[k] = origin_max[k] - origin_min[k] + 1;
+    }
+}
+
+void calculate_phases(const double *qpt, const int n_sc,
+    const int *sc_origins, const int n_cells, const int *cell_origins,
+    const int origin_min[3], const int origin_len[3], double *axis_phases,
+    double *sc_phases, double *cell_phases) {
+
+    int i, k, m, idx;
+    int ax_offset[3] = {0, origin_len[0], origin_len[0] + origin_len[1]};
+    double qr;
+    double re, im, tmp;
+    const double *ax_ph;
+
+    // Only calculate sin/cos for the integer coordinates along each axis,
+    // then multiply to get the phase at each supercell/cell origin, as
+    // e^-i(q.r) = e^-i(qh*ra)*e^-i(qk*rb)*e^-i(ql*rc)
+    for (k = 0; k < 3; k++) {
+        for (m = 0; m < origin_len[k]; m++) {
+            qr = 2*PI*qpt[k]*(origin_min[k] + m);
+            idx = 2*(ax_offset[k] + m);
+            axis_phases[idx] = cos(qr);
+            axis_phases[idx + 1] = -sin(qr);
+        }
+    }
+
+    for (i = 0; i < n_sc + n_cells; i++) {
+        re = 1;
+        im = 0;
+        for (k = 0; k < 3; k++) {
+            if (i < n_sc) {
+                m = sc_origins[3*i + k];
+            } else {
+                m = cell_origins[3*(i - n_sc) + k];
+            }
+            ax_ph = axis_phases + 2*(ax_offset[k] + m - origin_min[k]);
+            tmp = re*ax_ph[0] - im*ax_ph[1];
+            im = re*ax_ph[1] + im*ax_ph[0];
+            re = tmp;
+        }
+        if (i < n_sc) {
+            sc_phases[2*i] = re;
+            sc_phases[2*i + 1] = im;
+        } else {
+            cell_phases[2*(i - n_sc)] = re;
+            cell_phases[2*(i - n_sc) + 1] = im;
+        }
+    }
+}
+
+void calculate_dyn_mat_at_q(const int n_atoms, const int n_cells,
+    const int *sc_image_offsets, const int *sc_image_i,
+    const double *sc_phases, const double *cell_phases,
     const double *fc_mat, double *dyn_mat) {
 
-    int i, j, n, nc, k, sc, ii, jj, idx;
-    double qdotr;
-    double phase_r;
-    double phase_i;
+    int i, j, n, nc, sc, ii, jj, idx, offset;
+    double phase_r, phase_i;
+    double sum_r, sum_i;
 
     // Note: C calculated dynamical matrix uses e^-i(q.r) convention, whereas
     // Python uses the e^i(q.r) convention. This differing convention is used
@@ -25,26 +104,26 @@ void calculate_dyn_mat_at_q(const double *qpt, const int n_atoms,
     // ordering (dyn mat is Hermitian so transpose = complex conjugate)
 
     // Array strides
-    int s_n[2] = {n_atoms*n_atoms, n_atoms}; // For n_sc_images
-    // For sc_image_i
-    int s_i[3] = {n_atoms*n_atoms*max_images, n_atoms*max_images, max_images};
+    int s_n[2] = {n_atoms*n_atoms, n_atoms}; // For sc_image_offsets
     int s_fc = 9*n_atoms*n_atoms; // For fc_mat
 
     for (i = 0; i < n_atoms; i++) {
         for (j = i; j < n_atoms; j++) {
             for (nc = 0; nc < n_cells; nc++){
-                phase_r = 0;
-                phase_i = 0;
-                // Calculate and sum phases for all  images
-                for (n = 0; n < n_sc_images[nc*s_n[0] + i*s_n[1] + j]; n++) {
-                    qdotr = 0;
-                    sc = sc_image_i[nc*s_i[0] + i*s_i[1] + j*s_i[2] + n];
-                    for (k = 0; k < 3; k++){
-                        qdotr += qpt[k]*(sc_origins[3*sc + k] + cell_origins[3*nc + k]);
-                    }
-                    phase_r += cos(2*PI*qdotr);
-                    phase_i -= sin(2*PI*qdotr);
+                sum_r = 0;
+                sum_i = 0;
+                // Sum phases for all images. The images for each cell
+                // and ij pair are contiguous in sc_image_i
+                offset = nc*s_n[0] + i*s_n[1] + j;
+                for (n = sc_image_offsets[offset];
+                     n < sc_image_offsets[offset + 1]; n++) {
+                    sc = sc_image_i[n];
+                    sum_r += sc_phases[2*sc];
+                    sum_i += sc_phases[2*sc + 1];
                 }
+                // Multiply by the cell origin phase
+                phase_r = sum_r*cell_phases[2*nc] - sum_i*cell_phases[2*nc + 1];
+                phase_i = sum_r*cell_phases[2*nc + 1] + sum_i*cell_phases[2*nc];
                 for (ii = 0; ii < 3; ii++){
                     for (jj = 0; jj < 3; jj++){
                         idx = (3*i+ii)*3*n_atoms + 3*j + jj;
@@ -282,53 +361,131 @@ void mass_weight_dyn_mat(const double* dyn_mat_weighting, const int n_atoms,
 }
 
 int diagonalise_dyn_mat_zheevd(const int n_atoms, const double qpt[3],
-    double* dyn_mat, double* eigenvalues, ZheevdFunc zheevdptr) {
+    double* dyn_mat, double* eigenvalues, ZheevdFunc zheevdptr,
+    const int return_evecs, ZheevdWork *zwork) {
 
-    char jobz = 'V';
+    // Only calculate eigenvalues if eigenvectors aren't required
+    char jobz = return_evecs ? 'V' : 'N';
     char uplo = 'L';
     int order = 3*n_atoms;
     int lda = order;
-    int lwork, lrwork, liwork = -1;
-    double *work, *rwork;
-    int *iwork;
+    int lwork, lrwork, liwork;
     int info;
 
     // Query vars
     double lworkopt, lrworkopt;
     int liworkopt;
 
-    // Workspace query
-    (*zheevdptr)(&jobz, &uplo, &order, dyn_mat, &lda, eigenvalues, &lworkopt, &lwork,
-        &lrworkopt, &lrwork, &liworkopt, &liwork, &info);
+    // Workspace query, only done if the work arrays haven't already been
+    // allocated, as the workspace size only depends on order and jobz
+    if (zwork->work == NULL) {
+        lwork = lrwork = liwork = -1;
+        (*zheevdptr)(&jobz, &uplo, &order, dyn_mat, &lda, eigenvalues,
+            &lworkopt, &lwork, &lrworkopt, &lrwork, &liworkopt, &liwork,
+            &info);
+        if (info != 0) {
+            printf("INFO: Zheevd failed querying workspace with info %i at "
+                   "q-point %f %f %f\n", info, qpt[0], qpt[1], qpt[2]);
+            return info;
+        }
+        zwork->lwork = (int)lworkopt;
+        zwork->lrwork = (int)lrworkopt;
+        zwork->liwork = liworkopt;
+
+        // Allocate work arrays
+        zwork->work = (double*)malloc(2*zwork->lwork*sizeof(double));
+        zwork->rwork = (double*)malloc(zwork->lrwork*sizeof(double));
+        zwork->iwork = (int*)malloc(zwork->liwork*sizeof(int));
+    }
+    // zheevd may overwrite the sizes, so pass copies
+    lwork = zwork->lwork;
+    lrwork = zwork->lrwork;
+    liwork = zwork->liwork;
+
+    (*zheevdptr)(&jobz, &uplo, &order, dyn_mat, &lda, eigenvalues,
+        zwork->work, &lwork, zwork->rwork, &lrwork, zwork->iwork, &liwork,
+        &info);
+
     if (info != 0) {
-        printf("INFO: Zheevd failed querying workspace with info %i at "
-               "q-point %f %f %f\n", info, qpt[0], qpt[1], qpt[2]);
-        return info;
+       printf("INFO: Zheevd diagonalisation failed with info %i at "
+              "q-point %f %f %f\n", info, qpt[0], qpt[1], qpt[2]);
     }
-    lwork = (int)lworkopt;
-    lrwork = (int)lrworkopt;
-    liwork = liworkopt;
 
-    // Allocate work arrays
-    work = (double*)malloc(2*lwork*sizeof(double));
-    rwork = (double*)malloc(lrwork*sizeof(double));
-    iwork = (int*)malloc(liwork*sizeof(int));
+    return info;
+}
 
-    (*zheevdptr)(&jobz, &uplo, &order, dyn_mat, &lda, eigenvalues, work, &lwork,
-        rwork, &lrwork, iwork, &liwork, &info);
+void free_zheevd_work(ZheevdWork *zwork) {
+    free((void*)zwork->work);
+    free((void*)zwork->rwork);
+    free((void*)zwork->iwork);
+    zwork->work = NULL;
+    zwork->rwork = NULL;
+    zwork->iwork = NULL;
+}
 
-    free((void*)work);
-    free((void*)rwork);
-    free((void*)iwork);
+int diagonalise_dyn_mat_cheevd(const int n_atoms, const double qpt[3],
+    float* dyn_mat, float* eigenvalues, CheevdFunc cheevdptr,
+    const int return_evecs, CheevdWork *cwork) {
+
+    // Only calculate eigenvalues if eigenvectors aren't required
+    char jobz = return_evecs ? 'V' : 'N';
+    char uplo = 'L';
+    int order = 3*n_atoms;
+    int lda = order;
+    int lwork, lrwork, liwork;
+    int info;
+
+    // Query vars
+    float lworkopt, lrworkopt;
+    int liworkopt;
+
+    // Workspace query, only done if the work arrays haven't already been
+    // allocated, as the workspace size only depends on order and jobz
+    if (cwork->work == NULL) {
+        lwork = lrwork = liwork = -1;
+        (*cheevdptr)(&jobz, &uplo, &order, dyn_mat, &lda, eigenvalues,
+            &lworkopt, &lwork, &lrworkopt, &lrwork, &liworkopt, &liwork,
+            &info);
+        if (info != 0) {
+            printf("INFO: Cheevd failed querying workspace with info %i at "
+                   "q-point %f %f %f\n", info, qpt[0], qpt[1], qpt[2]);
+            return info;
+        }
+        cwork->lwork = (int)lworkopt;
+        cwork->lrwork = (int)lrworkopt;
+        cwork->liwork = liworkopt;
+
+        // Allocate work arrays
+        cwork->work = (float*)malloc(2*cwork->lwork*sizeof(float));
+        cwork->rwork = (float*)malloc(cwork->lrwork*sizeof(float));
+        cwork->iwork = (int*)malloc(cwork->liwork*sizeof(int));
+    }
+    // cheevd may overwrite the sizes, so pass copies
+    lwork = cwork->lwork;
+    lrwork = cwork->lrwork;
+    liwork = cwork->liwork;
+
+    (*cheevdptr)(&jobz, &uplo, &order, dyn_mat, &lda, eigenvalues,
+        cwork->work, &lwork, cwork->rwork, &lrwork, cwork->iwork, &liwork,
+        &info);
 
     if (info != 0) {
-       printf("INFO: Zheevd diagonalisation failed with info %i at "
+       printf("INFO: Cheevd diagonalisation failed with info %i at "
               "q-point %f %f %f\n", info, qpt[0], qpt[1], qpt[2]);
     }
 
     return info;
 }
 
+void free_cheevd_work(CheevdWork *cwork) {
+    free((void*)cwork->work);
+    free((void*)cwork->rwork);
+    free((void*)cwork->iwork);
+    cwork->work = NULL;
+    cwork->rwork = NULL;
+    cwork->iwork = NULL;
+}
+
 void evals_to_freqs(const int n_atoms, double *eigenvalues) {
     int i;
     double tmp;
@@ -1,9 +1,18 @@
 #ifndef __dyn_mat_H__
 #define __dyn_mat_H__
 
-void calculate_dyn_mat_at_q(const double *qpt, const int n_atoms,
-    const int n_cells, const int max_ims, const int *n_sc_images,
-    const int *sc_image_i, const int *cell_origins, const int *sc_origins,
+void get_origin_ranges(const int n_sc, const int *sc_origins,
+    const int n_cells, const int *cell_origins, int origin_min[3],
+    int origin_len[3]);
+
+void calculate_phases(const double *qpt, const int n_sc,
+    const int *sc_origins, const int n_cells, const int *cell_origins,
+    const int origin_min[3], const int origin_len[3], double *axis_phases,
+    double *sc_phases, double *cell_phases);
+
+void calculate_dyn_mat_at_q(const int n_atoms, const int n_cells,
+    const int *sc_image_offsets, const int *sc_image_i,
+    const double *sc_phases, const double *cell_phases,
     const double *fc_mat, double *dyn_mat);
 
 void calculate_dipole_correction(const double *qpt, const int n_atoms,
@@ -20,8 +29,39 @@ void calculate_gamma_correction(const double q_dir[3], const int n_atoms,
 void mass_weight_dyn_mat(const double *dyn_mat_weighting, const int n_atoms,
     double *dyn_mat);
 
+// zheevd work arrays, allocated on the first diagonalisation and reused
+// for every following diagonalisation of the same size. Should be zero
+// initialised, and freed with free_zheevd_work
+typedef struct {
+    double *work;
+    double *rwork;
+    int *iwork;
+    int lwork;
+    int lrwork;
+    int liwork;
+} ZheevdWork;
+
 int diagonalise_dyn_mat_zheevd(const int n_atoms, const double qpt[3],
-    double *dyn_mat, double *eigenvalues, ZheevdFunc zheevdptr);
+    double *dyn_mat, double *eigenvalues, ZheevdFunc zheevdptr,
+    const int return_evecs, ZheevdWork *zwork);
+
+void free_zheevd_work(ZheevdWork *zwork);
+
+// Single precision equivalent of ZheevdWork for cheevd
+typedef struct {
+    float *work;
+    float *rwork;
+    int *iwork;
+    int lwork;
+    int lrwork;
+    int liwork;
+} CheevdWork;
+
+int diagonalise_dyn_mat_cheevd(const int n_atoms, const double qpt[3],
+    float *dyn_mat, float *eigenvalues, CheevdFunc cheevdptr,
+    const int return_evecs, CheevdWork *cwork);
+
+void free_cheevd_work(CheevdWork *cwork);
 
 void evals_to_freqs(const int n_atoms, double *eigenvalues);
 
@@ -8,12 +8,13 @@
 
 #include <stdio.h>
 
-typedef void (*ZheevdFunc)(char* jobz, char* uplo, int* n, double* a, int* lda,
-    double* w, double* work, int* lwork, double* rwork, int* lrwork,
-    int* iwork, int* liwork, int* info);
-
-ZheevdFunc get_zheevd(const char *scipy_dir) {
-    ZheevdFunc zheevd;
+// Find and load a function (e.g. zheevd_) from the LAPACK library
+// distributed with Scipy. The library is left open so the returned function
+// pointer stays valid, and the path of the library that was loaded is
+// written to lib_path
+void *get_lapack_func(const char *scipy_dir, const char *func_name,
+    char *lib_path, size_t lib_path_len) {
+    void *func;
 
 #ifdef _WIN32
     HMODULE lib;
@@ -47,13 +48,13 @@ ZheevdFunc get_zheevd(const char *scipy_dir) {
         printf("Could not load lib handle %s\n", filedata.cFileName);
         return NULL;
     }
-    zheevd = (ZheevdFunc) GetProcAddress(lib, "zheevd_");
-    if (zheevd == NULL) {
-        printf("Could not find zheevd_ in %s\n", filedata.cFileName);
+    func = (void*) GetProcAddress(lib, func_name);
+    if (func == NULL) {
+        printf("Could not find %s in %s\n", func_name, filedata.cFileName);
         FreeLibrary(lib);
         return NULL;
     }
-    FreeLibrary(lib);
+    snprintf(lib_path, lib_path_len, "%s", filedata.cFileName);
 #else
     void *lib;
     const char *libdir = "/linalg";
@@ -78,22 +79,26 @@ ZheevdFunc get_zheevd(const char *scipy_dir) {
     closedir(dir);
     if (globres.gl_pathc == 0) {
         printf("Glob failed: couldn't find %s\n", buf);
+        globfree(&globres);
         return NULL;
     }
 
     lib = dlopen(globres.gl_pathv[0], RTLD_LAZY);
     if (lib == NULL) {
         printf("Could not load lib handle %s. Error: %s\n", globres.gl_pathv[0], dlerror());
+        globfree(&globres);
         return NULL;
     }
-    zheevd = dlsym(lib, "zheevd_");
-    if (zheevd == NULL) {
-        printf("Could not find zheevd_ in %s\n", buf);
+    func = dlsym(lib, func_name);
+    if (func == NULL) {
+        printf("Could not find %s in %s\n", func_name, globres.gl_pathv[0]);
         dlclose(lib);
+        globfree(&globres);
         return NULL;
     }
-    dlclose(lib);
+    snprintf(lib_path, lib_path_len, "%s", globres.gl_pathv[0]);
+    globfree(&globres);
 #endif
 
-    return zheevd;
+    return func;
 }
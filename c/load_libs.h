@@ -1,10 +1,17 @@
 #ifndef __load_libs_H__
 #define __load_libs_H__
 
+#include <stddef.h>
+
 typedef void (*ZheevdFunc)(char* jobz, char* uplo, int* n, double* a, int* lda,
     double* w, double* work, int* lwork, double* rwork, int* lrwork,
     int* iwork, int* liwork, int* info);
 
-ZheevdFunc get_zheevd(const char *scipy_dir);
+typedef void (*CheevdFunc)(char* jobz, char* uplo, int* n, float* a, int* lda,
+    float* w, float* work, int* lwork, float* rwork, int* lrwork,
+    int* iwork, int* liwork, int* info);
+
+void *get_lapack_func(const char *scipy_dir, const char *func_name,
+    char *lib_path, size_t lib_path_len);
 
 #endif
@@ -7,7 +7,8 @@
 int attr_from_pyobj(PyObject *obj, const char *attr_name, PyObject **result) {
 /* Given a PyObject and the name of one of its attributes, get the address of
  * that attribute, and alter the pointer pointed to by result to point to that
- * address */
+ * address. result is a new reference, which must be released by the caller
+ * with Py_DECREF */
     if (PyObject_HasAttrString(obj, attr_name)) {
         PyObject *tmp = PyObject_GetAttrString(obj, attr_name);
         *result = tmp; 
@@ -22,7 +23,9 @@ int int_from_pyobj(PyObject *obj, const char *attr_name, int *result) {
 /* Given a PyObject and the name of one of its attributes, read an integer
  * from that attribute and store it in the address pointed to by result */
     PyObject *tmp;
-    attr_from_pyobj(obj, attr_name, &tmp);
+    if (attr_from_pyobj(obj, attr_name, &tmp)) {
+        return 1;
+    }
 #if PY_MAJOR_VERSION >= 3
     if (PyLong_Check(tmp)) {
         *result = (int) PyLong_AsLong(tmp);
@@ -32,8 +35,10 @@ int int_from_pyobj(PyObject *obj, const char *attr_name, int *result) {
 #endif
     } else {
         printf("Incorrect type for %s\n", attr_name);
+        Py_DECREF(tmp);
         return 1;
     }
+    Py_DECREF(tmp);
     return 0;
 }
 
@@ -42,12 +47,16 @@ int double_from_pyobj(PyObject *obj, const char *attr_name,
 /* Given a PyObject and the name of one of its attributes, read a double
  * from that attribute and store it in the address pointed to by result */
     PyObject *tmp;
-    attr_from_pyobj(obj, attr_name, &tmp);
+    if (attr_from_pyobj(obj, attr_name, &tmp)) {
+        return 1;
+    }
     if (PyFloat_Check(tmp)) {
         *result = (double) PyFloat_AsDouble(tmp);
     } else {
         printf("Incorrect type for %s\n", attr_name);
+        Py_DECREF(tmp);
         return 1;
     }
+    Py_DECREF(tmp);
     return 0;
 }
@@ -0,0 +1,58 @@
+#include <math.h>
+
+#define PI 3.14159265358979323846
+
+void calculate_atom_factors(const double *qpt, const double *q_cart,
+    const int n_atoms, const double *atom_r, const double *norm_factor,
+    const double *dw, const int use_dw, double *atom_factors) {
+
+    int k, a, b;
+    double qdotr, mag, qwq;
+
+    // Calculate the exp(iQ.r) phase, normalisation and Debye-Waller
+    // factor for each atom, these are independent of the mode
+    for (k = 0; k < n_atoms; k++) {
+        qdotr = 0;
+        for (a = 0; a < 3; a++) {
+            qdotr += qpt[a]*atom_r[3*k + a];
+        }
+        mag = norm_factor[k];
+        if (use_dw) {
+            qwq = 0;
+            for (a = 0; a < 3; a++) {
+                for (b = 0; b < 3; b++) {
+                    qwq += dw[9*k + 3*a + b]*q_cart[a]*q_cart[b];
+                }
+            }
+            mag *= exp(-qwq);
+        }
+        atom_factors[2*k] = mag*cos(2*PI*qdotr);
+        atom_factors[2*k + 1] = mag*sin(2*PI*qdotr);
+    }
+}
+
+void calculate_sf_at_q(const double *q_cart, const int n_atoms,
+    const double *eigenvecs, const double *freqs, const double *atom_factors,
+    double *sf) {
+
+    int nu, k, a, idx;
+    double dot_r, dot_i, term_r, term_i;
+
+    for (nu = 0; nu < 3*n_atoms; nu++) {
+        term_r = 0;
+        term_i = 0;
+        for (k = 0; k < n_atoms; k++) {
+            // Q.conj(eigenvector)
+            dot_r = 0;
+            dot_i = 0;
+            for (a = 0; a < 3; a++) {
+                idx = 2*(3*(nu*n_atoms + k) + a);
+                dot_r += eigenvecs[idx]*q_cart[a];
+                dot_i -= eigenvecs[idx + 1]*q_cart[a];
+            }
+            term_r += dot_r*atom_factors[2*k] - dot_i*atom_factors[2*k + 1];
+            term_i += dot_r*atom_factors[2*k + 1] + dot_i*atom_factors[2*k];
+        }
+        sf[nu] = (term_r*term_r + term_i*term_i)/fabs(freqs[nu]);
+    }
+}
@@ -0,0 +1,12 @@
+#ifndef __structure_factor_H__
+#define __structure_factor_H__
+
+void calculate_atom_factors(const double *qpt, const double *q_cart,
+    const int n_atoms, const double *atom_r, const double *norm_factor,
+    const double *dw, const int use_dw, double *atom_factors);
+
+void calculate_sf_at_q(const double *q_cart, const int n_atoms,
+    const double *eigenvecs, const double *freqs, const double *atom_factors,
+    double *sf);
+
+#endif
@@ -21,6 +21,20 @@ void copy_array(const int size, const double *arr, double *copy) {
     }
 }
 
+void copy_array_to_float(const int size, const double *arr, float *copy) {
+    int i;
+    for (i = 0; i < size; i++) {
+        copy[i] = (float) arr[i];
+    }
+}
+
+void copy_array_from_float(const int size, const float *arr, double *copy) {
+    int i;
+    for (i = 0; i < size; i++) {
+        copy[i] = (double) arr[i];
+    }
+}
+
 double det_array(const double arr[9]) {
    double det;
    det = arr[0]*(arr[4]*arr[8] - arr[7]*arr[5]) +
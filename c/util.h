@@ -4,6 +4,8 @@
 void add_arrays(const int size, const double *arr1, double *arr2);
 void multiply_array(const int size, const double scalar, double *arr);
 void copy_array(const int size, const double *arr, double *copy);
+void copy_array_to_float(const int size, const double *arr, float *copy);
+void copy_array_from_float(const int size, const float *arr, double *copy);
 double det_array(const double arr[9]);
 int is_gamma(const double qpt[3]);
 double cell_volume(const double cell_vec[9]);
@@ -1,5 +1,6 @@
 import inspect
 import numpy as np
+import spglib
 from pint import Quantity
 from euphonic import ureg
 from euphonic.io import (_obj_to_json_file, _obj_from_json_file,
@@ -104,6 +105,34 @@ class Crystal(object):
         cv = self._cell_vectors
         return np.dot(cv[0], np.cross(cv[1], cv[2]))
 
+    def get_symmetry_operations(self, symprec=1e-5):
+        """
+        Uses spglib to get the symmetry operations of the crystal
+
+        Parameters
+        ----------
+        symprec : float, optional
+            The tolerance for determining the symmetry, in Angstrom
+
+        Returns
+        -------
+        rotations : (n_ops, 3, 3) int ndarray
+            The rotation part of each symmetry operation, acting on
+            fractional coordinates
+        translations : (n_ops, 3) float ndarray
+            The fractional translation part of each symmetry operation.
+            If spglib can't determine the symmetry, only the identity
+            operation is returned
+        """
+        _, atom_num = np.unique(self.atom_type, return_inverse=True)
+        cell_vectors = (self.cell_vectors.to('angstrom')).magnitude
+        cell = (cell_vectors, self.atom_r, atom_num)
+        symmetry = spglib.get_symmetry(cell, symprec=symprec)
+        if symmetry is None:
+            return (np.identity(3, dtype=np.int32)[np.newaxis],
+                    np.zeros((1, 3)))
+        return symmetry['rotations'], symmetry['translations']
+
     def to_dict(self):
         """
         Convert to a dictionary. See Crystal.from_dict for details on
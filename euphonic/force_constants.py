@@ -1,1304 +1,2999 @@
-import math
-import sys
-import warnings
-import numpy as np
-from pint import Quantity
-import scipy
-from scipy.linalg.lapack import zheev
-from scipy.special import erfc
-from euphonic import ureg
-from euphonic.crystal import Crystal
-from euphonic.qpoint_phonon_modes import QpointPhononModes
-from euphonic.util import is_gamma, get_all_origins, _check_constructor_inputs
-from euphonic.io import (_obj_to_json_file, _obj_from_json_file,
-                         _obj_to_dict, _process_dict)
-from euphonic.readers import castep, phonopy
-
-
-class ImportCError(Exception):
-
-    def __init__(self, message):
-        self.message = message
-
-    def __str__(self):
-        return "ImportCError: {}".format(self.message)
-
-
-class ForceConstants(object):
-    """
-    A class to read and store the data required for a phonon
-    interpolation calculation from model (e.g. CASTEP) output,
-    and calculate phonon frequencies/eigenvectors at arbitrary q-points
-    via Fourier interpolation
-
-    Attributes
-    ----------
-    crystal : Crystal
-        Lattice and atom information
-    force_constants : (n_cells_in_sc, 3*n_atoms, 3*n_atoms) float Quantity
-        Force constants matrix
-    sc_matrix : (3, 3) int ndarray
-        The supercell matrix
-    n_cells_in_sc : int
-        Number of cells in the supercell
-    cell_origins : (n_cells_in_sc, 3) int ndarray
-        The locations of the unit cells within the supercell
-    born : (n_atoms, 3, 3) float Quantity or None
-        The Born charges for each atom
-    dielectric : (3, 3) float Quantity or None
-        The dielectric permittivity tensor
-    """
-
-    def __init__(self, crystal, force_constants, sc_matrix, cell_origins,
-                 born=None, dielectric=None):
-        """
-        Parameters
-        ----------
-        crystal : Crystal
-            Lattice and atom information
-        force_constants : (n_cells_in_sc, 3*n_atoms, 3*n_atoms) float Quantity
-            Force constants matrix
-        sc_matrix : (3, 3) int ndarray
-            The supercell matrix
-        cell_origins : (n_cells_in_sc, 3) int ndarray
-            The locations of the unit cells within the supercell
-        born : (n_atoms, 3, 3) float Quantity, optional
-            The Born charges for each atom
-        dielectric : (3, 3) float Quantity, optional
-            The dielectric permittivity tensor
-        """
-        # Check independent inputs first
-        _check_constructor_inputs(
-            [crystal, sc_matrix], [Crystal, np.ndarray], [(), (3, 3)],
-            ['crystal', 'sc_matrix'])
-        n_at = crystal.n_atoms
-        n_sc = int(np.rint(np.absolute(np.linalg.det(sc_matrix))))
-        # Now check other derived input shapes
-        _check_constructor_inputs(
-            [force_constants, cell_origins, born, dielectric],
-            [Quantity, np.ndarray, [Quantity, type(None)],
-                [Quantity, type(None)]],
-            [(n_sc, 3*n_at, 3*n_at), (n_sc, 3), (n_at, 3, 3), (3, 3)],
-            ['force_constants', 'cell_origins', 'born', 'dielectric'])
-        self.crystal = crystal
-        self._force_constants = force_constants.to(
-            'INTERNAL_ENERGY_UNIT/INTERNAL_LENGTH_UNIT**2').magnitude
-        self.force_constants_unit = str(force_constants.units)
-        self.sc_matrix = sc_matrix
-        self.cell_origins = cell_origins
-        self.n_cells_in_sc = n_sc
-
-        if born is not None:
-            self._born = born.to(ureg.INTERNAL_CHARGE_UNIT).magnitude
-            self.born_unit = str(born.units)
-            self._dielectric = dielectric.to(ureg(
-                '(INTERNAL_CHARGE_UNIT**2)/'
-                '(INTERNAL_LENGTH_UNIT*INTERNAL_ENERGY_UNIT)')).magnitude
-            self.dielectric_unit = str(dielectric.units)
-        else:
-            self._born = born
-            self.born_unit = str(ureg.INTERNAL_CHARGE_UNIT)
-            self._dielectric = dielectric
-            self.dielectric_unit = str(ureg((
-                '(INTERNAL_CHARGE_UNIT**2)/'
-                '(INTERNAL_LENGTH_UNIT*INTERNAL_ENERGY_UNIT)')))
-
-    @property
-    def force_constants(self):
-        return self._force_constants*ureg(
-            'INTERNAL_ENERGY_UNIT/INTERNAL_LENGTH_UNIT**2').to(
-                self.force_constants_unit)
-
-    @property
-    def born(self):
-        if self._born is not None:
-            return self._born*ureg('INTERNAL_CHARGE_UNIT').to(self.born_unit)
-        else:
-            return None
-
-    @property
-    def dielectric(self):
-        if self._dielectric is not None:
-            return self._dielectric*ureg((
-                '(INTERNAL_CHARGE_UNIT**2)/'
-                '(INTERNAL_LENGTH_UNIT*INTERNAL_ENERGY_UNIT)')).to(
-                    self.dielectric_unit)
-        else:
-            return None
-
-    def __setattr__(self, name, value):
-        if hasattr(self, name):
-            if name in ['force_constants_unit', 'born_unit',
-                        'dielectric_unit']:
-                ureg(getattr(self, name)).to(value)
-        super(ForceConstants, self).__setattr__(name, value)
-
-    def calculate_qpoint_phonon_modes(
-        self, qpts, asr=None, dipole=True, eta_scale=1.0, splitting=True,
-        insert_gamma=False, reduce_qpts=True, use_c=False, n_threads=1,
-        fall_back_on_python=True):
-        """
-        Calculate phonon frequencies and eigenvectors at specified
-        q-points from a force constants matrix via Fourier interpolation
-
-        Parameters
-        ----------
-        qpts : (n_qpts, 3) float ndarray
-            The q-points to interpolate onto
-        asr : {'realspace', 'reciprocal'}, optional
-            Which acoustic sum rule correction to apply. 'realspace'
-            applies the correction to the force constant matrix in real
-            space. 'reciprocal' applies the correction to the dynamical
-            matrix at every q-point
-        dipole : boolean, optional
-            Calculates the dipole tail correction to the dynamical
-            matrix at each q-point using the Ewald sum, if the Born
-            charges and dielectric permitivitty tensor are present.
-        eta_scale : float, optional
-            Changes the cutoff in real/reciprocal space for the dipole
-            Ewald sum. A higher value uses more reciprocal terms. If tuned
-            correctly this can result in performance improvements. See
-            scripts/optimise_eta.py for help on choosing a good eta_scale.
-        splitting : boolean, optional
-            Whether to calculate the LO-TO splitting at the gamma
-            points. Only applied if dipole is True and the Born charges
-            and dielectric permitivitty tensor are present.
-        insert_gamma : boolean, optional
-            If splitting is True, this will insert gamma points into
-            qpts to store the extra split frequencies. Note this means
-            that the length of qpts in the output QpointPhononModes
-            object will not necessarily be the same as the input qpts.
-            If qpts already contains double gamma points where you want
-            split frequencies, leave this as False.
-        reduce_qpts : boolean, optional
-            Whether to use periodicity to reduce all q-points and only
-            calculate for unique q-points within the 1st BZ. This won't
-            change the output but could increase performance.
-        use_c : boolean, optional
-            Whether to use C instead of Python to calculate and
-            diagonalise the dynamical matrix
-        n_threads : int, optional
-            The number of OpenMP threads to use when looping over
-            q-points in C. Only applicable if use_c=True
-        fall_back_on_python : boolean, optional
-            If we cannot use the C extension, fall back on using python
-            if this is true, else raise an ImportCError.
-
-        Returns
-        -------
-        QpointPhononModes
-            A QpointPhononModes object containing the interpolated
-            frequencies and eigenvectors at each q-point. Note that if
-            there is LO-TO splitting, and insert_gamma=True, the number
-            of input q-points may not be the same as in the output
-            object
-
-        Raises
-        ------
-        ImportCError
-            If we have selected not to fall back on Python and cannot
-            use the C extension
-
-        Notes
-        -----
-        Phonon frequencies/eigenvectors are calculated at any q-point by
-        Fourier interpolation of a force constants matrix. The force
-        constants matrix is defined as [1]_:
-
-        .. math::
-
-          \\phi_{\\alpha, {\\alpha}'}^{\\kappa, {\\kappa}'} =
-          \\frac{\\delta^{2}E}{{\\delta}u_{\\kappa,\\alpha}{\\delta}u_{{\\kappa}',{\\alpha}'}}
-
-        Which gives the Dynamical matrix at q:
-
-        .. math::
-
-          D_{\\alpha, {\\alpha}'}^{\\kappa, {\\kappa}'}(q) =
-          \\frac{1}{\\sqrt{M_\\kappa M_{\\kappa '}}}
-          \\sum_{a}\\phi_{\\alpha, \\alpha '}^{\\kappa, \\kappa '}e^{-iq\\cdot r_a}
-
-        The eigenvalue equation for the dynamical matrix is then:
-
-        .. math::
-
-          D_{\\alpha, {\\alpha}'}^{\\kappa, {\\kappa}'}(q) \\epsilon_{q\\nu\\kappa\\alpha} =
-          \\omega_{q\\nu}^{2} \\epsilon_{q\\nu\\kappa\\alpha}
-
-        Where :math:`\\nu` runs over phonon modes, :math:`\\kappa` runs
-        over atoms, :math:`\\alpha` runs over the Cartesian directions,
-        :math:`a` runs over unit cells in the supercell,
-        :math:`u_{\\kappa, \\alpha}` is the displacement of atom
-        :math:`\\kappa` in direction :math:`\\alpha`,
-        :math:`M_{\\kappa}` is the mass of atom :math:`\\kappa`,
-        :math:`r_{a}` is the vector to the origin of cell :math:`a` in
-        the supercell, :math:`\\epsilon_{q\\nu\\kappa\\alpha}` are the
-        eigevectors, and :math:`\\omega_{q\\nu}^{2}` are the frequencies
-        squared.
-
-        In polar materials, there is an additional long-ranged
-        correction to the force constants matrix (applied if
-        dipole=True) and a non-analytical correction at the gamma point
-        [2]_ (applied if splitting=True).
-
-        .. [1] M.T. Dove, Introduction to Lattice Dynamics, Cambridge University Press, Cambridge, 1993, 83-87
-        .. [2] X. Gonze, K. C. Charlier, D. C. Allan, M. P. Teter, Phys. Rev. B, 1994, 50, 13035-13038
-        """
-        # Set default splitting params
-        if self.born is None:
-            dipole = False
-        if not dipole:
-            splitting = False
-
-        if splitting and insert_gamma:
-            # Duplicate gamma points where there is splitting
-            gamma_i = np.where(is_gamma(qpts))[0]
-            split_gamma = gamma_i[np.where(
-                np.logical_and(gamma_i > 0, gamma_i < len(qpts) - 1))]
-            qpts = np.insert(qpts, split_gamma, np.array([0., 0., 0.]), axis=0)
-
-        if reduce_qpts:
-            norm_qpts = qpts - np.rint(qpts)
-            # Ensure gamma points are exactly zero, otherwise you may
-            # have a case where small fp differences mean np.unique
-            # doesn't reduce them, yet they're all classified as gamma
-            # points. This causes indexing errors later when calculating
-            # q-directions as there are then points in reduced_qpts
-            # whose index isn't in qpts_i
-            gamma_i = np.where(is_gamma(qpts))[0]
-            n_gamma = len(gamma_i)
-            norm_qpts[gamma_i] = 0.
-
-            reduced_qpts, qpts_i = np.unique(norm_qpts, return_inverse=True,
-                                             axis=0)
-            n_rqpts = len(reduced_qpts)
-            # Special handling of gamma points - don't reduce gamma
-            # points if LO-TO splitting
-            if splitting and n_gamma > 1:
-                # Replace any gamma points and their indices with new
-                # gamma points appended onto the reduced q-point array,
-                # so each gamma can have its own splitting
-                qpts_i[gamma_i[1:]] = range(n_rqpts, n_rqpts + n_gamma - 1)
-                reduced_qpts = np.append(reduced_qpts,
-                                         np.tile(np.array([0., 0., 0., ]),
-                                                 (n_gamma - 1, 1)),
-                                         axis=0)
-                n_rqpts = len(reduced_qpts)
-        else:
-            reduced_qpts = qpts
-            qpts_i = np.arange(0, len(qpts), dtype=np.int32)
-            n_rqpts = len(qpts)
-
-        lim = 2  # Supercell image limit
-        # Construct list of supercell ion images
-        if not hasattr(self, 'sc_image_i'):
-            self._calculate_supercell_images(lim)
-
-        # Get a list of all the unique supercell image origins and cell
-        # origins in x, y, z and how to rebuild them to minimise
-        # expensive phase calculations later
-        sc_image_r = get_all_origins(
-            np.repeat(lim, 3) + 1, min_xyz=-np.repeat(lim, 3))
-        sc_offsets = np.einsum('ji,kj->ki', self.sc_matrix,
-                               sc_image_r).astype(np.int32)
-        unique_sc_offsets = [[] for i in range(3)]
-        unique_sc_i = np.zeros((len(sc_offsets), 3), dtype=np.int32)
-        unique_cell_origins = [[] for i in range(3)]
-        unique_cell_i = np.zeros((len(self.cell_origins), 3), dtype=np.int32)
-        for i in range(3):
-            unique_sc_offsets[i], unique_sc_i[:, i] = np.unique(
-                sc_offsets[:, i], return_inverse=True)
-            unique_cell_origins[i], unique_cell_i[:, i] = np.unique(
-                self.cell_origins[:, i], return_inverse=True)
-
-        # Precompute dynamical matrix mass weighting
-        atom_mass = self.crystal._atom_mass
-        n_atoms = self.crystal.n_atoms
-        masses = np.tile(np.repeat(atom_mass, 3), (3*n_atoms, 1))
-        dyn_mat_weighting = 1/np.sqrt(masses*np.transpose(masses))
-
-        # Initialise dipole correction calc to FC matrix if required
-        if dipole and (not hasattr(self, 'eta_scale') or
-                       eta_scale != self._eta_scale):
-            self._dipole_correction_init(eta_scale)
-
-        if asr == 'realspace':
-            if not hasattr(self, '_force_constants_asr'):
-                self._force_constants_asr = self._enforce_realspace_asr()
-            force_constants = self._force_constants_asr
-        else:
-            force_constants = self._force_constants
-        # Precompute fc matrix weighted by number of supercell atom
-        # images (for cumulant method)
-        n_sc_images_repeat = (
-            self._n_sc_images.repeat(3, axis=2).repeat(3, axis=1)
-        )
-        fc_img_weighted = np.divide(
-            force_constants, n_sc_images_repeat, where=n_sc_images_repeat != 0)
-
-        recip_asr_correction = np.array([], dtype=np.complex128)
-        if asr == 'reciprocal':
-            # Calculate dyn mat at gamma for reciprocal ASR
-            q_gamma = np.array([0., 0., 0.])
-            dyn_mat_gamma = self._calculate_dyn_mat(
-                q_gamma, fc_img_weighted, unique_sc_offsets,
-                unique_sc_i, unique_cell_origins, unique_cell_i)
-            if dipole:
-                dyn_mat_gamma += self._calculate_dipole_correction(q_gamma)
-            recip_asr_correction = self._enforce_reciprocal_asr(dyn_mat_gamma)
-            if len(recip_asr_correction) == 0:
-                # Finding acoustic modes failed
-                asr = None
-
-        rfreqs = np.zeros((n_rqpts, 3*n_atoms))
-        reigenvecs = np.zeros(
-            (n_rqpts, 3*n_atoms, n_atoms, 3), dtype=np.complex128
-        )
-        try:
-            if use_c:
-                try:
-                    import euphonic._euphonic as euphonic_c
-                    from euphonic.util import (_ensure_contiguous_args,
-                                               _ensure_contiguous_attrs)
-                except ImportError:
-                    warnings.warn((
-                        'use_c=True is set, but the Euphonic\'s C '
-                        'extension couldn\'t be imported, it may not '
-                        'have been installed. Attempting to fall back '
-                        'to pure Python calculation'), stacklevel=2)
-                    raise
-            else:
-                raise ImportError
-            # Make sure all arrays are contiguous before calling C
-            cell_vectors = self.crystal._cell_vectors
-            recip_vectors = self.crystal.reciprocal_cell().to(
-                '1/bohr').magnitude
-            (cell_vectors, recip_vectors, reduced_qpts, qpts_i, fc_img_weighted,
-                sc_offsets, recip_asr_correction, dyn_mat_weighting, rfreqs,
-                reigenvecs) = _ensure_contiguous_args(
-                    cell_vectors, recip_vectors, reduced_qpts, qpts_i,
-                    fc_img_weighted, sc_offsets, recip_asr_correction,
-                    dyn_mat_weighting, rfreqs, reigenvecs)
-            attrs = ['_n_sc_images', '_sc_image_i', 'cell_origins']
-            dipole_attrs = ['atom_r', '_born', '_dielectric', '_H_ab',
-                            '_cells', '_gvec_phases', '_gvecs_cart',
-                            '_dipole_q0']
-            _ensure_contiguous_attrs(self, attrs, opt_attrs=dipole_attrs)
-            reciprocal_asr = 1 if asr == 'reciprocal' else 0
-            euphonic_c.calculate_phonons(
-                self, cell_vectors, recip_vectors, reduced_qpts, qpts_i,
-                fc_img_weighted, sc_offsets, recip_asr_correction,
-                dyn_mat_weighting, dipole, reciprocal_asr, splitting, rfreqs,
-                reigenvecs, n_threads, scipy.__path__[0])
-        except ImportError:
-            if not fall_back_on_python:
-                raise ImportCError((
-                    'use_c=True is set, but the Euphonic\'s C extension'
-                    ' couldn\'t be imported, it may not have been '
-                    'installed. You have selected not to fall back on '
-                    'Python, therefore we cannot complete the '
-                    'calculation.'))
-            else:
-                q_independent_args = (
-                    reduced_qpts, qpts_i, fc_img_weighted, unique_sc_offsets,
-                    unique_sc_i, unique_cell_origins, unique_cell_i,
-                    recip_asr_correction, dyn_mat_weighting, dipole, asr,
-                    splitting)
-                for q in range(n_rqpts):
-                    rfreqs[q], reigenvecs[q] = self._calculate_phonons_at_q(
-                        q, q_independent_args)
-
-        freqs = rfreqs[qpts_i]*ureg('INTERNAL_ENERGY_UNIT').to(
-            'mDEFAULT_ENERGY_UNIT')
-
-        return QpointPhononModes(
-            self.crystal, qpts, freqs, reigenvecs[qpts_i],
-            weights=np.full(len(qpts), 1.0/len(qpts)))
-
-    def _calculate_phonons_at_q(self, q, args):
-        """
-        Given a q-point and some precalculated q-independent values,
-        calculate and diagonalise the dynamical matrix and return the
-        frequencies and eigenvalues. Optionally also includes the Ewald
-        dipole sum correction and LO-TO splitting
-        """
-        (reduced_qpts, qpts_i, fc_img_weighted, unique_sc_offsets,
-         unique_sc_i, unique_cell_origins, unique_cell_i,
-         recip_asr_correction, dyn_mat_weighting, dipole, asr,
-         splitting) = args
-
-        qpt = reduced_qpts[q]
-        n_atoms = self.crystal.n_atoms
-
-        dyn_mat = self._calculate_dyn_mat(
-            qpt, fc_img_weighted, unique_sc_offsets, unique_sc_i,
-            unique_cell_origins, unique_cell_i)
-
-        if dipole:
-            dipole_corr = self._calculate_dipole_correction(qpt)
-            dyn_mat += dipole_corr
-
-        if asr == 'reciprocal':
-            dyn_mat += recip_asr_correction
-
-        # Calculate LO-TO splitting by calculating non-analytic
-        # correction to dynamical matrix
-        if splitting and is_gamma(qpt):
-            # If first q-point
-            if qpts_i[0] == q:
-                q_dir = reduced_qpts[qpts_i[1]]
-            # If last q-point
-            elif qpts_i[-1] == q:
-                q_dir = reduced_qpts[qpts_i[-2]]
-            else:
-                # Find position in original qpts array (non reduced)
-                qpos = np.where(qpts_i == q)[0][0]
-                # If splitting=True there should be an adjacent gamma
-                # point. Calculate splitting in whichever direction
-                # isn't gamma
-                q_dir = reduced_qpts[qpts_i[qpos + 1]]
-                if is_gamma(q_dir):
-                    q_dir = -reduced_qpts[qpts_i[qpos - 1]]
-            na_corr = self._calculate_gamma_correction(q_dir)
-        else:
-            # Correction is zero if not a gamma point or splitting=False
-            na_corr = np.array([0])
-
-        dyn_mat += na_corr
-
-        # Mass weight dynamical matrix
-        dyn_mat *= dyn_mat_weighting
-
-        try:
-            evals, evecs = np.linalg.eigh(dyn_mat, UPLO='U')
-        # Fall back to zheev if eigh fails (eigh calls zheevd)
-        except np.linalg.LinAlgError:
-            evals, evecs, info = zheev(dyn_mat)
-        evecs = np.reshape(np.transpose(evecs),
-                           (3*n_atoms, n_atoms, 3))
-        # Set imaginary frequencies to negative
-        imag_freqs = np.where(evals < 0)
-        evals = np.sqrt(np.abs(evals))
-        evals[imag_freqs] *= -1
-
-        return evals, evecs
-
-    def _calculate_dyn_mat(self, q, fc_img_weighted, unique_sc_offsets,
-                           unique_sc_i, unique_cell_origins, unique_cell_i):
-        """
-        Calculate the non mass weighted dynamical matrix at a specified
-        q-point from the image weighted force constants matrix and the
-        indices specifying the periodic images. See eq. 1.5:
-        http://www.tcm.phy.cam.ac.uk/castep/Phonons_Guide/Castep_Phonons.html
-
-        Parameters
-        ----------
-        q : (3,) float ndarray
-            The q-point to calculate the correction for
-        fc_img_weighted : (n_cells_in_sc, 3*n_atoms, 3*n_atoms) float ndarray
-            The force constants matrix weighted by the number of
-            supercell atom images for each ij displacement
-        unique_sc_offsets : list of lists of ints
-            A list containing 3 lists of the unique supercell image
-            offsets in each direction. The supercell offset is
-            calculated by multiplying the supercell matrix by the
-            supercell image indices (obtained by _get_all_origins()). A
-            list of lists rather than a Numpy array is used as the 3
-            lists are independent and their size is not known beforehand
-        unique_sc_i : ((2*lim + 1)**3, 3) int ndarray
-            The indices needed to reconstruct sc_offsets from the unique
-            values in unique_sc_offsets
-        unique_cell_origins : list of lists of ints
-            A list containing 3 lists of the unique cell origins in each
-            direction. A list of lists rather than a Numpy array is used
-            as the 3 lists are independent and their size is not known
-            beforehand
-        unique_sc_i : (cell_origins, 3) int ndarray
-            The indices needed to reconstruct cell_origins from the
-            unique values in unique_cell_origins
-
-        Returns
-        -------
-        dyn_mat : (3*n_atoms, 3*n_atoms) complex ndarray
-            The non mass weighted dynamical matrix at q
-        """
-
-        sc_image_i = self._sc_image_i
-
-        # Cumulant method: for each ij ion-ion displacement sum phases
-        # for all possible supercell images, then multiply by the cell
-        # phases to account for j ions in different cells. Then multiply
-        # by the image weighted fc matrix for each 3 x 3 ij displacement
-
-        # Make sc_phases 1 longer than necessary, so when summing phases
-        # for supercell images if there is no image, an index of -1 and
-        # hence phase of zero can be used
-        sc_phases = np.zeros(len(unique_sc_i) + 1, dtype=np.complex128)
-        sc_phases[:-1], cell_phases = self._calculate_phases(
-            q, unique_sc_offsets, unique_sc_i, unique_cell_origins,
-            unique_cell_i)
-        sc_phase_sum = np.sum(sc_phases[sc_image_i],
-                              axis=3)
-        ax = np.newaxis
-        ij_phases = cell_phases[:, ax, ax]*sc_phase_sum
-        full_dyn_mat = fc_img_weighted*(
-            ij_phases.repeat(3, axis=2).repeat(3, axis=1))
-        dyn_mat = np.sum(full_dyn_mat, axis=0)
-
-        return dyn_mat
-
-    def _dipole_correction_init(self, eta_scale=1.0):
-        """
-        Calculate the q-independent parts of the long range correction
-        to the dynamical matrix for efficiency. The method used is based
-        on the Ewald sum, see eqs 72-74 from Gonze and Lee PRB 55, 10355
-        (1997)
-
-        Parameters
-        ----------
-        eta_scale : float, optional
-            Changes the cutoff in real/reciprocal space for the dipole
-            Ewald sum. A higher value uses more reciprocal terms
-        """
-
-        cell_vectors = self.crystal._cell_vectors
-        recip = self.crystal.reciprocal_cell().to('1/bohr').magnitude
-        n_atoms = self.crystal.n_atoms
-        atom_r = self.crystal.atom_r
-        born = self._born
-        dielectric = self._dielectric
-        inv_dielectric = np.linalg.inv(dielectric)
-        sqrt_pi = math.sqrt(math.pi)
-
-        # Calculate real/recip weighting
-        abc_mag = np.linalg.norm(cell_vectors, axis=1)
-        mean_abc_mag = np.prod(abc_mag)**(1.0/3)
-        eta = (sqrt_pi/mean_abc_mag)*n_atoms**(1.0/6)
-        # Use eta = lambda * |permittivity|**(1/6)
-        eta = eta*np.power(np.linalg.det(dielectric), 1.0/6)*eta_scale
-        eta_2 = eta**2
-
-        # Set limits and tolerances
-        max_shells = 50
-        frac_tol = 1e-15
-
-        # Calculate q=0 real space term
-        real_q0 = np.zeros((n_atoms, n_atoms, 3, 3))
-        # No. of independent i, j ion entries (to use i, j symmetry to
-        # minimise size of stored H_ab)
-        n_elems = np.sum(range(1, n_atoms + 1))
-        H_ab = np.zeros((0, n_elems, 3, 3))
-        cells = np.zeros((0, 3))
-        atom_r_cart = np.einsum('ij,jk->ik', atom_r, cell_vectors)
-        atom_r_e = np.einsum('ij,jk->ik', atom_r_cart, inv_dielectric)
-        for n in range(max_shells):
-            cells_tmp = self._get_shell_origins(n)
-            cells_cart = np.einsum('ij,jk->ik', cells_tmp, cell_vectors)
-            cells_e = np.einsum(
-                'ij,jk->ik', cells_cart, inv_dielectric)
-            H_ab_tmp = np.zeros((len(cells_tmp), n_elems, 3, 3))
-            for i in range(n_atoms):
-                idx = np.sum(range(n_atoms - i, n_atoms), dtype=np.int32)
-                for j in range(i, n_atoms):
-                    if n == 0 and i == j:
-                        continue
-                    rij_cart = atom_r_cart[i] - atom_r_cart[j]
-                    rij_e = atom_r_e[i] - atom_r_e[j]
-                    diffs = rij_cart - cells_cart
-                    deltas = rij_e - cells_e
-                    norms_2 = np.einsum('ij,ij->i', deltas, diffs)*eta_2
-                    norms = np.sqrt(norms_2)
-
-                    # Calculate H_ab
-                    exp_term = 2*np.exp(-norms_2)/(sqrt_pi*norms_2)
-                    erfc_term = erfc(norms)/(norms*norms_2)
-                    f1 = eta_2*(3*erfc_term/norms_2 + exp_term*(3/norms_2 + 2))
-                    f2 = erfc_term + exp_term
-                    deltas_ab = np.einsum('ij,ik->ijk', deltas, deltas)
-                    H_ab_tmp[:, idx + j] = (
-                        np.einsum('i,ijk->ijk', f1, deltas_ab)
-                        - np.einsum('i,jk->ijk', f2, inv_dielectric))
-            # End series when current terms are less than the fractional
-            # tolerance multiplied by the term for the cell at R=0
-            if n == 0:
-                r0_max = np.amax(np.abs(H_ab_tmp))
-            if np.amax(np.abs(H_ab_tmp)) > frac_tol*r0_max:
-                H_ab = np.concatenate((H_ab, H_ab_tmp))
-                cells = np.concatenate((cells, cells_tmp))
-            else:
-                break
-        # Use compact H_ab to fill in upper triangular of realspace term
-        real_q0[np.triu_indices(n_atoms)] = np.sum(H_ab, axis=0)
-        real_q0 *= eta**3/math.sqrt(np.linalg.det(dielectric))
-
-        # Calculate the q=0 reciprocal term
-        recip_q0 = np.zeros((n_atoms, n_atoms, 3, 3), dtype=np.complex128)
-        # Add G = 0 vectors to list, for later calculations when q !=0,
-        # but don't calculate for q=0
-        gvecs_cart = np.array([[0., 0., 0.]])
-        gvec_phases = np.tile([1. + 0.j], (1, n_atoms))
-        for n in range(1, max_shells):
-            gvecs = self._get_shell_origins(n)
-            gvecs_cart_tmp = np.einsum('ij,jk->ik', gvecs, recip)
-            gvec_dot_r = np.einsum('ij,kj->ik', gvecs, atom_r)
-            gvec_phases_tmp = np.exp(2j*math.pi*gvec_dot_r)
-            gvecs_ab = np.einsum('ij,ik->ijk', gvecs_cart_tmp, gvecs_cart_tmp)
-            k_len_2 = np.einsum('ijk,jk->i', gvecs_ab, dielectric)/(4*eta_2)
-            recip_exp = np.exp(-k_len_2)/k_len_2
-            recip_q0_tmp = np.zeros((n_atoms, n_atoms, 3, 3),
-                                    dtype=np.complex128)
-            for i in range(n_atoms):
-                for j in range(i, n_atoms):
-                    phase_exp = gvec_phases_tmp[:, i]/gvec_phases_tmp[:, j]
-                    recip_q0_tmp[i, j] = np.einsum(
-                        'ijk,i,i->jk', gvecs_ab, phase_exp, recip_exp)
-            # End series when current terms are less than the fractional
-            # tolerance multiplied by the max term for the first shell
-            if n == 1:
-                first_shell_max = np.amax(np.abs(recip_q0_tmp))
-            if np.amax(np.abs(recip_q0_tmp)) > frac_tol*first_shell_max:
-                gvecs_cart = np.concatenate((gvecs_cart, gvecs_cart_tmp))
-                gvec_phases = np.concatenate((gvec_phases, gvec_phases_tmp))
-                recip_q0 += recip_q0_tmp
-            else:
-                break
-        vol = self.crystal._cell_volume()
-        recip_q0 *= math.pi/(vol*eta_2)
-
-        # Fill in remaining entries by symmetry
-        for i in range(1, n_atoms):
-            for j in range(i):
-                real_q0[i, j] = np.conj(real_q0[j, i])
-                recip_q0[i, j] = np.conj(recip_q0[j, i])
-
-        # Calculate the q=0 correction, to be subtracted from the
-        # corrected diagonal at each q
-        dipole_q0 = np.zeros((n_atoms, 3, 3), dtype=np.complex128)
-        for i in range(n_atoms):
-            for j in range(n_atoms):
-                for a in range(3):
-                    for b in range(3):
-                        dipole_q0[i, a, b] += np.sum(
-                            np.einsum('i,j', born[i, a, :], born[j, b, :])
-                            *(recip_q0[i, j] - real_q0[i, j]))
-            # Symmetrise 3x3
-            dipole_q0[i] = 0.5*(dipole_q0[i] + np.transpose(dipole_q0[i]))
-
-        self._eta_scale = eta_scale
-        self._eta = eta
-        self._H_ab = H_ab
-        self._cells = cells
-        self._gvecs_cart = gvecs_cart
-        self._gvec_phases = gvec_phases
-        self._dipole_q0 = dipole_q0
-
-    def _calculate_dipole_correction(self, q):
-        """
-        Calculate the long range correction to the dynamical matrix
-        using the Ewald sum, see eqs 72-74 from Gonze and Lee PRB 55,
-        10355 (1997)
-
-        Parameters
-        ----------
-        q : (3,) float ndarray
-            The q-point to calculate the correction for
-
-        Returns
-        -------
-        corr : (3*n_atoms, 3*n_atoms) complex ndarray
-            The correction to the dynamical matrix
-        """
-        recip = self.crystal.reciprocal_cell().to('1/bohr').magnitude
-        n_atoms = self.crystal.n_atoms
-        atom_r = self.crystal.atom_r
-        born = self._born
-        dielectric = self._dielectric
-        eta = self._eta
-        eta_2 = eta**2
-        H_ab = self._H_ab
-        cells = self._cells
-        q_norm = q - np.rint(q)  # Normalised q-pt
-
-        # Don't include G=0 vector if q=0
-        if is_gamma(q_norm):
-            gvec_phases = self._gvec_phases[1:]
-            gvecs_cart = self._gvecs_cart[1:]
-        else:
-            gvec_phases = self._gvec_phases
-            gvecs_cart = self._gvecs_cart
-
-        # Calculate real space term
-        real_dipole = np.zeros((n_atoms, n_atoms, 3, 3), dtype=np.complex128)
-        # Calculate real space phase factor
-        q_dot_ra = np.einsum('i,ji->j', q_norm, cells)
-        real_phases = np.exp(2j*math.pi*q_dot_ra)
-        real_dipole_tmp = np.einsum('i,ijkl->jkl', real_phases, H_ab)
-        idx_u = np.triu_indices(n_atoms)
-        real_dipole[idx_u] = real_dipole_tmp
-        real_dipole *= eta**3/math.sqrt(np.linalg.det(dielectric))
-
-        # Calculate reciprocal term
-        recip_dipole = np.zeros((n_atoms, n_atoms, 3, 3), dtype=np.complex128)
-        # Calculate q-point phases
-        q_dot_r = np.einsum('i,ji->j', q_norm, atom_r)
-        q_phases = np.exp(2j*math.pi*q_dot_r)
-        q_cart = np.dot(q_norm, recip)
-        # Calculate k-vector symmetric matrix
-        kvecs = gvecs_cart + q_cart
-        kvecs_ab = np.einsum('ij,ik->ijk', kvecs, kvecs)
-        k_len_2 = np.einsum('ijk,jk->i', kvecs_ab, dielectric)/(4*eta_2)
-        recip_exp = np.einsum('ijk,i->ijk', kvecs_ab, np.exp(-k_len_2)/k_len_2)
-        for i in range(n_atoms):
-                phase_exp = ((gvec_phases[:, i, None]*q_phases[i])
-                             /(gvec_phases[:, i:]*q_phases[i:]))
-                recip_dipole[i, i:] = np.einsum(
-                    'ikl,ij->jkl', recip_exp, phase_exp)
-        cell_volume = self.crystal._cell_volume()
-        recip_dipole *= math.pi/(cell_volume*eta_2)
-
-        # Fill in remaining entries by symmetry
-        # Mask so we don't count diagonal twice
-        mask = np.tri(n_atoms, k=-1)[:, :, np.newaxis, np.newaxis]
-        real_dipole = real_dipole + mask*np.conj(
-            np.transpose(real_dipole, axes=[1, 0, 2, 3]))
-        recip_dipole = recip_dipole + mask*np.conj(
-            np.transpose(recip_dipole, axes=[1, 0, 2, 3]))
-
-        # Multiply by Born charges and subtract q=0 from diagonal
-        dipole = np.zeros((n_atoms, n_atoms, 3, 3), dtype=np.complex128)
-        dipole_tmp = recip_dipole - real_dipole
-        for i in range(n_atoms):
-            dipole[i] = np.einsum('ij,klm,kjm->kil',
-                                  born[i], born, dipole_tmp[i])
-            dipole[i, i] -= self._dipole_q0[i]
-
-        return np.reshape(np.transpose(dipole, axes=[0, 2, 1, 3]),
-                          (3*n_atoms, 3*n_atoms))
-
-    def _calculate_gamma_correction(self, q_dir):
-        """
-        Calculate non-analytic correction to the dynamical matrix at q=0
-        for a specified direction of approach. See Eq. 60 of X. Gonze
-        and C. Lee, PRB (1997) 55, 10355-10368.
-
-        Parameters
-        ----------
-        q_dir : (3,) float ndarray
-            The direction along which q approaches 0, in reciprocal
-            fractional coordinates
-
-        Returns
-        -------
-        na_corr : (3*n_atoms, 3*n_atoms) complex ndarray
-            The correction to the dynamical matrix
-        """
-        n_atoms = self.crystal.n_atoms
-        born = self._born
-        dielectric = self._dielectric
-        na_corr = np.zeros((3*n_atoms, 3*n_atoms), dtype=np.complex128)
-
-        if is_gamma(q_dir):
-            return na_corr
-
-        cell_volume = self.crystal._cell_volume()
-        denominator = np.einsum('ij,i,j', dielectric, q_dir, q_dir)
-        factor = 4*math.pi/(cell_volume*denominator)
-
-        q_born_sum = np.einsum('ijk,k->ij', born, q_dir)
-        for i in range(n_atoms):
-            for j in range(n_atoms):
-                na_corr[3*i:3*(i+1), 3*j:3*(j+1)] = np.einsum(
-                    'i,j->ij', q_born_sum[i], q_born_sum[j])
-        na_corr *= factor
-
-        return na_corr
-
-    def _get_shell_origins(self, n):
-        """
-        Given the shell number, compute all the cell origins that lie in
-        that shell
-
-        Parameters
-        ----------
-        n : int
-            The shell number
-
-        Returns
-        -------
-        origins : ((2*n + 1)**3 - (2*n - 1)**3, 3) int ndarray
-            The cell origins. Note: if n = 0, origins = [[0, 0, 0]]
-
-        """
-
-        if n == 0:
-            return np.array([[0, 0, 0]], dtype=np.int32)
-
-        # Coordinates of cells in xy plane where z=0, xz plane where
-        # y=0, yz plane where x=0. Note: to avoid duplicating cells at
-        # the edges, the xz plane has (2*n + 1) - 2 rows in z, rather
-        # than (2*n + 1). The yz plane also has (2*n + 1) - 2 rows in z
-        # and (2*n + 1) - 2 columns in y
-        xy = get_all_origins([n+1, n+1, 1], min_xyz=[-n, -n, 0])
-        xz = get_all_origins([n+1, 1, n], min_xyz=[-n, 0, -n+1])
-        yz = get_all_origins([1, n, n], min_xyz=[0, -n+1, -n+1])
-
-        # Offset each plane by n and -n to get the 6 planes that make up
-        # the shell
-        origins = np.zeros(((2*n+1)**3-(2*n-1)**3, 3), dtype=np.int32)
-        for i, ni in enumerate([-n, n]):
-            origins[i*len(xy):(i+1)*len(xy)] = xy
-            origins[i*len(xy):(i+1)*len(xy), 2] = ni
-            io = 2*len(xy)
-            origins[io+i*len(xz):io+(i+1)*len(xz)] = xz
-            origins[io+i*len(xz):io+(i+1)*len(xz), 1] = ni
-            io = 2*(len(xy) + len(xz))
-            origins[io+i*len(yz):io+(i+1)*len(yz)] = yz
-            origins[io+i*len(yz):io+(i+1)*len(yz), 0] = ni
-
-        return origins
-
-    def _enforce_realspace_asr(self):
-        """
-        Apply a transformation to the force constants matrix so that it
-        satisfies the acousic sum rule. Diagonalise, shift the acoustic
-        modes to almost zero then construct the correction to the force
-        constants matrix using the eigenvectors. For more information
-        see section 2.3.4:
-        http://www.tcm.phy.cam.ac.uk/castep/Phonons_Guide/Castep_Phonons.html
-
-        Returns
-        -------
-        force_constants : (n_cells_in_sc, 3*n_atoms, 3*n_atoms) float ndarray
-            The corrected force constants matrix
-        """
-        cell_origins = self.cell_origins
-        sc_matrix = self.sc_matrix
-        n_cells_in_sc = self.n_cells_in_sc
-        n_atoms = self.crystal.n_atoms
-        force_constants = self._force_constants
-        ax = np.newaxis
-
-        # Compute square matrix giving relative index of cells in sc
-        n_atoms_in_sc = n_atoms*n_cells_in_sc
-        sq_fc = np.zeros((3*n_atoms_in_sc, 3*n_atoms_in_sc))
-        inv_sc_matrix = np.linalg.inv(np.transpose(sc_matrix))
-        cell_origins_sc = np.einsum('ij,kj->ik', cell_origins, inv_sc_matrix)
-        for nc in range(n_cells_in_sc):
-            # Get all possible cell-cell vector combinations
-            inter_cell_vectors = cell_origins_sc - np.tile(cell_origins_sc[nc],
-                                                           (n_cells_in_sc, 1))
-            # Compare cell-cell vectors with origin-cell vectors and
-            # determine which are equivalent
-            # Do calculation in chunks, so loop can be broken if all
-            # equivalent vectors have been found
-            N = 100
-            dist_min = np.full((n_cells_in_sc), sys.float_info.max)
-            sc_relative_index = np.zeros(n_cells_in_sc, dtype=np.int32)
-            for i in range(int((n_cells_in_sc - 1)/N) + 1):
-                ci = i*N
-                cf = min((i + 1)*N, n_cells_in_sc)
-                dist = (inter_cell_vectors[:, ax, :] -
-                        cell_origins_sc[ax, ci:cf, :])
-                dist_frac = dist - np.rint(dist)
-                dist_frac_sum = np.sum(np.abs(dist_frac), axis=2)
-                scri_current = np.argmin(dist_frac_sum, axis=1)
-                dist_min_current = dist_frac_sum[
-                    range(n_cells_in_sc), scri_current]
-                replace = dist_min_current < dist_min
-                sc_relative_index[replace] = ci + scri_current[replace]
-                dist_min[replace] = dist_min_current[replace]
-                if np.all(dist_min <= 16*sys.float_info.epsilon):
-                    break
-            if np.any(dist_min > 16*sys.float_info.epsilon):
-                warnings.warn((
-                    'Error correcting FC matrix for acoustic sum rule, '
-                    'supercell relative index couldn\'t be found. '
-                    'Returning uncorrected FC matrix'))
-                return self.force_constants
-            sq_fc[3*nc*n_atoms:3*(nc+1)*n_atoms, :] = np.transpose(
-                np.reshape(force_constants[sc_relative_index],
-                           (3*n_cells_in_sc*n_atoms, 3*n_atoms)))
-        try:
-            ac_i, evals, evecs = self._find_acoustic_modes(sq_fc)
-        except Exception:
-            warnings.warn((
-                '\nError correcting for acoustic sum rule, could not '
-                'find 3 acoustic modes.\nReturning uncorrected FC '
-                'matrix'), stacklevel=2)
-            return self.force_constants
-
-        # Correct fc matrix - set acoustic modes to almost zero
-        fc_tol = 1e-8*np.min(np.abs(evals))
-        for ac in ac_i:
-            sq_fc -= (fc_tol + evals[ac])*np.einsum(
-                'i,j->ij', evecs[:, ac], evecs[:, ac])
-
-        fc = np.reshape(sq_fc[:, :3*n_atoms],
-                        (n_cells_in_sc, 3*n_atoms, 3*n_atoms))
-
-        return fc
-
-    def _enforce_reciprocal_asr(self, dyn_mat_gamma):
-        """
-        Calculate the correction to the dynamical matrix that would have
-        to be applied to satisfy the acousic sum rule. Diagonalise the
-        gamma-point dynamical matrix, shift the acoustic modes to almost
-        zero then reconstruct the dynamical matrix using the
-        eigenvectors. For more information see section 2.3.4:
-        http://www.tcm.phy.cam.ac.uk/castep/Phonons_Guide/Castep_Phonons.html
-
-        Parameters
-        ----------
-        dyn_mat_gamma : (3*n_atoms, 3*n_atoms) complex ndarray
-            The non mass-weighted dynamical matrix at gamma
-
-        Returns
-        -------
-        dyn_mat : (3*n_atoms, 3*n_atoms) complex ndarray or empty array
-            The corrected, non mass-weighted dynamical matrix at q.
-            Returns empty array (np.array([])) if finding the 3 acoustic
-            modes fails
-        """
-        tol = 5e-15
-
-        try:
-            ac_i, g_evals, g_evecs = self._find_acoustic_modes(
-                dyn_mat_gamma)
-        except Exception:
-            warnings.warn(('\nError correcting for acoustic sum rule, '
-                           'could not find 3 acoustic modes.\nNot '
-                           'correcting dynamical matrix'), stacklevel=2)
-            return np.array([], dtype=np.complex128)
-
-        n_atoms = self.crystal.n_atoms
-        recip_asr_correction = np.zeros((3*n_atoms, 3*n_atoms),
-                                        dtype=np.complex128)
-        for i, ac in enumerate(ac_i):
-            recip_asr_correction -= (tol*i + g_evals[ac])*np.einsum(
-                'i,j->ij', g_evecs[:, ac], g_evecs[:, ac])
-
-        return recip_asr_correction
-
-    def _find_acoustic_modes(self, dyn_mat):
-        """
-        Find the acoustic modes from a dynamical matrix, they should
-        have the sum of c of m amplitude squared = mass (note: have not
-        actually included mass weighting here so assume mass = 1.0)
-
-        Parameters
-        ----------
-        dyn_mat : (3*n_atoms, 3*n_atoms) complex ndarray
-            A dynamical matrix
-
-        Returns
-        -------
-        ac_i : (3,) int ndarray
-            The indices of the acoustic modes
-        evals : (3*n_atoms) float ndarray
-            Dynamical matrix eigenvalues
-        evecs : (3*n_atoms, n_atoms, 3) complex ndarray
-            Dynamical matrix eigenvectors
-        """
-        n_branches = dyn_mat.shape[0]
-        n_atoms = int(n_branches/3)
-
-        evals, evecs = np.linalg.eigh(dyn_mat, UPLO='U')
-        evec_reshape = np.reshape(
-            np.transpose(evecs), (n_branches, n_atoms, 3))
-        # Sum displacements for all ions in each branch
-        c_of_m_disp = np.sum(evec_reshape, axis=1)
-        c_of_m_disp_sq = np.sum(np.abs(c_of_m_disp)**2, axis=1)
-        sensitivity = 0.5
-        sc_mass = 1.0*n_atoms
-        # Check number of acoustic modes
-        if np.sum(c_of_m_disp_sq > sensitivity*sc_mass) < 3:
-            raise Exception('Could not find 3 acoustic modes')
-        # Find idx of acoustic modes (3 largest c of m displacements)
-        ac_i = np.argsort(c_of_m_disp_sq)[-3:]
-
-        return ac_i, evals, evecs
-
-    def _calculate_phases(self, q, unique_sc_offsets, unique_sc_i,
-                          unique_cell_origins, unique_cell_i):
-        """
-        Calculate the phase factors for the supercell images and cells
-        for a single q-point. The unique supercell and cell origins
-        indices are required to minimise expensive exp and power
-        operations
-
-        Parameters
-        ----------
-        q : (3,) float ndarray
-            The q-point to calculate the phase for
-        unique_sc_offsets : list of lists of ints
-            A list containing 3 lists of the unique supercell image
-            offsets in each direction. The supercell offset is
-            calculated by multiplying the supercell matrix by the
-            supercell image indices (obtained by _get_all_origins()). A
-            list of lists rather than a Numpy array is used as the 3
-            lists are independent and their size is not known beforehand
-        unique_sc_i : ((2*lim + 1)**3, 3) int ndarray
-            The indices needed to reconstruct sc_offsets from the unique
-            values in unique_sc_offsets
-        unique_cell_origins : list of lists of ints
-            A list containing 3 lists of the unique cell origins in each
-            direction. A list of lists rather than a Numpy array is used
-            as the 3 lists are independent and their size is not known
-            beforehand
-        unique_cell_i : (cell_origins, 3) int ndarray
-            The indices needed to reconstruct cell_origins from the
-            unique values in unique_cell_origins
-
-        Returns
-        -------
-        sc_phases : (unique_sc_i,) float ndarray
-            Phase factors exp(iq.r) for each supercell image coordinate
-            in sc_offsets
-        cell_phases : (unique_cell_i,) float ndarray
-            Phase factors exp(iq.r) for each cell coordinate in the
-            supercell
-        """
-
-        # Only calculate exp(iq) once, then raise to power to get the
-        # phase at different supercell/cell coordinates to minimise
-        # expensive exp calculations
-        # exp(iq.r) = exp(iqh.ra)*exp(iqk.rb)*exp(iql.rc)
-        #           = (exp(iqh)^ra)*(exp(iqk)^rb)*(exp(iql)^rc)
-        phase = np.exp(2j*math.pi*q)
-        sc_phases = np.ones(len(unique_sc_i), dtype=np.complex128)
-        cell_phases = np.ones(len(unique_cell_i), dtype=np.complex128)
-        for i in range(3):
-            unique_sc_phases = np.power(phase[i], unique_sc_offsets[i])
-            sc_phases *= unique_sc_phases[unique_sc_i[:, i]]
-
-            unique_cell_phases = np.power(phase[i], unique_cell_origins[i])
-            cell_phases *= unique_cell_phases[unique_cell_i[:, i]]
-
-        return sc_phases, cell_phases
-
-    def _calculate_supercell_images(self, lim):
-        """
-        For each displacement of ion i in the unit cell and ion j in the
-        supercell, calculate the number of supercell periodic images
-        there are and which supercells they reside in, and sets the
-        sc_image_i, and n_sc_images ForceConstants attributes
-
-        Parameters
-        ----------
-        lim : int
-            The supercell image limit
-        """
-
-        n_atoms = self.crystal.n_atoms
-        cell_vectors = self.crystal._cell_vectors
-        atom_r = self.crystal.atom_r
-        cell_origins = self.cell_origins
-        n_cells_in_sc = self.n_cells_in_sc
-        sc_matrix = self.sc_matrix
-        ax = np.newaxis
-
-        # List of points defining Wigner-Seitz cell
-        ws_frac = np.array([[0, 0, 0], [0, 0, 1], [0, 1, 0], [0, 1, 1],
-                            [0, 1, -1], [1, 0, 0], [1, 0, 1], [1, 0, -1],
-                            [1, 1, 0], [1, 1, 1], [1, 1, -1], [1, -1, 0],
-                            [1, -1, 1], [1, -1, -1]])
-        cutoff_scale = 1.0
-
-        # Calculate points of WS cell for this supercell
-        sc_vecs = np.dot(sc_matrix, cell_vectors)
-        ws_list = np.dot(ws_frac, sc_vecs)
-        inv_ws_sq = 1.0/np.sum(np.square(ws_list[1:]), axis=1)
-        ws_list_norm = ws_list[1:]*inv_ws_sq[:, ax]
-
-        # Get Cartesian coords of supercell images and ions in supercell
-        sc_image_r = get_all_origins(
-            np.repeat(lim, 3) + 1, min_xyz=-np.repeat(lim, 3))
-        sc_image_cart = np.einsum('ij,jk->ik', sc_image_r, sc_vecs)
-        sc_atom_r = np.einsum('ijk,kl->ijl',
-                             cell_origins[:, ax, :] + atom_r[ax, :, :],
-                             np.linalg.inv(np.transpose(sc_matrix)))
-        sc_ion_cart = np.einsum('ijk,kl->ijl', sc_atom_r, sc_vecs)
-
-        sc_image_i = np.full((n_cells_in_sc, n_atoms, n_atoms, (2*lim + 1)**3),
-                             -1, dtype=np.int32)
-        n_sc_images = np.zeros((n_cells_in_sc, n_atoms, n_atoms),
-                               dtype=np.int32)
-
-        # Ordering of loops here is for efficiency:
-        # ions in unit cell -> periodic supercell images -> WS points
-        # This is so the ion-ion vectors in each loop will be similar,
-        # so they are more likely to pass/fail the WS check together
-        # so the last loop can be broken early
-        for i in range(n_atoms):
-            rij = sc_ion_cart[0, i] - sc_ion_cart
-            for im, sc_r in enumerate(sc_image_cart):
-                # Get vector between j in sc image and i in unit cell
-                dists = rij - sc_r
-                # Only want to include images where ion < halfway to ALL
-                # ws points, so compare vector to all ws points
-                for n, wsp in enumerate(ws_list_norm):
-                    dist_wsp = np.absolute(np.sum(dists*wsp, axis=-1))
-                    if n == 0:
-                        nc_idx, nj_idx = np.where(
-                            dist_wsp <= (0.5*cutoff_scale + 0.001)
-                        )
-                        # Reindex dists to remove elements where the ion
-                        # is > halfway to WS point for efficiency
-                        dists = dists[nc_idx, nj_idx]
-                    else:
-                        # After first reindex, dists is now 1D so need
-                        # to reindex like this instead
-                        idx = np.where(
-                            dist_wsp <= (0.5*cutoff_scale + 0.001)
-                        )[0]
-                        nc_idx = nc_idx[idx]
-                        nj_idx = nj_idx[idx]
-                        dists = dists[idx]
-                    if len(nc_idx) == 0:
-                        break
-                    # If ion-ion vector has been < halfway to all WS
-                    # points, this is a valid image! Save it
-                    if n == len(ws_list_norm) - 1:
-                        n_im_idx = n_sc_images[nc_idx, i, nj_idx]
-                        sc_image_i[nc_idx, i, nj_idx, n_im_idx] = im
-                        n_sc_images[nc_idx, i, nj_idx] += 1
-
-        self._n_sc_images = n_sc_images
-        # Truncate sc_image_i to the maximum ACTUAL images rather than
-        # the maximum possible images to avoid storing and summing over
-        # nonexistent images
-        self._sc_image_i = sc_image_i[:, :, :, :np.max(n_sc_images)]
-
-    def to_dict(self):
-        """
-        Convert to a dictionary. See ForceConstants.from_dict for
-        details on keys/values
-
-        Returns
-        -------
-        dict
-        """
-        dout = _obj_to_dict(self, ['crystal', 'force_constants',
-                                   'n_cells_in_sc', 'sc_matrix',
-                                   'cell_origins', 'born',
-                                   'dielectric'])
-        return dout
-
-    def to_json_file(self, filename):
-        """
-        Write to a JSON file. JSON fields are equivalent to
-        ForceConstants.from_dict keys
-
-        Parameters
-        ----------
-        filename : str
-            Name of the JSON file to write to
-        """
-        _obj_to_json_file(self, filename)
-
-    @classmethod
-    def from_dict(cls, d):
-        """
-        Convert a dictionary to a ForceConstants object
-
-        Parameters
-        ----------
-        d : dict
-            A dictionary with the following keys/values:
-
-            - 'crystal': dict, see Crystal.from_dict
-            - 'force_constants': (n_cells_in_sc, 3*crystal.n_atoms, 3*crystal.n_atoms) float ndarray
-            - 'force_constants_unit': str
-            - 'sc_matrix': (3,3) int ndarray
-            - 'cell_origins': (n_cells_in_sc, 3) int ndarray
-
-            There are also the following optional keys:
-
-            - 'born': (3*crystal.n_atoms, 3, 3) float ndarray
-            - 'born_unit': str
-            - 'dielectric': (3, 3) float ndarray
-            - 'dielectric_unit': str
-
-        Returns
-        -------
-        ForceConstants
-        """
-        crystal = Crystal.from_dict(d['crystal'])
-        d = _process_dict(
-            d, quantities=['force_constants', 'born', 'dielectric'],
-            optional=['born', 'dielectric'])
-        return ForceConstants(crystal, d['force_constants'], d['sc_matrix'],
-                              d['cell_origins'], d['born'], d['dielectric'])
-
-    @classmethod
-    def from_json_file(cls, filename):
-        """
-        Read from a JSON file. See ForceConstants.from_dict for required
-        fields
-
-        Parameters
-        ----------
-        filename : str
-            The file to read from
-
-        Returns
-        -------
-        ForceConstants
-        """
-        return _obj_from_json_file(cls, filename)
-
-    @classmethod
-    def from_castep(cls, filename):
-        """
-        Reads from a .castep_bin or .check file
-
-        Parameters
-        ----------
-        filename : str
-            The path and name of the file to read
-
-        Returns
-        -------
-        ForceConstants
-        """
-        data = castep._read_interpolation_data(filename)
-        return cls.from_dict(data)
-
-    @classmethod
-    def from_phonopy(cls, path='.', summary_name='phonopy.yaml',
-                     born_name=None, fc_name='FORCE_CONSTANTS',
-                     fc_format=None):
-        """
-        Reads data from the phonopy summary file (default phonopy.yaml)
-        and optionally born and force constants files. Only attempts to
-        read from born or force constants files if these can't be found
-        in the summary file.
-
-        Parameters
-        ----------
-        path : str, optional
-            Path to directory containing the file(s)
-        summary_name : str, optional
-            Filename of phonopy summary file, default phonopy.yaml. By
-            default any information (e.g. force constants) read from
-            this file takes priority
-        born_name : str, optional
-            Name of the Phonopy file containing born charges and
-            dielectric tensor (by convention in Phonopy this would be
-            called BORN). Is only read if Born charges can't be found in
-            the summary_name file
-        fc_name : str, optional
-            Name of file containing force constants. Is only read if
-            force constants can't be found in summary_name
-        fc_format : {'phonopy', 'hdf5'} str, optional
-            Format of file containing force constants data.
-            FORCE_CONSTANTS is type 'phonopy'
-
-        Returns
-        -------
-        ForceConstants
-        """
-        data = phonopy._read_interpolation_data(
-            path=path, summary_name=summary_name, born_name=born_name,
-            fc_name=fc_name, fc_format=fc_format)
-        return cls.from_dict(data)
+import math
+import mmap
+import sys
+import time
+import warnings
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # shared_memory is only available in Python >= 3.8
+    shared_memory = None
+import numpy as np
+from pint import Quantity
+from scipy.linalg.lapack import zheev
+from scipy.special import erfc
+from euphonic import ureg
+from euphonic.crystal import Crystal
+from euphonic.qpoint_phonon_modes import QpointPhononModes
+from euphonic.qpoint_frequencies import QpointFrequencies
+from euphonic.util import (is_gamma, get_all_origins,
+                           _check_constructor_inputs, _get_array_types)
+from euphonic.io import (_obj_to_json_file, _obj_from_json_file,
+                         _obj_to_dict, _process_dict, _hash_arrays,
+                         _load_cache_npz, _save_cache_npz)
+from euphonic.readers import castep, phonopy
+
+
+# Increment if the cached q-independent values in
+# ForceConstants._calculate_phonons_setup change, to invalidate existing
+# cache entries
+_SETUP_CACHE_VERSION = 1
+# The eta_scale values tried when eta_scale='auto'
+_AUTO_ETA_SCALES = (0.5, 0.75, 1.0, 1.25, 1.5)
+
+
+class ImportCError(Exception):
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return "ImportCError: {}".format(self.message)
+
+
+class ForceConstants(object):
+    """
+    A class to read and store the data required for a phonon
+    interpolation calculation from model (e.g. CASTEP) output,
+    and calculate phonon frequencies/eigenvectors at arbitrary q-points
+    via Fourier interpolation
+
+    Attributes
+    ----------
+    crystal : Crystal
+        Lattice and atom information
+    force_constants : (n_cells_in_sc, 3*n_atoms, 3*n_atoms) float Quantity
+        Force constants matrix
+    sc_matrix : (3, 3) int ndarray
+        The supercell matrix
+    n_cells_in_sc : int
+        Number of cells in the supercell
+    cell_origins : (n_cells_in_sc, 3) int ndarray
+        The locations of the unit cells within the supercell
+    born : (n_atoms, 3, 3) float Quantity or None
+        The Born charges for each atom
+    dielectric : (3, 3) float Quantity or None
+        The dielectric permittivity tensor
+    """
+
+    def __init__(self, crystal, force_constants, sc_matrix, cell_origins,
+                 born=None, dielectric=None):
+        """
+        Parameters
+        ----------
+        crystal : Crystal
+            Lattice and atom information
+        force_constants : (n_cells_in_sc, 3*n_atoms, 3*n_atoms) float Quantity
+            Force constants matrix
+        sc_matrix : (3, 3) int ndarray
+            The supercell matrix
+        cell_origins : (n_cells_in_sc, 3) int ndarray
+            The locations of the unit cells within the supercell
+        born : (n_atoms, 3, 3) float Quantity, optional
+            The Born charges for each atom
+        dielectric : (3, 3) float Quantity, optional
+            The dielectric permittivity tensor
+        """
+        # Check independent inputs first
+        _check_constructor_inputs(
+            [crystal, sc_matrix], [Crystal, np.ndarray], [(), (3, 3)],
+            ['crystal', 'sc_matrix'])
+        n_at = crystal.n_atoms
+        n_sc = int(np.rint(np.absolute(np.linalg.det(sc_matrix))))
+        # Now check other derived input shapes
+        _check_constructor_inputs(
+            [force_constants, cell_origins, born, dielectric],
+            [Quantity, np.ndarray, [Quantity, type(None)],
+                [Quantity, type(None)]],
+            [(n_sc, 3*n_at, 3*n_at), (n_sc, 3), (n_at, 3, 3), (3, 3)],
+            ['force_constants', 'cell_origins', 'born', 'dielectric'])
+        self.crystal = crystal
+        self._force_constants = force_constants.to(
+            'INTERNAL_ENERGY_UNIT/INTERNAL_LENGTH_UNIT**2').magnitude
+        self.force_constants_unit = str(force_constants.units)
+        self.sc_matrix = sc_matrix
+        self.cell_origins = cell_origins
+        self.n_cells_in_sc = n_sc
+        # Per-object store of the q-independent phonon calculation
+        # values, see _calculate_phonons_setup
+        self._setup_cache = {}
+        # Per-object store of the eta_scale chosen by eta_scale='auto'
+        # for each backend, see _get_auto_eta_scale
+        self._auto_eta_scale = {}
+
+        if born is not None:
+            self._born = born.to(ureg.INTERNAL_CHARGE_UNIT).magnitude
+            self.born_unit = str(born.units)
+            self._dielectric = dielectric.to(ureg(
+                '(INTERNAL_CHARGE_UNIT**2)/'
+                '(INTERNAL_LENGTH_UNIT*INTERNAL_ENERGY_UNIT)')).magnitude
+            self.dielectric_unit = str(dielectric.units)
+        else:
+            self._born = born
+            self.born_unit = str(ureg.INTERNAL_CHARGE_UNIT)
+            self._dielectric = dielectric
+            self.dielectric_unit = str(ureg((
+                '(INTERNAL_CHARGE_UNIT**2)/'
+                '(INTERNAL_LENGTH_UNIT*INTERNAL_ENERGY_UNIT)')))
+
+    @property
+    def force_constants(self):
+        return self._force_constants*ureg(
+            'INTERNAL_ENERGY_UNIT/INTERNAL_LENGTH_UNIT**2').to(
+                self.force_constants_unit)
+
+    @property
+    def born(self):
+        if self._born is not None:
+            return self._born*ureg('INTERNAL_CHARGE_UNIT').to(self.born_unit)
+        else:
+            return None
+
+    @property
+    def dielectric(self):
+        if self._dielectric is not None:
+            return self._dielectric*ureg((
+                '(INTERNAL_CHARGE_UNIT**2)/'
+                '(INTERNAL_LENGTH_UNIT*INTERNAL_ENERGY_UNIT)')).to(
+                    self.dielectric_unit)
+        else:
+            return None
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            if name in ['force_constants_unit', 'born_unit',
+                        'dielectric_unit']:
+                ureg(getattr(self, name)).to(value)
+        super(ForceConstants, self).__setattr__(name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Shut down any processes started by calculations with n_procs,
+        and free the shared memory used to pass arrays to them. This
+        object can still be used afterwards, new processes are started
+        if required
+        """
+        for setup in self._setup_cache.values():
+            pool = setup.pop('process_pool', None)
+            if pool is not None:
+                pool.close()
+
+    def calculate_qpoint_phonon_modes(
+        self, qpts, asr=None, dipole=True, eta_scale=1.0, splitting=True,
+        insert_gamma=False, reduce_qpts=True, use_c=False, n_threads=1,
+        fall_back_on_python=True, n_procs=1, cache_dir=None,
+        cache_max_size=2**30, use_symmetry=False, out=None,
+        dtype=np.float64, chunk_size=None):
+        """
+        Calculate phonon frequencies and eigenvectors at specified
+        q-points from a force constants matrix via Fourier interpolation
+
+        Parameters
+        ----------
+        qpts : (n_qpts, 3) float ndarray
+            The q-points to interpolate onto
+        asr : {'realspace', 'reciprocal'}, optional
+            Which acoustic sum rule correction to apply. 'realspace'
+            applies the correction to the force constant matrix in real
+            space. 'reciprocal' applies the correction to the dynamical
+            matrix at every q-point
+        dipole : boolean, optional
+            Calculates the dipole tail correction to the dynamical
+            matrix at each q-point using the Ewald sum, if the Born
+            charges and dielectric permitivitty tensor are present.
+        eta_scale : float or 'auto', optional
+            Changes the cutoff in real/reciprocal space for the dipole
+            Ewald sum. A higher value uses more reciprocal terms. If tuned
+            correctly this can result in performance improvements. See
+            scripts/optimise_eta.py for help on choosing a good eta_scale.
+            If 'auto', eta_scale is chosen by timing a short calculation
+            on the backend in use (C with n_threads, or Python) for
+            several values, and the fastest per q-point is used. The
+            chosen value is stored on the object, and in cache_dir if
+            provided
+        splitting : boolean, optional
+            Whether to calculate the LO-TO splitting at the gamma
+            points. Only applied if dipole is True and the Born charges
+            and dielectric permitivitty tensor are present.
+        insert_gamma : boolean, optional
+            If splitting is True, this will insert gamma points into
+            qpts to store the extra split frequencies. Note this means
+            that the length of qpts in the output QpointPhononModes
+            object will not necessarily be the same as the input qpts.
+            If qpts already contains double gamma points where you want
+            split frequencies, leave this as False.
+        reduce_qpts : boolean, optional
+            Whether to use periodicity to reduce all q-points and only
+            calculate for unique q-points within the 1st BZ. Time
+            reversal symmetry is also used, so only one of each q, -q
+            pair is calculated (as D(-q) = D(q)*, the frequencies are
+            the same and the eigenvectors are complex conjugates),
+            unless the reciprocal acoustic sum rule correction is
+            complex.
+            This won't change the output but could increase
+            performance.
+        use_c : boolean, optional
+            Whether to use C instead of Python to calculate and
+            diagonalise the dynamical matrix
+        n_threads : int, optional
+            The number of OpenMP threads to use when looping over
+            q-points in C. Only applicable if use_c=True
+        fall_back_on_python : boolean, optional
+            If we cannot use the C extension, fall back on using python
+            if this is true, else raise an ImportCError.
+        n_procs : int, optional
+            The number of processes to use when looping over q-points
+            in Python. The q-points are split between the processes of
+            a concurrent.futures.ProcessPoolExecutor, and the force
+            constants and other large arrays are placed in shared
+            memory rather than being copied to each process. Only
+            applicable if use_c=False, or if the C extension can't be
+            used and fall_back_on_python=True. Requires Python >= 3.8,
+            otherwise a single process is used. The processes and
+            shared memory are kept and reused by later calls with the
+            same asr, dipole and eta_scale until ForceConstants.close
+            is called (or the with block the object was used in exits)
+        cache_dir : str, optional
+            If provided, the q-independent parts of the calculation
+            (supercell images, dipole Ewald sum tables and realspace
+            acoustic sum rule corrected force constants) are stored in
+            this directory, keyed by a hash of the crystal, force
+            constants, supercell matrix, Born charges, dielectric tensor
+            and eta_scale. If the same data is used again, even in a
+            different process, they are read from the cache rather than
+            recalculated
+        cache_max_size : int, optional
+            The maximum total size in bytes of the files in cache_dir.
+            If exceeded, the least recently used entries are removed
+        use_symmetry : boolean, optional
+            Whether to use the rotational symmetry of the crystal
+            (determined with spglib) to further reduce the q-points
+            after reduce_qpts. Only one q-point from each set of
+            symmetry equivalent q-points is calculated, and the
+            eigenvectors at the others are obtained by rotating its
+            eigenvectors. This assumes that the force constants (and
+            Born charges and dielectric tensor) have the symmetry of
+            the crystal, and is most useful for q-points on a grid
+            covering the whole Brillouin zone
+        out : (n_qpts, 3*n_atoms, n_atoms, 3) complex ndarray or h5py.Dataset, optional
+            A preallocated C-contiguous complex128 array (e.g. a
+            numpy.memmap), or a writeable complex128 h5py.Dataset, to
+            write the eigenvectors into. If provided, it is used as the
+            eigenvectors of the returned QpointPhononModes without
+            copying, so reusing it in a later call will overwrite those
+            eigenvectors. If there is LO-TO splitting and
+            insert_gamma=True, n_qpts must include the inserted gamma
+            points. If dtype is numpy.float32, out must be complex64
+        dtype : {numpy.float64, numpy.float32}, optional
+            The precision used to diagonalise the dynamical matrix and
+            store the eigenvectors. If numpy.float32, the dynamical
+            matrix is still calculated in double precision, but is
+            diagonalised in single precision and the eigenvectors are
+            returned as a complex64 array, which halves their memory.
+            The frequencies are always returned in double precision.
+            See the ForceConstants documentation for the expected
+            accuracy
+        chunk_size : int, optional
+            If provided, the q-points are calculated chunk_size at a
+            time (see ForceConstants.iter_qpoint_phonon_modes), and the
+            eigenvectors of each chunk are written into out (if
+            provided) as it completes. This limits the memory used by
+            the calculation when out is stored on disk. Defaults to
+            calculating all q-points at once, unless out is an
+            h5py.Dataset, in which case chunks of 1000 q-points are used
+
+        Returns
+        -------
+        QpointPhononModes
+            A QpointPhononModes object containing the interpolated
+            frequencies and eigenvectors at each q-point. Note that if
+            there is LO-TO splitting, and insert_gamma=True, the number
+            of input q-points may not be the same as in the output
+            object
+
+        Raises
+        ------
+        ImportCError
+            If we have selected not to fall back on Python and cannot
+            use the C extension
+        ValueError
+            If out doesn't have the correct shape or dtype, or isn't a
+            writeable C-contiguous array or h5py.Dataset, or if dtype isn't
+            numpy.float32 or numpy.float64
+
+        Notes
+        -----
+        Phonon frequencies/eigenvectors are calculated at any q-point by
+        Fourier interpolation of a force constants matrix. The force
+        constants matrix is defined as [1]_:
+
+        .. math::
+
+          \\phi_{\\alpha, {\\alpha}'}^{\\kappa, {\\kappa}'} =
+          \\frac{\\delta^{2}E}{{\\delta}u_{\\kappa,\\alpha}{\\delta}u_{{\\kappa}',{\\alpha}'}}
+
+        Which gives the Dynamical matrix at q:
+
+        .. math::
+
+          D_{\\alpha, {\\alpha}'}^{\\kappa, {\\kappa}'}(q) =
+          \\frac{1}{\\sqrt{M_\\kappa M_{\\kappa '}}}
+          \\sum_{a}\\phi_{\\alpha, \\alpha '}^{\\kappa, \\kappa '}e^{-iq\\cdot r_a}
+
+        The eigenvalue equation for the dynamical matrix is then:
+
+        .. math::
+
+          D_{\\alpha, {\\alpha}'}^{\\kappa, {\\kappa}'}(q) \\epsilon_{q\\nu\\kappa\\alpha} =
+          \\omega_{q\\nu}^{2} \\epsilon_{q\\nu\\kappa\\alpha}
+
+        Where :math:`\\nu` runs over phonon modes, :math:`\\kappa` runs
+        over atoms, :math:`\\alpha` runs over the Cartesian directions,
+        :math:`a` runs over unit cells in the supercell,
+        :math:`u_{\\kappa, \\alpha}` is the displacement of atom
+        :math:`\\kappa` in direction :math:`\\alpha`,
+        :math:`M_{\\kappa}` is the mass of atom :math:`\\kappa`,
+        :math:`r_{a}` is the vector to the origin of cell :math:`a` in
+        the supercell, :math:`\\epsilon_{q\\nu\\kappa\\alpha}` are the
+        eigevectors, and :math:`\\omega_{q\\nu}^{2}` are the frequencies
+        squared.
+
+        In polar materials, there is an additional long-ranged
+        correction to the force constants matrix (applied if
+        dipole=True) and a non-analytical correction at the gamma point
+        [2]_ (applied if splitting=True).
+
+        .. [1] M.T. Dove, Introduction to Lattice Dynamics, Cambridge University Press, Cambridge, 1993, 83-87
+        .. [2] X. Gonze, K. C. Charlier, D. C. Allan, M. P. Teter, Phys. Rev. B, 1994, 50, 13035-13038
+        """
+        # Set default splitting params
+        if self.born is None:
+            dipole = False
+        if not dipole:
+            splitting = False
+
+        if splitting and insert_gamma:
+            qpts = self._insert_split_gamma(qpts)
+
+        complex_dtype = _get_complex_dtype(dtype)
+        n_atoms = self.crystal.n_atoms
+        out_shape = (len(qpts), 3*n_atoms, n_atoms, 3)
+        if out is not None:
+            if isinstance(out, np.ndarray):
+                writeable = (out.flags['C_CONTIGUOUS']
+                             and out.flags['WRITEABLE'])
+            elif isinstance(out, tuple(_get_array_types())):
+                # h5py.Dataset
+                writeable = out.file.mode == 'r+'
+                if chunk_size is None:
+                    chunk_size = 1000
+            else:
+                writeable = False
+            if (not writeable
+                    or out.shape != out_shape
+                    or out.dtype != complex_dtype):
+                raise ValueError((
+                    f'out must be a writeable C-contiguous {complex_dtype} '
+                    f'array or h5py.Dataset with shape {out_shape}'))
+
+        if dipole and eta_scale == 'auto':
+            eta_scale = self._get_auto_eta_scale(
+                use_c, n_threads, cache_dir, cache_max_size)
+        setup = self._calculate_phonons_setup(asr, dipole, eta_scale,
+                                              cache_dir, cache_max_size)
+        if chunk_size is None:
+            freqs, eigenvectors = self._calculate_phonons_at_qpts(
+                qpts, setup, splitting, reduce_qpts, use_c, n_threads,
+                fall_back_on_python, n_procs, use_symmetry=use_symmetry,
+                eigenvectors_out=out, dtype=dtype)
+        else:
+            if out is None:
+                out = np.empty(out_shape, dtype=complex_dtype)
+            freqs = np.zeros(out_shape[:2])*ureg('mDEFAULT_ENERGY_UNIT')
+            for qi, qf, chunk_freqs, chunk_evecs in (
+                    self._iter_phonons_at_qpts(
+                        qpts, chunk_size, setup, splitting, reduce_qpts,
+                        use_c, n_threads, fall_back_on_python, n_procs,
+                        use_symmetry=use_symmetry, dtype=dtype)):
+                freqs[qi:qf] = chunk_freqs
+                out[qi:qf] = chunk_evecs
+            eigenvectors = out
+
+        return QpointPhononModes(
+            self.crystal, qpts, freqs, eigenvectors,
+            weights=np.full(len(qpts), 1.0/len(qpts)))
+
+    def calculate_qpoint_frequencies(
+        self, qpts, asr=None, dipole=True, eta_scale=1.0, splitting=True,
+        insert_gamma=False, reduce_qpts=True, use_c=False, n_threads=1,
+        fall_back_on_python=True, n_procs=1, cache_dir=None,
+        cache_max_size=2**30, use_symmetry=False, dtype=np.float64):
+        """
+        Calculate phonon frequencies (without eigenvectors) at specified
+        q-points from a force constants matrix via Fourier
+        interpolation. Only the eigenvalues of the dynamical matrix are
+        calculated, which is faster and uses less memory than
+        ForceConstants.calculate_qpoint_phonon_modes, so this should be
+        used if eigenvectors aren't required (e.g. for dispersion plots
+        or density of states). See
+        ForceConstants.calculate_qpoint_phonon_modes for algorithm
+        details
+
+        Parameters
+        ----------
+        qpts : (n_qpts, 3) float ndarray
+            The q-points to interpolate onto
+        asr : {'realspace', 'reciprocal'}, optional
+            Which acoustic sum rule correction to apply. See
+            ForceConstants.calculate_qpoint_phonon_modes
+        dipole : boolean, optional
+            Whether to calculate the dipole tail correction. See
+            ForceConstants.calculate_qpoint_phonon_modes
+        eta_scale : float or 'auto', optional
+            Changes the cutoff in real/reciprocal space for the dipole
+            Ewald sum. See ForceConstants.calculate_qpoint_phonon_modes
+        splitting : boolean, optional
+            Whether to calculate the LO-TO splitting at the gamma
+            points. See ForceConstants.calculate_qpoint_phonon_modes
+        insert_gamma : boolean, optional
+            If splitting is True, this will insert gamma points into
+            qpts to store the extra split frequencies. See
+            ForceConstants.calculate_qpoint_phonon_modes
+        reduce_qpts : boolean, optional
+            Whether to use periodicity and time reversal symmetry to
+            reduce all q-points and only calculate for unique q-points
+            within the 1st BZ. See
+            ForceConstants.calculate_qpoint_phonon_modes
+        use_c : boolean, optional
+            Whether to use C instead of Python to calculate and
+            diagonalise the dynamical matrix
+        n_threads : int, optional
+            The number of OpenMP threads to use when looping over
+            q-points in C. Only applicable if use_c=True
+        fall_back_on_python : boolean, optional
+            If we cannot use the C extension, fall back on using python
+            if this is true, else raise an ImportCError.
+        n_procs : int, optional
+            The number of processes to use when looping over q-points
+            in Python. See ForceConstants.calculate_qpoint_phonon_modes
+        cache_dir : str, optional
+            Directory to cache the q-independent parts of the
+            calculation in. See
+            ForceConstants.calculate_qpoint_phonon_modes
+        cache_max_size : int, optional
+            The maximum total size in bytes of the files in cache_dir
+        use_symmetry : boolean, optional
+            Whether to use the rotational symmetry of the crystal to
+            reduce the q-points. See
+            ForceConstants.calculate_qpoint_phonon_modes
+        dtype : {numpy.float64, numpy.float32}, optional
+            The precision used to diagonalise the dynamical matrix. See
+            ForceConstants.calculate_qpoint_phonon_modes
+
+        Returns
+        -------
+        QpointFrequencies
+            A QpointFrequencies object containing the interpolated
+            frequencies at each q-point. Note that if there is LO-TO
+            splitting, and insert_gamma=True, the number of input
+            q-points may not be the same as in the output object
+
+        Raises
+        ------
+        ImportCError
+            If we have selected not to fall back on Python and cannot
+            use the C extension
+        ValueError
+            If dtype isn't numpy.float32 or numpy.float64
+        """
+        _get_complex_dtype(dtype)
+        if self.born is None:
+            dipole = False
+        if not dipole:
+            splitting = False
+
+        if splitting and insert_gamma:
+            qpts = self._insert_split_gamma(qpts)
+
+        if dipole and eta_scale == 'auto':
+            eta_scale = self._get_auto_eta_scale(
+                use_c, n_threads, cache_dir, cache_max_size)
+        setup = self._calculate_phonons_setup(asr, dipole, eta_scale,
+                                              cache_dir, cache_max_size)
+        freqs, _ = self._calculate_phonons_at_qpts(
+            qpts, setup, splitting, reduce_qpts, use_c, n_threads,
+            fall_back_on_python, n_procs, return_eigenvectors=False,
+            use_symmetry=use_symmetry, dtype=dtype)
+
+        return QpointFrequencies(
+            self.crystal, qpts, freqs,
+            weights=np.full(len(qpts), 1.0/len(qpts)))
+
+    def iter_qpoint_phonon_modes(
+        self, qpts, chunk_size=1000, asr=None, dipole=True, eta_scale=1.0,
+        splitting=True, insert_gamma=False, reduce_qpts=True, use_c=False,
+        n_threads=1, fall_back_on_python=True, n_procs=1, cache_dir=None,
+        cache_max_size=2**30, use_symmetry=False, dtype=np.float64):
+        """
+        Calculate phonon frequencies and eigenvectors at specified
+        q-points in chunks, yielding a QpointPhononModes object for
+        each chunk. The q-independent parts of the calculation (e.g.
+        supercell images, Ewald sum initialisation, acoustic sum rule
+        correction) are only calculated once, so the peak memory usage
+        is determined by chunk_size rather than the total number of
+        q-points. See ForceConstants.calculate_qpoint_phonon_modes for
+        algorithm details
+
+        Parameters
+        ----------
+        qpts : (n_qpts, 3) float ndarray
+            The q-points to interpolate onto
+        chunk_size : int, optional
+            The maximum number of q-points in each yielded
+            QpointPhononModes object
+        asr : {'realspace', 'reciprocal'}, optional
+            Which acoustic sum rule correction to apply. See
+            ForceConstants.calculate_qpoint_phonon_modes
+        dipole : boolean, optional
+            Whether to calculate the dipole tail correction. See
+            ForceConstants.calculate_qpoint_phonon_modes
+        eta_scale : float or 'auto', optional
+            Changes the cutoff in real/reciprocal space for the dipole
+            Ewald sum. See ForceConstants.calculate_qpoint_phonon_modes
+        splitting : boolean, optional
+            Whether to calculate the LO-TO splitting at the gamma
+            points. The q-points adjacent to each chunk are used to
+            determine the direction of approach to gamma, so the
+            result is the same as if all q-points were calculated at
+            once
+        insert_gamma : boolean, optional
+            If splitting is True, this will insert gamma points into
+            qpts to store the extra split frequencies. See
+            ForceConstants.calculate_qpoint_phonon_modes
+        reduce_qpts : boolean, optional
+            Whether to use periodicity and time reversal symmetry to
+            reduce the q-points in each chunk and only calculate for
+            unique q-points within the 1st BZ
+        use_c : boolean, optional
+            Whether to use C instead of Python to calculate and
+            diagonalise the dynamical matrix
+        n_threads : int, optional
+            The number of OpenMP threads to use when looping over
+            q-points in C. Only applicable if use_c=True
+        fall_back_on_python : boolean, optional
+            If we cannot use the C extension, fall back on using python
+            if this is true, else raise an ImportCError.
+        n_procs : int, optional
+            The number of processes to use when looping over q-points
+            in Python. See ForceConstants.calculate_qpoint_phonon_modes
+        cache_dir : str, optional
+            Directory to cache the q-independent parts of the
+            calculation in. See
+            ForceConstants.calculate_qpoint_phonon_modes
+        cache_max_size : int, optional
+            The maximum total size in bytes of the files in cache_dir
+        use_symmetry : boolean, optional
+            Whether to use the rotational symmetry of the crystal to
+            reduce the q-points in each chunk. See
+            ForceConstants.calculate_qpoint_phonon_modes
+        dtype : {numpy.float64, numpy.float32}, optional
+            The precision used to diagonalise the dynamical matrix and
+            store the eigenvectors. See
+            ForceConstants.calculate_qpoint_phonon_modes
+
+        Yields
+        ------
+        QpointPhononModes
+            A QpointPhononModes object containing the interpolated
+            frequencies and eigenvectors for each chunk of q-points.
+            The weights are normalised over all q-points rather than
+            each chunk, so the weights of all chunks sum to 1
+
+        Raises
+        ------
+        ImportCError
+            If we have selected not to fall back on Python and cannot
+            use the C extension
+        ValueError
+            If dtype isn't numpy.float32 or numpy.float64
+        """
+        _get_complex_dtype(dtype)
+        if self.born is None:
+            dipole = False
+        if not dipole:
+            splitting = False
+
+        if splitting and insert_gamma:
+            qpts = self._insert_split_gamma(qpts)
+
+        if dipole and eta_scale == 'auto':
+            eta_scale = self._get_auto_eta_scale(
+                use_c, n_threads, cache_dir, cache_max_size)
+        setup = self._calculate_phonons_setup(asr, dipole, eta_scale,
+                                              cache_dir, cache_max_size)
+        n_qpts = len(qpts)
+        for qi, qf, freqs, eigenvectors in self._iter_phonons_at_qpts(
+                qpts, chunk_size, setup, splitting, reduce_qpts, use_c,
+                n_threads, fall_back_on_python, n_procs,
+                use_symmetry=use_symmetry, dtype=dtype):
+            yield QpointPhononModes(
+                self.crystal, qpts[qi:qf], freqs, eigenvectors,
+                weights=np.full(qf - qi, 1.0/n_qpts))
+
+    def calculate_adaptive_qpoint_phonon_modes(
+            self, qpts, freq_tol=0.1*ureg('meV'), n_initial=4, max_depth=8,
+            **kwargs):
+        """
+        Calculate phonon frequencies and eigenvectors along a path
+        through reciprocal space, with q-points placed adaptively so
+        that more q-points are used where the frequencies vary
+        non-linearly. Each straight segment between consecutive q-points
+        in qpts is initially split into n_initial intervals, then each
+        interval is recursively bisected while the frequencies at its
+        midpoint differ from the linear interpolation between its ends
+        by more than freq_tol. All new midpoints at each level of
+        bisection are calculated with a single call to
+        calculate_qpoint_phonon_modes. If there is LO-TO splitting, any
+        gamma point in qpts between two segments is calculated twice,
+        with the splitting in the direction of each segment. If there
+        are Born charges but splitting=False, the frequencies are
+        discontinuous at gamma so intervals ending at a gamma point
+        in qpts aren't bisected
+
+        Parameters
+        ----------
+        qpts : (n_vertices, 3) float ndarray
+            The q-points at the start and end of each straight segment
+            of the path (e.g. high symmetry points), in order
+        freq_tol : float Quantity, optional
+            The maximum allowed difference between the frequencies at
+            the midpoint of an interval and the linear interpolation
+            between its ends
+        n_initial : int, optional
+            The number of intervals each segment is initially split
+            into
+        max_depth : int, optional
+            The maximum number of times an interval can be bisected
+        **kwargs
+            Get passed to calculate_qpoint_phonon_modes. insert_gamma,
+            out and chunk_size are not supported
+
+        Returns
+        -------
+        QpointPhononModes
+            A QpointPhononModes object containing the frequencies and
+            eigenvectors at the non-uniformly spaced q-points along
+            the path, in order
+
+        Raises
+        ------
+        ValueError
+            If insert_gamma=True, out or chunk_size is given
+        """
+        if kwargs.get('insert_gamma', False):
+            raise ValueError(
+                'insert_gamma=True is not supported when calculating with '
+                'adaptive q-points')
+        for kwarg in ['out', 'chunk_size']:
+            if kwargs.get(kwarg) is not None:
+                raise ValueError(
+                    f'{kwarg} is not supported when calculating with '
+                    f'adaptive q-points, as the number of q-points isn\'t '
+                    f'known in advance')
+        tol = freq_tol.to('INTERNAL_ENERGY_UNIT').magnitude
+        n_segments = len(qpts) - 1
+        # Matches the defaults in calculate_qpoint_phonon_modes
+        dipole = kwargs.get('dipole', True) and self.born is not None
+        splitting = dipole and kwargs.get('splitting', True)
+        gamma_vertex = np.where(is_gamma(qpts))[0]
+        # Each q-point is identified by its position along the path,
+        # which is its segment index plus its fractional position
+        # along that segment. If there is LO-TO splitting, gamma points
+        # between segments are included twice, so each is adjacent to
+        # a different segment and gets the splitting in its direction
+        vertex_pos = np.arange(n_segments + 1, dtype=np.float64)
+        if splitting:
+            vertex_pos = np.concatenate((vertex_pos, gamma_vertex[
+                np.logical_and(gamma_vertex > 0,
+                               gamma_vertex < n_segments)]))
+        pos = np.concatenate((
+            vertex_pos,
+            (np.arange(n_segments)[:, np.newaxis]
+             + np.arange(1, n_initial)/n_initial).flatten()))
+        pos = np.sort(pos)
+        path_qpts = self._qpts_along_path(qpts, pos)
+        phonons = self.calculate_qpoint_phonon_modes(path_qpts, **kwargs)
+        freqs = [phonons._frequencies]
+        eigenvecs = [phonons.eigenvectors]
+        all_pos = [pos]
+
+        # Intervals are described by the indices (in the concatenated
+        # arrays) of the q-points at each end, only bisect those with
+        # non-zero length
+        start = np.arange(len(pos) - 1)
+        end = start + 1
+        bisect = np.linalg.norm(
+            path_qpts[end] - path_qpts[start], axis=1) > 0
+        if dipole and not splitting:
+            # The frequencies at gamma aren't the limit approaching
+            # gamma, so bisecting towards it would never converge
+            at_gamma = np.isin(pos, gamma_vertex)
+            bisect &= ~(at_gamma[start] | at_gamma[end])
+        start, end = start[bisect], end[bisect]
+        n_calculated = len(pos)
+        for _ in range(max_depth):
+            if len(start) == 0:
+                break
+            concat_pos = np.concatenate(all_pos)
+            concat_freqs = np.concatenate(freqs)
+            mid_pos = 0.5*(concat_pos[start] + concat_pos[end])
+            mid_phonons = self.calculate_qpoint_phonon_modes(
+                self._qpts_along_path(qpts, mid_pos), **kwargs)
+            mid_freqs = mid_phonons._frequencies
+            freqs.append(mid_freqs)
+            eigenvecs.append(mid_phonons.eigenvectors)
+            all_pos.append(mid_pos)
+
+            deviation = np.amax(np.abs(
+                mid_freqs - 0.5*(concat_freqs[start] + concat_freqs[end])),
+                axis=1)
+            refine = deviation > tol
+            mid_i = n_calculated + np.arange(len(mid_pos))
+            n_calculated += len(mid_pos)
+            start, end = (
+                np.concatenate((start[refine], mid_i[refine])),
+                np.concatenate((mid_i[refine], end[refine])))
+
+        pos = np.concatenate(all_pos)
+        order = np.argsort(pos, kind='stable')
+        return QpointPhononModes(
+            self.crystal, self._qpts_along_path(qpts, pos[order]),
+            np.concatenate(freqs)[order]*ureg('INTERNAL_ENERGY_UNIT').to(
+                'mDEFAULT_ENERGY_UNIT'),
+            np.concatenate(eigenvecs)[order])
+
+    @staticmethod
+    def _qpts_along_path(qpts, pos):
+        """
+        Get the q-points at positions pos along a path of straight
+        segments between consecutive q-points in qpts. The integer
+        part of pos is the segment index and the remainder is the
+        fractional position along that segment
+        """
+        seg_i = np.minimum(np.floor(pos).astype(np.int32), len(qpts) - 2)
+        frac = (pos - seg_i)[:, np.newaxis]
+        return (1 - frac)*qpts[seg_i] + frac*qpts[seg_i + 1]
+
+    def _insert_split_gamma(self, qpts):
+        """
+        Duplicate any gamma points that aren't at the start or end of
+        qpts, so each can store the frequencies split in a different
+        direction
+        """
+        gamma_i = np.where(is_gamma(qpts))[0]
+        split_gamma = gamma_i[np.where(
+            np.logical_and(gamma_i > 0, gamma_i < len(qpts) - 1))]
+        return np.insert(qpts, split_gamma, np.array([0., 0., 0.]), axis=0)
+
+    def _calculate_phonons_setup(self, asr, dipole, eta_scale,
+                                 cache_dir=None, cache_max_size=2**30):
+        """
+        Calculate the q-independent values required to calculate and
+        diagonalise the dynamical matrix at any q-point
+
+        Parameters
+        ----------
+        asr : {'realspace', 'reciprocal'} or None
+            Which acoustic sum rule correction to apply
+        dipole : boolean
+            Whether to calculate the dipole tail correction
+        eta_scale : float
+            Changes the cutoff in real/reciprocal space for the dipole
+            Ewald sum
+        cache_dir : str, optional
+            If provided, read/write the supercell images, dipole
+            Ewald sum tables and realspace acoustic sum rule corrected
+            force constants from/to this directory
+        cache_max_size : int, optional
+            The maximum total size in bytes of the files in cache_dir
+
+        Returns
+        -------
+        setup : dict
+            The q-independent values. 'asr' and 'dipole' may differ
+            from the input if the correction can't be applied
+
+        Notes
+        -----
+        The setup is stored per object for each (asr, dipole, eta_scale)
+        combination, so repeated calls only cost the q-dependent work
+        """
+        # eta_scale only affects the setup if dipole is True
+        setup_key = (asr, dipole, eta_scale if dipole else None)
+        if setup_key in self._setup_cache:
+            setup = self._setup_cache[setup_key]
+            # The Ewald sum attributes may have been overwritten by a
+            # setup with a different eta_scale since, so restore them
+            for attr, val in setup['dipole_attrs'].items():
+                setattr(self, attr, val)
+            return setup
+
+        lim = 2  # Supercell image limit
+        cache_key = None
+        if cache_dir is not None:
+            cache_key = self._cache_key(lim)
+        # Construct list of supercell ion images
+        if not hasattr(self, '_sc_image_i'):
+            if not self._load_attrs_from_cache(
+                    cache_dir, f'{cache_key}_sc_images'):
+                self._calculate_supercell_images(lim)
+                self._save_attrs_to_cache(
+                    cache_dir, f'{cache_key}_sc_images',
+                    ['_sc_image_i', '_sc_image_offsets', '_n_sc_images'],
+                    cache_max_size)
+
+        # Get a list of all the unique supercell image origins and cell
+        # origins in x, y, z and how to rebuild them to minimise
+        # expensive phase calculations later
+        sc_image_r = get_all_origins(
+            np.repeat(lim, 3) + 1, min_xyz=-np.repeat(lim, 3))
+        sc_offsets = np.einsum('ji,kj->ki', self.sc_matrix,
+                               sc_image_r).astype(np.int32)
+        unique_sc_offsets = [[] for i in range(3)]
+        unique_sc_i = np.zeros((len(sc_offsets), 3), dtype=np.int32)
+        unique_cell_origins = [[] for i in range(3)]
+        unique_cell_i = np.zeros((len(self.cell_origins), 3), dtype=np.int32)
+        for i in range(3):
+            unique_sc_offsets[i], unique_sc_i[:, i] = np.unique(
+                sc_offsets[:, i], return_inverse=True)
+            unique_cell_origins[i], unique_cell_i[:, i] = np.unique(
+                self.cell_origins[:, i], return_inverse=True)
+
+        # Precompute dynamical matrix mass weighting
+        atom_mass = self.crystal._atom_mass
+        n_atoms = self.crystal.n_atoms
+        masses = np.tile(np.repeat(atom_mass, 3), (3*n_atoms, 1))
+        dyn_mat_weighting = 1/np.sqrt(masses*np.transpose(masses))
+
+        # Initialise dipole correction calc to FC matrix if required
+        dipole_attrs = ['_eta_scale', '_eta', '_H_ab', '_cells',
+                        '_gvecs_cart', '_gvec_phases', '_dipole_q0']
+        if dipole and (not hasattr(self, '_eta_scale') or
+                       eta_scale != self._eta_scale):
+            dipole_key = f'{cache_key}_dipole_{float(eta_scale)!r}'
+            if not self._load_attrs_from_cache(cache_dir, dipole_key):
+                self._dipole_correction_init(eta_scale)
+                self._save_attrs_to_cache(cache_dir, dipole_key,
+                                          dipole_attrs, cache_max_size)
+
+        if asr == 'realspace':
+            if not hasattr(self, '_force_constants_asr'):
+                asr_key = f'{cache_key}_asr_realspace'
+                if not self._load_attrs_from_cache(cache_dir, asr_key):
+                    self._force_constants_asr = self._enforce_realspace_asr()
+                    self._save_attrs_to_cache(
+                        cache_dir, asr_key, ['_force_constants_asr'],
+                        cache_max_size)
+            force_constants = self._force_constants_asr
+        else:
+            force_constants = self._force_constants
+        # Precompute fc matrix weighted by number of supercell atom
+        # images (for cumulant method)
+        n_sc_images_repeat = (
+            self._n_sc_images.repeat(3, axis=2).repeat(3, axis=1)
+        )
+        fc_img_weighted = np.divide(
+            force_constants, n_sc_images_repeat, where=n_sc_images_repeat != 0)
+
+        recip_asr_correction = np.array([], dtype=np.complex128)
+        if asr == 'reciprocal':
+            # Calculate dyn mat at gamma for reciprocal ASR
+            q_gamma = np.array([0., 0., 0.])
+            dyn_mat_gamma = self._calculate_dyn_mats(
+                q_gamma[np.newaxis], fc_img_weighted, unique_sc_offsets,
+                unique_sc_i, unique_cell_origins, unique_cell_i)[0]
+            if dipole:
+                dyn_mat_gamma += self._calculate_dipole_correction(q_gamma)
+            recip_asr_correction = self._enforce_reciprocal_asr(dyn_mat_gamma)
+            if len(recip_asr_correction) == 0:
+                # Finding acoustic modes failed
+                asr = None
+
+        setup = {'asr': asr, 'dipole': dipole,
+                 'fc_img_weighted': fc_img_weighted,
+                 'sc_offsets': sc_offsets,
+                 'unique_sc_offsets': unique_sc_offsets,
+                 'unique_sc_i': unique_sc_i,
+                 'unique_cell_origins': unique_cell_origins,
+                 'unique_cell_i': unique_cell_i,
+                 'recip_asr_correction': recip_asr_correction,
+                 'dyn_mat_weighting': dyn_mat_weighting,
+                 'dipole_attrs': {}}
+        if dipole:
+            setup['dipole_attrs'] = {attr: getattr(self, attr)
+                                     for attr in dipole_attrs}
+        self._setup_cache[setup_key] = setup
+        return setup
+
+    def _cache_key(self, lim):
+        """
+        Get a key identifying the data used in the q-independent parts
+        of the phonon calculation, for use with cache_dir
+
+        Parameters
+        ----------
+        lim : int
+            The supercell image limit
+
+        Returns
+        -------
+        key : str
+            A SHA-256 hex digest of the crystal, force constants,
+            supercell matrix, cell origins, Born charges and dielectric
+            tensor
+        """
+        crystal = self.crystal
+        return _hash_arrays(
+            np.array([_SETUP_CACHE_VERSION, lim]), crystal._cell_vectors,
+            crystal.atom_r, crystal.atom_type, crystal._atom_mass,
+            self._force_constants, self.sc_matrix, self.cell_origins,
+            self._born, self._dielectric)
+
+    def _load_attrs_from_cache(self, cache_dir, key):
+        """
+        Set attributes from an entry written by _save_attrs_to_cache
+
+        Returns
+        -------
+        loaded : bool
+            False if cache_dir is None or there is no entry for key
+        """
+        if cache_dir is None:
+            return False
+        attrs = _load_cache_npz(cache_dir, key)
+        if attrs is None:
+            return False
+        for name, val in attrs.items():
+            # Scalars (e.g. _eta) are stored as 0-d arrays
+            setattr(self, name, val[()] if val.ndim == 0 else val)
+        return True
+
+    def _save_attrs_to_cache(self, cache_dir, key, attrs, cache_max_size):
+        """
+        Write the listed attributes to cache_dir under key. Does
+        nothing if cache_dir is None, and only warns if writing fails,
+        as the cache isn't required for the calculation
+        """
+        if cache_dir is None:
+            return
+        try:
+            _save_cache_npz(cache_dir, key,
+                            {attr: getattr(self, attr) for attr in attrs},
+                            cache_max_size)
+        except OSError as e:
+            warnings.warn(f'Could not write to cache_dir {cache_dir}: {e}',
+                          stacklevel=4)
+
+    def _get_auto_eta_scale(self, use_c, n_threads, cache_dir=None,
+                            cache_max_size=2**30, n_repeats=2):
+        """
+        Choose the eta_scale with the lowest dipole calculation cost
+        per q-point, by timing the calculation of the phonon
+        frequencies at a few q-points for each value in
+        _AUTO_ETA_SCALES, on the backend that would actually be used.
+        The result is stored on the object for each backend and
+        written to cache_dir if provided, so the calibration is only
+        run once per material
+
+        Parameters
+        ----------
+        use_c : boolean
+            Whether the C extension will be used. If it can't be
+            imported the Python implementation is timed instead
+        n_threads : int
+            The number of OpenMP threads used by the C extension
+        cache_dir : str, optional
+            If provided, read/write the chosen eta_scale from/to this
+            directory
+        cache_max_size : int, optional
+            The maximum total size in bytes of the files in cache_dir
+        n_repeats : int, optional
+            The number of times to repeat the timing for each
+            eta_scale, the fastest is used
+
+        Returns
+        -------
+        eta_scale : float
+            The chosen eta_scale
+        """
+        if use_c:
+            try:
+                import euphonic._euphonic  # noqa: F401
+            except ImportError:
+                use_c = False
+        backend = f'c{n_threads}' if use_c else 'python'
+        if backend in self._auto_eta_scale:
+            return self._auto_eta_scale[backend]
+        cache_key = None
+        if cache_dir is not None:
+            # Use the same data hash as _calculate_phonons_setup
+            cache_key = f'{self._cache_key(2)}_auto_eta_scale_{backend}'
+            cached = _load_cache_npz(cache_dir, cache_key)
+            if cached is not None:
+                eta_scale = float(cached['eta_scale'])
+                self._auto_eta_scale[backend] = eta_scale
+                return eta_scale
+
+        # Enough q-points to give each thread some work. Use fixed
+        # q-points so the calibration is reproducible
+        qpts = np.random.RandomState(0).rand(max(8, 4*n_threads), 3)
+        setup_keys = set(self._setup_cache.keys())
+        times = np.zeros(len(_AUTO_ETA_SCALES))
+        dipole_attrs = []
+        for i, eta_scale in enumerate(_AUTO_ETA_SCALES):
+            setup = self._calculate_phonons_setup(None, True, eta_scale)
+            dipole_attrs.append(setup['dipole_attrs'])
+            times[i] = np.inf
+            for n in range(n_repeats):
+                start = time.perf_counter()
+                self._calculate_phonons_at_qpts(
+                    qpts, setup, False, False, use_c, n_threads, True,
+                    return_eigenvectors=False)
+                times[i] = min(times[i], time.perf_counter() - start)
+        opt = np.argmin(times)
+        eta_scale = _AUTO_ETA_SCALES[opt]
+
+        # Don't keep the calibration setups, but restore the Ewald sum
+        # values for the chosen eta_scale so they aren't recalculated
+        for key in set(self._setup_cache.keys()) - setup_keys:
+            del self._setup_cache[key]
+        for attr, val in dipole_attrs[opt].items():
+            setattr(self, attr, val)
+
+        self._auto_eta_scale[backend] = eta_scale
+        if cache_dir is not None:
+            try:
+                _save_cache_npz(cache_dir, cache_key,
+                                {'eta_scale': np.array(eta_scale)},
+                                cache_max_size)
+            except OSError as e:
+                warnings.warn(
+                    f'Could not write to cache_dir {cache_dir}: {e}',
+                    stacklevel=3)
+        return eta_scale
+
+    def _calculate_phonons_at_qpts(self, qpts, setup, splitting, reduce_qpts,
+                                   use_c, n_threads, fall_back_on_python,
+                                   n_procs=1, return_eigenvectors=True,
+                                   use_symmetry=False, eigenvectors_out=None,
+                                   dtype=np.float64):
+        """
+        Calculate phonon frequencies and eigenvectors at the specified
+        q-points, using the q-independent values from
+        _calculate_phonons_setup. Any gamma points for LO-TO splitting
+        should already have been inserted into qpts. If
+        return_eigenvectors is False, only the eigenvalues of the
+        dynamical matrix are calculated. If use_symmetry is True, only
+        one of each set of symmetry equivalent q-points is calculated,
+        see _reduce_qpts_symmetry. If eigenvectors_out is given, the
+        eigenvectors are written into it. If the reduced q-points are
+        the same as qpts (e.g. reduce_qpts=False), the C or Python
+        implementation writes directly into the output arrays and
+        there is no copy from the reduced q-point arrays. If dtype is
+        numpy.float32, the dynamical matrices are diagonalised in
+        single precision and the eigenvectors are complex64
+
+        Returns
+        -------
+        freqs : (n_qpts, 3*n_atoms) float Quantity
+            The phonon frequencies
+        eigenvectors : (n_qpts, 3*n_atoms, n_atoms, 3) complex ndarray or None
+            The phonon eigenvectors. None if return_eigenvectors is
+            False
+        """
+        asr = setup['asr']
+        dipole = setup['dipole']
+        fc_img_weighted = setup['fc_img_weighted']
+        sc_offsets = setup['sc_offsets']
+        recip_asr_correction = setup['recip_asr_correction']
+        dyn_mat_weighting = setup['dyn_mat_weighting']
+        n_atoms = self.crystal.n_atoms
+        complex_dtype = _get_complex_dtype(dtype)
+
+        if reduce_qpts:
+            norm_qpts = qpts - np.rint(qpts)
+            # Ensure gamma points are exactly zero, otherwise you may
+            # have a case where small fp differences mean np.unique
+            # doesn't reduce them, yet they're all classified as gamma
+            # points. This causes indexing errors later when calculating
+            # q-directions as there are then points in reduced_qpts
+            # whose index isn't in qpts_i
+            gamma_i = np.where(is_gamma(qpts))[0]
+            n_gamma = len(gamma_i)
+            norm_qpts[gamma_i] = 0.
+            # Time reversal symmetry: D(-q) = D(q)*, so only calculate
+            # one of each q, -q pair. Use the q-point whose first
+            # non-zero component is positive, and conjugate the
+            # eigenvectors of the others. This doesn't hold if the
+            # q-independent reciprocal ASR correction is complex
+            if np.all(np.imag(recip_asr_correction) == 0):
+                first_nonzero = np.argmax(norm_qpts != 0, axis=1)
+                time_reversed = norm_qpts[
+                    np.arange(len(norm_qpts)), first_nonzero] < 0
+                norm_qpts[time_reversed] *= -1
+            else:
+                time_reversed = np.zeros(len(qpts), dtype=bool)
+
+            reduced_qpts, qpts_i = np.unique(norm_qpts, return_inverse=True,
+                                             axis=0)
+            n_rqpts = len(reduced_qpts)
+            # Special handling of gamma points - don't reduce gamma
+            # points if LO-TO splitting
+            if splitting and n_gamma > 1:
+                # Replace any gamma points and their indices with new
+                # gamma points appended onto the reduced q-point array,
+                # so each gamma can have its own splitting
+                qpts_i[gamma_i[1:]] = range(n_rqpts, n_rqpts + n_gamma - 1)
+                reduced_qpts = np.append(reduced_qpts,
+                                         np.tile(np.array([0., 0., 0., ]),
+                                                 (n_gamma - 1, 1)),
+                                         axis=0)
+                n_rqpts = len(reduced_qpts)
+        else:
+            reduced_qpts = qpts
+            qpts_i = np.arange(0, len(qpts), dtype=np.int32)
+            n_rqpts = len(qpts)
+
+        if use_symmetry:
+            keep = np.zeros(n_rqpts, dtype=bool)
+            if splitting:
+                # The LO-TO splitting direction is taken from the
+                # q-points adjacent to each gamma point, so these must
+                # be calculated as given rather than rotated
+                gamma_i = np.where(is_gamma(qpts))[0]
+                adjacent_i = np.concatenate(
+                    (gamma_i - 1, gamma_i, gamma_i + 1))
+                adjacent_i = adjacent_i[np.logical_and(
+                    adjacent_i >= 0, adjacent_i < len(qpts))]
+                keep[qpts_i[adjacent_i]] = True
+            reduced_qpts, ir_i, sym_i, symmetry = (
+                self._reduce_qpts_symmetry(
+                    reduced_qpts, keep,
+                    same_cell_only=(asr == 'reciprocal')))
+            sym_i = sym_i[qpts_i]
+            qpts_i = ir_i[qpts_i].astype(np.int32)
+            n_rqpts = len(reduced_qpts)
+
+        # If each q-point maps to the reduced q-point with the same
+        # index, the reduced arrays can be returned without expansion
+        identity_qpts_i = np.array_equal(qpts_i, np.arange(len(qpts)))
+        if return_eigenvectors and identity_qpts_i:
+            reigenvecs_out = eigenvectors_out
+        else:
+            reigenvecs_out = None
+
+        def allocate_outputs():
+            rfreqs = np.zeros((n_rqpts, 3*n_atoms))
+            if reigenvecs_out is not None:
+                reigenvecs = reigenvecs_out
+            else:
+                # If return_eigenvectors is False only a dummy array is
+                # needed, the dynamical matrices are stored per-thread
+                # in C
+                reigenvecs = np.zeros(
+                    (n_rqpts if return_eigenvectors else 0, 3*n_atoms,
+                     n_atoms, 3), dtype=complex_dtype)
+            return rfreqs, reigenvecs
+
+        try:
+            if use_c:
+                try:
+                    import euphonic._euphonic as euphonic_c
+                    from euphonic.util import (_ensure_contiguous_args,
+                                               _ensure_contiguous_attrs)
+                except ImportError:
+                    warnings.warn((
+                        'use_c=True is set, but the Euphonic\'s C '
+                        'extension couldn\'t be imported, it may not '
+                        'have been installed. Attempting to fall back '
+                        'to pure Python calculation'), stacklevel=3)
+                    raise
+            else:
+                raise ImportError
+            rfreqs, reigenvecs = allocate_outputs()
+            # Make sure all arrays are contiguous before calling C
+            cell_vectors = self.crystal._cell_vectors
+            recip_vectors = self.crystal.reciprocal_cell().to(
+                '1/bohr').magnitude
+            (cell_vectors, recip_vectors, reduced_qpts, qpts_i, fc_img_weighted,
+                sc_offsets, recip_asr_correction, dyn_mat_weighting, rfreqs,
+                reigenvecs) = _ensure_contiguous_args(
+                    cell_vectors, recip_vectors, reduced_qpts, qpts_i,
+                    fc_img_weighted, sc_offsets, recip_asr_correction,
+                    dyn_mat_weighting, rfreqs, reigenvecs)
+            attrs = ['_sc_image_offsets', '_sc_image_i', 'cell_origins']
+            dipole_attrs = ['atom_r', '_born', '_dielectric', '_H_ab',
+                            '_cells', '_gvec_phases', '_gvecs_cart',
+                            '_dipole_q0']
+            _ensure_contiguous_attrs(self, attrs, opt_attrs=dipole_attrs)
+            reciprocal_asr = 1 if asr == 'reciprocal' else 0
+            single = 1 if complex_dtype == np.complex64 else 0
+            euphonic_c.calculate_phonons(
+                self, cell_vectors, recip_vectors, reduced_qpts, qpts_i,
+                fc_img_weighted, sc_offsets, recip_asr_correction,
+                dyn_mat_weighting, dipole, reciprocal_asr, splitting, rfreqs,
+                reigenvecs, n_threads, return_eigenvectors, single)
+        except ImportError:
+            if not fall_back_on_python:
+                raise ImportCError((
+                    'use_c=True is set, but the Euphonic\'s C extension'
+                    ' couldn\'t be imported, it may not have been '
+                    'installed. You have selected not to fall back on '
+                    'Python, therefore we cannot complete the '
+                    'calculation.'))
+            else:
+                q_independent_args = (
+                    reduced_qpts, qpts_i, fc_img_weighted,
+                    setup['unique_sc_offsets'], setup['unique_sc_i'],
+                    setup['unique_cell_origins'], setup['unique_cell_i'],
+                    recip_asr_correction, dyn_mat_weighting, dipole, asr,
+                    splitting)
+                if n_procs > 1 and shared_memory is None:
+                    warnings.warn((
+                        f'n_procs={n_procs} is set, but '
+                        'multiprocessing.shared_memory is not available '
+                        '(requires Python >= 3.8). Falling back to a '
+                        'single process'), stacklevel=3)
+                    n_procs = 1
+                if n_procs > 1:
+                    # The processes allocate their own output arrays
+                    rfreqs, reigenvecs = (
+                        self._calculate_phonons_at_qpts_parallel(
+                            setup, reduced_qpts, qpts_i, splitting, n_procs,
+                            return_eigenvectors=return_eigenvectors,
+                            eigenvectors_out=reigenvecs_out, dtype=dtype))
+                else:
+                    rfreqs, reigenvecs = allocate_outputs()
+                    block_size = self._get_qpt_block_size(dipole)
+                    for qi in range(0, n_rqpts, block_size):
+                        q_block = np.arange(qi, min(qi + block_size, n_rqpts))
+                        if return_eigenvectors:
+                            rfreqs[q_block], reigenvecs[q_block] = (
+                                self._calculate_phonons_at_q_block(
+                                    q_block, q_independent_args,
+                                    dtype=dtype))
+                        else:
+                            rfreqs[q_block], _ = (
+                                self._calculate_phonons_at_q_block(
+                                    q_block, q_independent_args,
+                                    return_eigenvectors=False,
+                                    dtype=dtype))
+
+        if not identity_qpts_i:
+            rfreqs = rfreqs[qpts_i]
+        freqs = rfreqs*ureg('INTERNAL_ENERGY_UNIT').to(
+            'mDEFAULT_ENERGY_UNIT')
+        if return_eigenvectors:
+            if identity_qpts_i:
+                eigenvectors = reigenvecs
+            elif eigenvectors_out is not None:
+                eigenvectors = np.take(reigenvecs, qpts_i, axis=0,
+                                       out=eigenvectors_out)
+            else:
+                eigenvectors = reigenvecs[qpts_i]
+            if use_symmetry:
+                eigenvectors = self._rotate_eigenvectors(
+                    eigenvectors, reduced_qpts[qpts_i], sym_i, symmetry)
+            if reduce_qpts:
+                eigenvectors[time_reversed] = np.conj(
+                    eigenvectors[time_reversed])
+            return freqs, eigenvectors
+        return freqs, None
+
+    def _iter_phonons_at_qpts(self, qpts, chunk_size, setup, splitting,
+                              *args, **kwargs):
+        """
+        Calculate phonon frequencies and eigenvectors at qpts in
+        chunks of chunk_size q-points with _calculate_phonons_at_qpts,
+        which is passed any other args and kwargs
+
+        Yields
+        ------
+        qi : int
+            The index of the first q-point in the chunk
+        qf : int
+            The index after the last q-point in the chunk
+        freqs : (qf - qi, 3*n_atoms) float Quantity
+            The phonon frequencies for the chunk
+        eigenvectors : (qf - qi, 3*n_atoms, n_atoms, 3) complex ndarray
+            The phonon eigenvectors for the chunk
+        """
+        n_qpts = len(qpts)
+        for qi in range(0, n_qpts, chunk_size):
+            qf = min(qi + chunk_size, n_qpts)
+            # If there is LO-TO splitting, also calculate the q-points
+            # either side of the chunk so the direction of approach to
+            # any gamma points at the chunk edges is still known
+            if splitting:
+                ci = max(qi - 1, 0)
+                cf = min(qf + 1, n_qpts)
+            else:
+                ci = qi
+                cf = qf
+            freqs, eigenvectors = self._calculate_phonons_at_qpts(
+                qpts[ci:cf], setup, splitting, *args, **kwargs)
+            yield (qi, qf, freqs[qi - ci:qf - ci],
+                   eigenvectors[qi - ci:qf - ci])
+
+    def _reduce_qpts_symmetry(self, qpts, keep, same_cell_only=False,
+                              symprec=1e-5):
+        """
+        Map each q-point to a representative q-point that is equivalent
+        by a rotation of the crystal's space group. For each q-point the
+        images under all rotations are found, and the representative is
+        the image that is lexicographically smallest when folded into
+        [0, 1), so all q-points in the same star have the same
+        representative
+
+        Parameters
+        ----------
+        qpts : (n_qpts, 3) float ndarray
+            The q-points to reduce
+        keep : (n_qpts,) bool ndarray
+            The q-points that should be calculated as given, rather
+            than mapped to a representative
+        same_cell_only : boolean, optional
+            Only use the symmetry operations that map every atom with
+            the same lattice translation. This is required if a
+            q-independent correction (i.e. the reciprocal acoustic sum
+            rule correction) is added to the dynamical matrix, as it
+            is only invariant under these operations
+        symprec : float, optional
+            The spglib symmetry tolerance in Angstrom
+
+        Returns
+        -------
+        ir_qpts : (n_ir_qpts, 3) float ndarray
+            The representative q-points
+        ir_i : (n_qpts,) int ndarray
+            The index in ir_qpts of the representative of each q-point
+        sym_i : (n_qpts,) int ndarray
+            The index of the symmetry operation in symmetry that maps
+            the representative to each q-point
+        symmetry : tuple
+            The (rotations, translations, atom_perm) of each symmetry
+            operation with a unique rotation. atom_perm[i, j] is the
+            atom that atom j is mapped to by operation i. The first
+            operation is the identity
+        """
+        rotations, translations = self.crystal.get_symmetry_operations(
+            symprec=symprec)
+        identity = np.identity(3, dtype=rotations.dtype)
+        rotations = np.concatenate((identity[np.newaxis], rotations))
+        translations = np.concatenate((np.zeros((1, 3)), translations))
+
+        # Find which atom each atom is mapped to by each operation
+        atom_r = self.crystal.atom_r
+        cell_vectors = self.crystal._cell_vectors
+        atom_r_rot = (np.einsum('ijk,lk->ilj', rotations, atom_r)
+                      + translations[:, np.newaxis, :])
+        dr = atom_r_rot[:, :, np.newaxis, :] - atom_r
+        dr -= np.rint(dr)
+        atom_perm = np.argmin(
+            np.linalg.norm(np.einsum('ijkl,lm->ijkm', dr, cell_vectors),
+                           axis=-1), axis=-1)
+        if same_cell_only:
+            lattice_shift = np.rint(
+                atom_r_rot - atom_r[atom_perm]).astype(np.int32)
+            same_cell = np.all(lattice_shift == lattice_shift[:, :1],
+                               axis=(1, 2))
+            rotations = rotations[same_cell]
+            translations = translations[same_cell]
+            atom_perm = atom_perm[same_cell]
+
+        # Only the rotation is needed to map q-points, so only keep
+        # the first operation for each unique rotation, with the
+        # identity first. Only rotations whose inverse is also
+        # available can be used
+        _, unique_i = np.unique(np.reshape(rotations, (-1, 9)), axis=0,
+                                return_index=True)
+        unique_i = np.sort(unique_i)
+        rotations = rotations[unique_i]
+        translations = translations[unique_i]
+        atom_perm = atom_perm[unique_i]
+        inv_rotations = np.rint(np.linalg.inv(rotations)).astype(np.int32)
+        is_inv = np.all(rotations[np.newaxis] == inv_rotations[:, np.newaxis],
+                        axis=(2, 3))
+        has_inv = np.any(is_inv, axis=1)
+        rotations = rotations[has_inv]
+        translations = translations[has_inv]
+        atom_perm = atom_perm[has_inv]
+        inv_rotations = inv_rotations[has_inv]
+        # Index of the inverse of each rotation
+        inv_i = np.argmax(np.all(
+            rotations[np.newaxis] == inv_rotations[:, np.newaxis],
+            axis=(2, 3)), axis=1)
+
+        # Images of each q-point under each operation g are
+        # R_g^-T q, folded into [0, 1) and converted to an integer key
+        # with a 1e-6 tolerance
+        images = np.einsum('ikj,lk->lij', inv_rotations, qpts)
+        grid = 10**6
+        img_keys = np.mod(np.rint((images - np.floor(images))*grid),
+                          grid).astype(np.int64)
+        img_keys = (img_keys[..., 0]*grid + img_keys[..., 1])*grid \
+            + img_keys[..., 2]
+        op_i = np.argmin(img_keys, axis=1)
+        rep_keys = img_keys[np.arange(len(qpts)), op_i]
+        # Keep q-points are their own representative
+        op_i[keep] = 0
+        rep_keys[keep] = -1 - np.arange(np.sum(keep))
+
+        _, first_i, ir_i = np.unique(rep_keys, return_index=True,
+                                     return_inverse=True)
+        ir_qpts = images[first_i, op_i[first_i]]
+        # The representative is mapped back to each q-point by the
+        # inverse of the operation that mapped it to the representative
+        sym_i = inv_i[op_i]
+        return ir_qpts, ir_i, sym_i, (rotations, translations, atom_perm)
+
+    def _rotate_eigenvectors(self, eigenvecs, rep_qpts, sym_i, symmetry):
+        """
+        Rotate eigenvectors calculated at representative q-points to
+        the symmetry equivalent q-points
+
+        Parameters
+        ----------
+        eigenvecs : (n_qpts, 3*n_atoms, n_atoms, 3) complex ndarray
+            The eigenvectors at the representative of each q-point
+        rep_qpts : (n_qpts, 3) float ndarray
+            The representative of each q-point
+        sym_i : (n_qpts,) int ndarray
+            The index of the symmetry operation mapping each
+            representative to each q-point
+        symmetry : tuple
+            The (rotations, translations, atom_perm) from
+            _reduce_qpts_symmetry
+
+        Returns
+        -------
+        eigenvecs : (n_qpts, 3*n_atoms, n_atoms, 3) complex ndarray
+            The eigenvectors at each q-point
+        """
+        rotations, _, atom_perm = symmetry
+        atom_r = self.crystal.atom_r
+        cell_vectors = self.crystal._cell_vectors
+        for op in np.unique(sym_i):
+            if op == 0:
+                # Identity
+                continue
+            idx = np.where(sym_i == op)[0]
+            rot = rotations[op]
+            rot_cart = np.linalg.multi_dot(
+                (np.transpose(cell_vectors), rot,
+                 np.linalg.inv(np.transpose(cell_vectors))))
+            q_rep = rep_qpts[idx]
+            q_rot = np.einsum('ij,ki->kj', np.linalg.inv(rot), q_rep)
+            # Eigenvectors use the cell origin phase convention, so
+            # convert to the atom position convention (in which the
+            # dynamical matrix transforms by just the rotation and
+            # atom permutation), rotate, then convert back
+            evecs = eigenvecs[idx]*np.exp(
+                -2j*math.pi*np.einsum('ij,kj->ik', q_rep, atom_r)
+            )[:, np.newaxis, :, np.newaxis]
+            rot_evecs = np.empty_like(evecs)
+            rot_evecs[:, :, atom_perm[op]] = np.einsum(
+                'ij,klmj->klmi', rot_cart, evecs)
+            rot_evecs *= np.exp(
+                2j*math.pi*np.einsum('ij,kj->ik', q_rot, atom_r)
+            )[:, np.newaxis, :, np.newaxis]
+            eigenvecs[idx] = rot_evecs
+        return eigenvecs
+
+    def _calculate_phonons_at_qpts_parallel(self, setup, reduced_qpts, qpts_i,
+                                            splitting, n_procs,
+                                            return_eigenvectors=True,
+                                            eigenvectors_out=None,
+                                            dtype=np.float64):
+        """
+        Calculate phonon frequencies and eigenvectors at the reduced
+        q-points using a pool of n_procs processes. The pool, which has
+        the force constants, supercell image and Ewald arrays in shared
+        memory, is created once per setup and reused by later calls,
+        e.g. for each chunk of iter_qpoint_phonon_modes, until
+        ForceConstants.close is called. Each process
+        writes its results directly into output arrays in shared
+        memory, which are returned without copying
+
+        Parameters
+        ----------
+        setup : dict
+            The q-independent values from _calculate_phonons_setup
+        reduced_qpts : (n_rqpts, 3) float ndarray
+            The reduced q-points to calculate
+        qpts_i : (n_qpts,) int ndarray
+            The index of the reduced q-point for each q-point
+        splitting : bool
+            Whether to calculate the LO-TO splitting at gamma points
+        n_procs : int
+            The number of processes to use
+        return_eigenvectors : bool, optional
+            Whether to calculate the eigenvectors
+        eigenvectors_out : (n_rqpts, 3*n_atoms, n_atoms, 3) complex ndarray, optional
+            The array to write the eigenvectors into. If it is a
+            writeable numpy.memmap, the processes write into its file
+            directly, otherwise the eigenvectors are copied into it
+        dtype : {numpy.float64, numpy.float32}, optional
+            The precision used to diagonalise the dynamical matrices
+
+        Returns
+        -------
+        rfreqs : (n_rqpts, 3*n_atoms) float ndarray
+            The frequencies
+        reigenvecs : (n_rqpts, 3*n_atoms, n_atoms, 3) complex ndarray or None
+            The eigenvectors. None if return_eigenvectors is False
+        """
+        pool = setup.get('process_pool')
+        if pool is None or pool.n_procs != n_procs:
+            if pool is not None:
+                pool.close()
+            pool = _PhononsProcessPool(self, setup, n_procs)
+            setup['process_pool'] = pool
+        n_rqpts = len(reduced_qpts)
+        n_atoms = self.crystal.n_atoms
+
+        shms = []
+        call_info = {}
+        for name, arr in [('reduced_qpts', reduced_qpts),
+                          ('qpts_i', qpts_i)]:
+            shm, call_info[name] = _shared_copy(arr)
+            shms.append(shm)
+        outputs = {'rfreqs': ((n_rqpts, 3*n_atoms), np.float64)}
+        memmap_out = (isinstance(eigenvectors_out, np.memmap)
+                      and isinstance(eigenvectors_out.base, mmap.mmap)
+                      and eigenvectors_out.mode in ('r+', 'w+'))
+        if return_eigenvectors and memmap_out:
+            call_info['reigenvecs'] = (
+                eigenvectors_out.filename, eigenvectors_out.shape,
+                eigenvectors_out.dtype.str, eigenvectors_out.offset)
+        elif return_eigenvectors:
+            outputs['reigenvecs'] = ((n_rqpts, 3*n_atoms, n_atoms, 3),
+                                     _get_complex_dtype(dtype))
+        results = {}
+        for name, (shape, out_dtype) in outputs.items():
+            shm, results[name] = _shared_array(shape, out_dtype)
+            call_info[name] = (shm.name, shape, np.dtype(out_dtype).str)
+            shms.append(shm)
+
+        # Split q-points into several tasks per process to balance the
+        # load, but no larger than the Python block size
+        task_size = min(self._get_qpt_block_size(setup['dipole']),
+                        max(1, math.ceil(n_rqpts/(4*n_procs))))
+        futures = []
+        try:
+            futures = [
+                pool.executor.submit(
+                    _calculate_phonons_worker, call_info, qi,
+                    min(qi + task_size, n_rqpts), splitting,
+                    return_eigenvectors, dtype)
+                for qi in range(0, n_rqpts, task_size)]
+            for future in futures:
+                future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            # The output arrays stay mapped in this process until they
+            # are garbage collected
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+        rfreqs = results['rfreqs']
+        if not return_eigenvectors:
+            return rfreqs, None
+        if memmap_out:
+            return rfreqs, eigenvectors_out
+        reigenvecs = results['reigenvecs']
+        if eigenvectors_out is not None:
+            eigenvectors_out[:] = reigenvecs
+            reigenvecs = eigenvectors_out
+        return rfreqs, reigenvecs
+
+    def _get_qpt_block_size(self, dipole=False, max_block_bytes=2**27):
+        """
+        Get the number of q-points to calculate at once in the Python
+        implementation, so that the largest temporary arrays (the
+        supercell image phases, the dynamical matrices and if dipole is
+        True the Ewald sum reciprocal terms) use approximately
+        max_block_bytes of memory
+
+        Parameters
+        ----------
+        dipole : bool, optional
+            Whether the dipole correction will be calculated
+        max_block_bytes : int, optional
+            The approximate memory limit in bytes for each block
+
+        Returns
+        -------
+        block_size : int
+            The number of q-points per block
+        """
+        n_atoms = self.crystal.n_atoms
+        # Complex phases for each supercell image and their sums for
+        # each cell and ij pair, plus ~3 copies of the complex dynamical
+        # matrix (dyn_mat, eigenvectors and temporary arrays)
+        bytes_per_qpt = 16*(self._sc_image_i.size + self._n_sc_images.size
+                            + 3*(3*n_atoms)**2)
+        if dipole:
+            # Phase weighted reciprocal terms for each G-vector and ij
+            # pair, plus the real space term for each ij pair
+            bytes_per_qpt += 16*(2*len(self._gvecs_cart)*9*n_atoms
+                                 + 2*9*n_atoms**2)
+        return max(1, int(max_block_bytes//bytes_per_qpt))
+
+    def _calculate_phonons_at_q_block(self, q_block, args,
+                                      return_eigenvectors=True,
+                                      dtype=np.float64):
+        """
+        Given the indices of a block of reduced q-points and some
+        precalculated q-independent values, calculate and diagonalise
+        the dynamical matrices for the whole block at once and return
+        the frequencies and eigenvectors. Optionally also includes the
+        Ewald dipole sum correction and LO-TO splitting. If
+        return_eigenvectors is False, only the eigenvalues are
+        calculated and None is returned for the eigenvectors. If dtype
+        is numpy.float32 the dynamical matrices are converted to
+        complex64 before diagonalisation
+        """
+        (reduced_qpts, qpts_i, fc_img_weighted, unique_sc_offsets,
+         unique_sc_i, unique_cell_origins, unique_cell_i,
+         recip_asr_correction, dyn_mat_weighting, dipole, asr,
+         splitting) = args
+
+        qpts = reduced_qpts[q_block]
+        n_atoms = self.crystal.n_atoms
+
+        dyn_mats = self._calculate_dyn_mats(
+            qpts, fc_img_weighted, unique_sc_offsets, unique_sc_i,
+            unique_cell_origins, unique_cell_i)
+
+        if dipole:
+            dyn_mats += self._calculate_dipole_corrections(qpts)
+
+        if asr == 'reciprocal':
+            dyn_mats += recip_asr_correction
+
+        # Calculate LO-TO splitting by calculating non-analytic
+        # correction to dynamical matrix. Correction is zero if not a
+        # gamma point or splitting=False
+        if splitting:
+            for i in np.where(is_gamma(qpts))[0]:
+                q = q_block[i]
+                # If first q-point
+                if qpts_i[0] == q:
+                    q_dir = reduced_qpts[qpts_i[1]]
+                # If last q-point
+                elif qpts_i[-1] == q:
+                    q_dir = reduced_qpts[qpts_i[-2]]
+                else:
+                    # Find position in original qpts array (non reduced)
+                    qpos = np.where(qpts_i == q)[0][0]
+                    # If splitting=True there should be an adjacent
+                    # gamma point. Calculate splitting in whichever
+                    # direction isn't gamma
+                    q_dir = reduced_qpts[qpts_i[qpos + 1]]
+                    if is_gamma(q_dir):
+                        q_dir = -reduced_qpts[qpts_i[qpos - 1]]
+                dyn_mats[i] += self._calculate_gamma_correction(q_dir)
+
+        # Mass weight dynamical matrix
+        dyn_mats *= dyn_mat_weighting
+        if np.dtype(dtype) == np.float32:
+            dyn_mats = dyn_mats.astype(np.complex64)
+
+        if return_eigenvectors:
+            try:
+                evals, evecs = np.linalg.eigh(dyn_mats, UPLO='U')
+            except np.linalg.LinAlgError:
+                # Diagonalise each matrix separately so only the
+                # failed matrices fall back to zheev (eigh calls zheevd)
+                evals = np.zeros((len(qpts), 3*n_atoms))
+                evecs = np.zeros_like(dyn_mats)
+                for i, dyn_mat in enumerate(dyn_mats):
+                    try:
+                        evals[i], evecs[i] = np.linalg.eigh(
+                            dyn_mat, UPLO='U')
+                    except np.linalg.LinAlgError:
+                        evals[i], evecs[i], info = zheev(dyn_mat)
+            evecs = np.reshape(np.transpose(evecs, axes=(0, 2, 1)),
+                               (len(qpts), 3*n_atoms, n_atoms, 3))
+        else:
+            evecs = None
+            try:
+                evals = np.linalg.eigvalsh(dyn_mats, UPLO='U')
+            except np.linalg.LinAlgError:
+                evals = np.zeros((len(qpts), 3*n_atoms))
+                for i, dyn_mat in enumerate(dyn_mats):
+                    try:
+                        evals[i] = np.linalg.eigvalsh(dyn_mat, UPLO='U')
+                    except np.linalg.LinAlgError:
+                        evals[i], _, info = zheev(dyn_mat, compute_v=0)
+        # Set imaginary frequencies to negative
+        imag_freqs = np.where(evals < 0)
+        evals = np.sqrt(np.abs(evals))
+        evals[imag_freqs] *= -1
+
+        return evals, evecs
+
+    def _calculate_dyn_mats(self, qpts, fc_img_weighted, unique_sc_offsets,
+                            unique_sc_i, unique_cell_origins, unique_cell_i):
+        """
+        Calculate the non mass weighted dynamical matrices at the
+        specified q-points from the image weighted force constants
+        matrix and the indices specifying the periodic images. See eq.
+        1.5:
+        http://www.tcm.phy.cam.ac.uk/castep/Phonons_Guide/Castep_Phonons.html
+
+        Parameters
+        ----------
+        qpts : (n_qpts, 3) float ndarray
+            The q-points to calculate the dynamical matrices for
+        fc_img_weighted : (n_cells_in_sc, 3*n_atoms, 3*n_atoms) float ndarray
+            The force constants matrix weighted by the number of
+            supercell atom images for each ij displacement
+        unique_sc_offsets : list of lists of ints
+            A list containing 3 lists of the unique supercell image
+            offsets in each direction. The supercell offset is
+            calculated by multiplying the supercell matrix by the
+            supercell image indices (obtained by _get_all_origins()). A
+            list of lists rather than a Numpy array is used as the 3
+            lists are independent and their size is not known beforehand
+        unique_sc_i : ((2*lim + 1)**3, 3) int ndarray
+            The indices needed to reconstruct sc_offsets from the unique
+            values in unique_sc_offsets
+        unique_cell_origins : list of lists of ints
+            A list containing 3 lists of the unique cell origins in each
+            direction. A list of lists rather than a Numpy array is used
+            as the 3 lists are independent and their size is not known
+            beforehand
+        unique_sc_i : (cell_origins, 3) int ndarray
+            The indices needed to reconstruct cell_origins from the
+            unique values in unique_cell_origins
+
+        Returns
+        -------
+        dyn_mats : (n_qpts, 3*n_atoms, 3*n_atoms) complex ndarray
+            The non mass weighted dynamical matrix at each q
+        """
+
+        n_qpts = len(qpts)
+        n_cells, n_atoms = self._n_sc_images.shape[:2]
+
+        # Cumulant method: for each ij ion-ion displacement sum phases
+        # for all possible supercell images, then multiply by the cell
+        # phases to account for j ions in different cells. Then multiply
+        # by the image weighted fc matrix for each 3 x 3 ij displacement
+
+        sc_phases, cell_phases = self._calculate_phases(
+            qpts, unique_sc_offsets, unique_sc_i, unique_cell_origins,
+            unique_cell_i)
+        # The images for each cell and ij pair are stored contiguously
+        # in _sc_image_i, starting at _sc_image_offsets, so the phases
+        # can be summed with reduceat. reduceat doesn't give zero for
+        # empty segments, so only sum segments with at least 1 image
+        has_images = self._n_sc_images.ravel() > 0
+        sc_phase_sum = np.zeros((n_qpts, n_cells*n_atoms*n_atoms),
+                                dtype=np.complex128)
+        sc_phase_sum[:, has_images] = np.add.reduceat(
+            sc_phases[:, self._sc_image_i],
+            self._sc_image_offsets[:-1][has_images], axis=1)
+        ij_phases = np.transpose(
+            np.reshape(sc_phase_sum, (n_qpts, n_cells, n_atoms, n_atoms)),
+            axes=(2, 3, 0, 1))
+        ij_phases *= cell_phases
+        # Contract over cells for each ij pair with a batched matrix
+        # product: (n_atoms, n_atoms, n_qpts, n_cells) @
+        # (n_atoms, n_atoms, n_cells, 9). The force constants are real,
+        # so do the real and imaginary parts separately to avoid a
+        # complex copy of the force constants
+        fc_ij = np.transpose(
+            np.reshape(fc_img_weighted, (n_cells, n_atoms, 3, n_atoms, 3)),
+            axes=(1, 3, 0, 2, 4)).reshape(n_atoms, n_atoms, n_cells, 9)
+        dyn_mats = np.empty((n_atoms, n_atoms, n_qpts, 9),
+                            dtype=np.complex128)
+        dyn_mats.real = np.matmul(np.ascontiguousarray(ij_phases.real), fc_ij)
+        dyn_mats.imag = np.matmul(np.ascontiguousarray(ij_phases.imag), fc_ij)
+        dyn_mats = np.reshape(
+            np.transpose(
+                np.reshape(dyn_mats, (n_atoms, n_atoms, n_qpts, 3, 3)),
+                axes=(2, 0, 3, 1, 4)),
+            (n_qpts, 3*n_atoms, 3*n_atoms))
+
+        return dyn_mats
+
+    def _dipole_correction_init(self, eta_scale=1.0):
+        """
+        Calculate the q-independent parts of the long range correction
+        to the dynamical matrix for efficiency. The method used is based
+        on the Ewald sum, see eqs 72-74 from Gonze and Lee PRB 55, 10355
+        (1997)
+
+        Parameters
+        ----------
+        eta_scale : float, optional
+            Changes the cutoff in real/reciprocal space for the dipole
+            Ewald sum. A higher value uses more reciprocal terms
+        """
+
+        cell_vectors = self.crystal._cell_vectors
+        recip = self.crystal.reciprocal_cell().to('1/bohr').magnitude
+        n_atoms = self.crystal.n_atoms
+        atom_r = self.crystal.atom_r
+        born = self._born
+        dielectric = self._dielectric
+        inv_dielectric = np.linalg.inv(dielectric)
+        sqrt_pi = math.sqrt(math.pi)
+        ax = np.newaxis
+
+        # Calculate real/recip weighting
+        abc_mag = np.linalg.norm(cell_vectors, axis=1)
+        mean_abc_mag = np.prod(abc_mag)**(1.0/3)
+        eta = (sqrt_pi/mean_abc_mag)*n_atoms**(1.0/6)
+        # Use eta = lambda * |permittivity|**(1/6)
+        eta = eta*np.power(np.linalg.det(dielectric), 1.0/6)*eta_scale
+        eta_2 = eta**2
+
+        # Set limits and tolerances
+        max_shells = 50
+        frac_tol = 1e-15
+
+        # Calculate q=0 real space term
+        real_q0 = np.zeros((n_atoms, n_atoms, 3, 3))
+        # No. of independent i, j ion entries (to use i, j symmetry to
+        # minimise size of stored H_ab)
+        n_elems = np.sum(range(1, n_atoms + 1))
+        H_ab = np.zeros((0, n_elems, 3, 3))
+        cells = np.zeros((0, 3))
+        atom_r_cart = np.einsum('ij,jk->ik', atom_r, cell_vectors)
+        atom_r_e = np.einsum('ij,jk->ik', atom_r_cart, inv_dielectric)
+        for n in range(max_shells):
+            cells_tmp = self._get_shell_origins(n)
+            cells_cart = np.einsum('ij,jk->ik', cells_tmp, cell_vectors)
+            cells_e = np.einsum(
+                'ij,jk->ik', cells_cart, inv_dielectric)
+            H_ab_tmp = np.zeros((len(cells_tmp), n_elems, 3, 3))
+            # For each ion i, calculate H_ab for all j >= i and all
+            # cells in this shell at once
+            for i in range(n_atoms):
+                idx = np.sum(range(n_atoms - i, n_atoms), dtype=np.int32)
+                # Skip the i == j term for the cell at R=0
+                j0 = i + 1 if n == 0 else i
+                if j0 == n_atoms:
+                    continue
+                rij_cart = atom_r_cart[i] - atom_r_cart[j0:]
+                rij_e = atom_r_e[i] - atom_r_e[j0:]
+                # diffs, deltas have shape (n_j, n_cells, 3)
+                diffs = rij_cart[:, ax, :] - cells_cart
+                deltas = rij_e[:, ax, :] - cells_e
+                norms_2 = np.einsum('ijk,ijk->ij', deltas, diffs)*eta_2
+                norms = np.sqrt(norms_2)
+
+                # Calculate H_ab
+                exp_term = 2*np.exp(-norms_2)/(sqrt_pi*norms_2)
+                erfc_term = erfc(norms)/(norms*norms_2)
+                f1 = eta_2*(3*erfc_term/norms_2 + exp_term*(3/norms_2 + 2))
+                f2 = erfc_term + exp_term
+                H_ab_tmp[:, idx + j0:idx + n_atoms] = (
+                    np.einsum('ji,jia,jib->ijab', f1, deltas, deltas)
+                    - np.einsum('ji,ab->ijab', f2, inv_dielectric))
+            # End series when current terms are less than the fractional
+            # tolerance multiplied by the term for the cell at R=0
+            if n == 0:
+                r0_max = np.amax(np.abs(H_ab_tmp))
+            if np.amax(np.abs(H_ab_tmp)) > frac_tol*r0_max:
+                H_ab = np.concatenate((H_ab, H_ab_tmp))
+                cells = np.concatenate((cells, cells_tmp))
+            else:
+                break
+        # Use compact H_ab to fill in upper triangular of realspace term
+        real_q0[np.triu_indices(n_atoms)] = np.sum(H_ab, axis=0)
+        real_q0 *= eta**3/math.sqrt(np.linalg.det(dielectric))
+
+        # Calculate the q=0 reciprocal term
+        recip_q0 = np.zeros((n_atoms, n_atoms, 3, 3), dtype=np.complex128)
+        # Add G = 0 vectors to list, for later calculations when q !=0,
+        # but don't calculate for q=0
+        gvecs_cart = np.array([[0., 0., 0.]])
+        gvec_phases = np.tile([1. + 0.j], (1, n_atoms))
+        for n in range(1, max_shells):
+            gvecs = self._get_shell_origins(n)
+            gvecs_cart_tmp = np.einsum('ij,jk->ik', gvecs, recip)
+            gvec_dot_r = np.einsum('ij,kj->ik', gvecs, atom_r)
+            gvec_phases_tmp = np.exp(2j*math.pi*gvec_dot_r)
+            gvecs_ab = np.einsum('ij,ik->ijk', gvecs_cart_tmp, gvecs_cart_tmp)
+            k_len_2 = np.einsum('ijk,jk->i', gvecs_ab, dielectric)/(4*eta_2)
+            recip_exp = np.exp(-k_len_2)/k_len_2
+            # Sum over G for all ij pairs with a single matrix product:
+            # sum_G exp(iG.ri)*exp(-iG.rj)*recip_exp*G_a*G_b
+            gvecs_ab_exp = np.reshape(
+                gvecs_ab*recip_exp[:, ax, ax], (len(gvecs), 9))
+            recip_q0_tmp = np.reshape(
+                np.tensordot(gvec_phases_tmp,
+                             (np.conj(gvec_phases_tmp)[:, :, ax]
+                              *gvecs_ab_exp[:, ax, :]),
+                             axes=(0, 0)),
+                (n_atoms, n_atoms, 3, 3))
+            # End series when current terms are less than the fractional
+            # tolerance multiplied by the max term for the first shell
+            if n == 1:
+                first_shell_max = np.amax(np.abs(recip_q0_tmp))
+            if np.amax(np.abs(recip_q0_tmp)) > frac_tol*first_shell_max:
+                gvecs_cart = np.concatenate((gvecs_cart, gvecs_cart_tmp))
+                gvec_phases = np.concatenate((gvec_phases, gvec_phases_tmp))
+                recip_q0 += recip_q0_tmp
+            else:
+                break
+        vol = self.crystal._cell_volume()
+        recip_q0 *= math.pi/(vol*eta_2)
+
+        # Fill in remaining entries of the realspace term by symmetry.
+        # The reciprocal term has been calculated for all ij pairs
+        lower = np.tril_indices(n_atoms, -1)
+        real_q0[lower] = np.conj(real_q0[lower[1], lower[0]])
+
+        # Calculate the q=0 correction, to be subtracted from the
+        # corrected diagonal at each q
+        dipole_q0 = np.einsum('iac,jbd,ijcd->iab', born, born,
+                              recip_q0 - real_q0, optimize=True)
+        # Symmetrise 3x3
+        dipole_q0 = 0.5*(dipole_q0 + np.transpose(dipole_q0, axes=(0, 2, 1)))
+
+        self._eta_scale = eta_scale
+        self._eta = eta
+        self._H_ab = H_ab
+        self._cells = cells
+        self._gvecs_cart = gvecs_cart
+        self._gvec_phases = gvec_phases
+        self._dipole_q0 = dipole_q0
+
+    def _calculate_dipole_correction(self, q):
+        """
+        Calculate the long range correction to the dynamical matrix
+        using the Ewald sum, see eqs 72-74 from Gonze and Lee PRB 55,
+        10355 (1997)
+
+        Parameters
+        ----------
+        q : (3,) float ndarray
+            The q-point to calculate the correction for
+
+        Returns
+        -------
+        corr : (3*n_atoms, 3*n_atoms) complex ndarray
+            The correction to the dynamical matrix
+        """
+        return self._calculate_dipole_corrections(q[np.newaxis])[0]
+
+    def _calculate_dipole_corrections(self, qpts):
+        """
+        Calculate the long range correction to the dynamical matrix
+        using the Ewald sum for a block of q-points at once, see eqs
+        72-74 from Gonze and Lee PRB 55, 10355 (1997)
+
+        Parameters
+        ----------
+        qpts : (n_qpts, 3) float ndarray
+            The q-points to calculate the correction for
+
+        Returns
+        -------
+        corr : (n_qpts, 3*n_atoms, 3*n_atoms) complex ndarray
+            The correction to the dynamical matrix at each q-point
+        """
+        recip = self.crystal.reciprocal_cell().to('1/bohr').magnitude
+        n_atoms = self.crystal.n_atoms
+        n_qpts = len(qpts)
+        atom_r = self.crystal.atom_r
+        born = self._born
+        dielectric = self._dielectric
+        eta = self._eta
+        eta_2 = eta**2
+        H_ab = self._H_ab
+        cells = self._cells
+        gvec_phases = self._gvec_phases
+        gvecs_cart = self._gvecs_cart
+        q_norm = qpts - np.rint(qpts)  # Normalised q-pts
+        ax = np.newaxis
+
+        # Calculate real space term for all q with a single matrix
+        # product of the real space phases with the compact H_ab
+        q_dot_ra = 2*math.pi*np.einsum('ij,kj->ik', q_norm, cells)
+        H_ab_flat = np.reshape(H_ab, (len(cells), -1))
+        real_dipole_tmp = np.empty((n_qpts, H_ab_flat.shape[1]),
+                                   dtype=np.complex128)
+        real_dipole_tmp.real = np.matmul(np.cos(q_dot_ra), H_ab_flat)
+        real_dipole_tmp.imag = np.matmul(np.sin(q_dot_ra), H_ab_flat)
+        real_dipole = np.zeros((n_qpts, n_atoms, n_atoms, 3, 3),
+                               dtype=np.complex128)
+        idx_u = np.triu_indices(n_atoms)
+        real_dipole[:, idx_u[0], idx_u[1]] = np.reshape(
+            real_dipole_tmp, (n_qpts, -1, 3, 3))
+        real_dipole *= eta**3/math.sqrt(np.linalg.det(dielectric))
+
+        # Calculate reciprocal term
+        # Calculate q-point phases
+        q_dot_r = np.einsum('ij,kj->ik', q_norm, atom_r)
+        q_phases = np.exp(2j*math.pi*q_dot_r)
+        q_cart = np.dot(q_norm, recip)
+        # Calculate k-vector symmetric matrix, shape
+        # (n_qpts, n_gvecs, 3, 3)
+        kvecs = gvecs_cart + q_cart[:, ax, :]
+        kvecs_ab = np.einsum('ijk,ijl->ijkl', kvecs, kvecs)
+        k_len_2 = np.einsum('ijkl,kl->ij', kvecs_ab, dielectric)/(4*eta_2)
+        # Don't include G=0 vector if q=0
+        include_g = np.ones(k_len_2.shape, dtype=bool)
+        include_g[is_gamma(q_norm), 0] = False
+        exp_factor = np.zeros(k_len_2.shape)
+        np.divide(np.exp(-k_len_2), k_len_2, out=exp_factor,
+                  where=include_g)
+        recip_exp = np.reshape(kvecs_ab*exp_factor[:, :, ax, ax],
+                               (n_qpts, len(gvecs_cart), 9))
+        # Sum over G for all ij pairs with a batched matrix product:
+        # sum_G exp(i(G+q).ri)*exp(-i(G+q).rj)*recip_exp
+        phases = gvec_phases*q_phases[:, ax, :]
+        recip_dipole = np.reshape(
+            np.matmul(np.transpose(phases, axes=(0, 2, 1)),
+                      np.reshape(np.conj(phases)[:, :, :, ax]
+                                 *recip_exp[:, :, ax, :],
+                                 (n_qpts, len(gvecs_cart), 9*n_atoms))),
+            (n_qpts, n_atoms, n_atoms, 3, 3))
+        cell_volume = self.crystal._cell_volume()
+        recip_dipole *= math.pi/(cell_volume*eta_2)
+
+        # Fill in remaining entries of the real space term by symmetry
+        # Mask so we don't count diagonal twice
+        mask = np.tri(n_atoms, k=-1)[:, :, ax, ax]
+        real_dipole = real_dipole + mask*np.conj(
+            np.transpose(real_dipole, axes=[0, 2, 1, 3, 4]))
+
+        # Multiply by Born charges and subtract q=0 from diagonal
+        dipole = np.matmul(
+            np.matmul(born[:, ax], recip_dipole - real_dipole),
+            np.transpose(born, axes=(0, 2, 1))[ax])
+        diag = np.arange(n_atoms)
+        dipole[:, diag, diag] -= self._dipole_q0
+
+        return np.reshape(np.transpose(dipole, axes=[0, 1, 3, 2, 4]),
+                          (n_qpts, 3*n_atoms, 3*n_atoms))
+
+    def _calculate_gamma_correction(self, q_dir):
+        """
+        Calculate non-analytic correction to the dynamical matrix at q=0
+        for a specified direction of approach. See Eq. 60 of X. Gonze
+        and C. Lee, PRB (1997) 55, 10355-10368.
+
+        Parameters
+        ----------
+        q_dir : (3,) float ndarray
+            The direction along which q approaches 0, in reciprocal
+            fractional coordinates
+
+        Returns
+        -------
+        na_corr : (3*n_atoms, 3*n_atoms) complex ndarray
+            The correction to the dynamical matrix
+        """
+        n_atoms = self.crystal.n_atoms
+        born = self._born
+        dielectric = self._dielectric
+        na_corr = np.zeros((3*n_atoms, 3*n_atoms), dtype=np.complex128)
+
+        if is_gamma(q_dir):
+            return na_corr
+
+        cell_volume = self.crystal._cell_volume()
+        denominator = np.einsum('ij,i,j', dielectric, q_dir, q_dir)
+        factor = 4*math.pi/(cell_volume*denominator)
+
+        q_born_sum = np.einsum('ijk,k->ij', born, q_dir)
+        for i in range(n_atoms):
+            for j in range(n_atoms):
+                na_corr[3*i:3*(i+1), 3*j:3*(j+1)] = np.einsum(
+                    'i,j->ij', q_born_sum[i], q_born_sum[j])
+        na_corr *= factor
+
+        return na_corr
+
+    def _get_shell_origins(self, n):
+        """
+        Given the shell number, compute all the cell origins that lie in
+        that shell
+
+        Parameters
+        ----------
+        n : int
+            The shell number
+
+        Returns
+        -------
+        origins : ((2*n + 1)**3 - (2*n - 1)**3, 3) int ndarray
+            The cell origins. Note: if n = 0, origins = [[0, 0, 0]]
+
+        """
+
+        if n == 0:
+            return np.array([[0, 0, 0]], dtype=np.int32)
+
+        # Coordinates of cells in xy plane where z=0, xz plane where
+        # y=0, yz plane where x=0. Note: to avoid duplicating cells at
+        # the edges, the xz plane has (2*n + 1) - 2 rows in z, rather
+        # than (2*n + 1). The yz plane also has (2*n + 1) - 2 rows in z
+        # and (2*n + 1) - 2 columns in y
+        xy = get_all_origins([n+1, n+1, 1], min_xyz=[-n, -n, 0])
+        xz = get_all_origins([n+1, 1, n], min_xyz=[-n, 0, -n+1])
+        yz = get_all_origins([1, n, n], min_xyz=[0, -n+1, -n+1])
+
+        # Offset each plane by n and -n to get the 6 planes that make up
+        # the shell
+        origins = np.zeros(((2*n+1)**3-(2*n-1)**3, 3), dtype=np.int32)
+        for i, ni in enumerate([-n, n]):
+            origins[i*len(xy):(i+1)*len(xy)] = xy
+            origins[i*len(xy):(i+1)*len(xy), 2] = ni
+            io = 2*len(xy)
+            origins[io+i*len(xz):io+(i+1)*len(xz)] = xz
+            origins[io+i*len(xz):io+(i+1)*len(xz), 1] = ni
+            io = 2*(len(xy) + len(xz))
+            origins[io+i*len(yz):io+(i+1)*len(yz)] = yz
+            origins[io+i*len(yz):io+(i+1)*len(yz), 0] = ni
+
+        return origins
+
+    def _enforce_realspace_asr(self):
+        """
+        Apply a transformation to the force constants matrix so that it
+        satisfies the acousic sum rule. Diagonalise, shift the acoustic
+        modes to almost zero then construct the correction to the force
+        constants matrix using the eigenvectors. For more information
+        see section 2.3.4:
+        http://www.tcm.phy.cam.ac.uk/castep/Phonons_Guide/Castep_Phonons.html
+
+        The full (3*n_atoms*n_cells_in_sc, 3*n_atoms*n_cells_in_sc)
+        supercell force constants matrix is not constructed. It is
+        block circulant over the cells in the supercell, so if it is
+        symmetric its acoustic modes are uniform across cells, and are
+        eigenvectors of the (3*n_atoms, 3*n_atoms) sum of the force
+        constants over cells. Otherwise the acoustic modes of its upper
+        triangle are found iteratively, see
+        _find_supercell_acoustic_modes
+
+        Returns
+        -------
+        force_constants : (n_cells_in_sc, 3*n_atoms, 3*n_atoms) float ndarray
+            The corrected force constants matrix
+        """
+        cell_origins = self.cell_origins
+        sc_matrix = self.sc_matrix
+        n_cells_in_sc = self.n_cells_in_sc
+        force_constants = self._force_constants
+
+        # The cell origins in fractional supercell coordinates are
+        # multiples of 1/n_cells_in_sc, so label each cell by its
+        # integer coordinates modulo n_cells_in_sc. The cell equivalent
+        # to any inter-cell vector can then be found by its label
+        inv_sc_matrix = np.linalg.inv(np.transpose(sc_matrix))
+        cell_origins_sc = n_cells_in_sc*np.einsum(
+            'ij,kj->ik', cell_origins, inv_sc_matrix)
+        cell_labels = np.rint(cell_origins_sc)
+        label_err = np.abs(cell_origins_sc - cell_labels)
+        cell_labels = np.mod(cell_labels.astype(np.int64), n_cells_in_sc)
+        label_weights = n_cells_in_sc**np.arange(2, -1, -1, dtype=np.int64)
+        cell_keys = np.dot(cell_labels, label_weights)
+        key_order = np.argsort(cell_keys)
+        if (np.any(label_err > 16*n_cells_in_sc*sys.float_info.epsilon)
+                or len(np.unique(cell_keys)) != n_cells_in_sc):
+            warnings.warn((
+                'Error correcting FC matrix for acoustic sum rule, '
+                'supercell relative index couldn\'t be found. '
+                'Returning uncorrected FC matrix'))
+            return force_constants
+
+        def cell_index(labels):
+            keys = np.dot(np.mod(labels, n_cells_in_sc), label_weights)
+            return key_order[np.searchsorted(cell_keys[key_order], keys)]
+
+        # Block (i, j) of the supercell matrix is the transpose of the
+        # force constants of the cell equivalent to cell j - cell i.
+        # Get the first column of blocks, which is the output
+        fc = np.transpose(
+            force_constants[cell_index(cell_labels[0] - cell_labels)],
+            axes=(0, 2, 1))
+        is_symmetric = np.array_equal(
+            fc, force_constants[cell_index(cell_labels - cell_labels[0])])
+
+        try:
+            fc_sum = np.sum(fc, axis=0)
+            ac_i, evals, evecs = self._find_acoustic_modes(
+                0.5*(fc_sum + np.transpose(fc_sum)))
+            # Repeat the eigenvectors in each cell, normalised over cells
+            fc_tol = 1e-8*np.min(np.abs(evals))
+            evals = evals[ac_i]
+            evecs = np.tile(evecs[:, ac_i]/np.sqrt(n_cells_in_sc),
+                            (n_cells_in_sc, 1, 1))
+            if not is_symmetric:
+                evals, evecs = self._find_supercell_acoustic_modes(
+                    cell_labels, cell_index, evals, evecs)
+        except Exception:
+            warnings.warn((
+                '\nError correcting for acoustic sum rule, could not '
+                'find 3 acoustic modes.\nReturning uncorrected FC '
+                'matrix'), stacklevel=2)
+            return force_constants
+
+        # Correct fc matrix - set acoustic modes to almost zero
+        fc -= np.einsum('k,iak,bk->iab', fc_tol + evals, evecs, evecs[0])
+
+        return fc
+
+    def _find_supercell_acoustic_modes(self, cell_labels, cell_index,
+                                       evals, evecs):
+        """
+        Find the acoustic modes of a non-symmetric supercell force
+        constants matrix without constructing it. As in
+        _find_acoustic_modes, only its upper triangle is used, so these
+        are the acoustic modes of the symmetric matrix H with that upper
+        triangle. A Davidson method is used, preconditioned with the
+        symmetrised supercell matrix, see _get_supercell_bloch_modes
+
+        Parameters
+        ----------
+        cell_labels : (n_cells_in_sc, 3) int ndarray
+            The integer fractional supercell coordinates of each cell,
+            multiplied by n_cells_in_sc
+        cell_index : function
+            Returns the index of the cell(s) equivalent to the label(s)
+            passed to it
+        evals : (3,) float ndarray
+            Initial guess for the acoustic eigenvalues
+        evecs : (n_cells_in_sc, 3*n_atoms, 3) float ndarray
+            Initial guess for the acoustic eigenvectors
+
+        Returns
+        -------
+        evals : (3,) float ndarray
+            The acoustic eigenvalues of H
+        evecs : (n_cells_in_sc, 3*n_atoms, 3) float ndarray
+            The acoustic eigenvectors of H
+        """
+        force_constants = self._force_constants
+        n_cells_in_sc, n_branches = force_constants.shape[:2]
+        n_atoms_in_sc = n_cells_in_sc*self.crystal.n_atoms
+        max_iter = 50
+
+        # Diagonal blocks of H, from the upper triangle of the force
+        # constants of the origin cell
+        fc_origin = np.transpose(force_constants[
+            cell_index(np.zeros(3, dtype=np.int64))])
+        fc_origin = np.triu(fc_origin) + np.transpose(np.triu(fc_origin, 1))
+
+        def apply_h(x):
+            hx = np.einsum('ab,ibk->iak', fc_origin, x)
+            for i in range(n_cells_in_sc - 1):
+                # The transpose of blocks (i, j > i) of the upper
+                # triangle, which are mirrored into the lower triangle
+                fc_t = force_constants[
+                    cell_index(cell_labels[i + 1:] - cell_labels[i])]
+                hx[i] += np.einsum('jba,jbk->ak', fc_t, x[i + 1:])
+                hx[i + 1:] += np.einsum('jab,bk->jak', fc_t, x[i])
+            return hx
+
+        resid_tol = 1e-12*np.linalg.norm(force_constants)
+        sc_modes = None
+        basis = np.reshape(evecs, (-1, 3))
+        h_basis = np.reshape(apply_h(evecs), (-1, 3))
+        for _ in range(max_iter):
+            # Rayleigh-Ritz, choosing the acoustic modes as in
+            # _find_acoustic_modes
+            ritz_evals, ritz_coeffs = np.linalg.eigh(
+                np.einsum('ij,ik->jk', basis, h_basis), UPLO='U')
+            ritz_evecs = np.einsum('ij,jk->ik', basis, ritz_coeffs)
+            c_of_m_disp_sq = np.sum(np.sum(np.reshape(
+                ritz_evecs, (n_atoms_in_sc, 3, -1)), axis=0)**2, axis=0)
+            if np.sum(c_of_m_disp_sq > 0.5*n_atoms_in_sc) < 3:
+                raise Exception('Could not find 3 acoustic modes')
+            ac_i = np.argsort(c_of_m_disp_sq)[-3:]
+            evals = ritz_evals[ac_i]
+            evecs = ritz_evecs[:, ac_i]
+            resid = (np.einsum('ij,jk->ik', h_basis, ritz_coeffs[:, ac_i])
+                     - evecs*evals)
+            unconverged = np.linalg.norm(resid, axis=0) > resid_tol
+            if not np.any(unconverged):
+                return evals, np.reshape(evecs, (n_cells_in_sc, -1, 3))
+            # Get the corrections by applying (S_sym - eval)^-1 to the
+            # residuals in the Bloch basis, where S_sym is the
+            # symmetrised supercell matrix
+            if sc_modes is None:
+                sc_modes = self._get_supercell_bloch_modes(cell_labels)
+            resid = np.reshape(resid[:, unconverged],
+                               (n_cells_in_sc, n_branches, -1))
+            corr = np.zeros(resid.shape, dtype=np.complex128)
+            for m, sc_evals, sc_evecs in zip(*sc_modes):
+                phases = _get_cell_phases(cell_labels, m)
+                coeffs = np.einsum('ba,bk->ak', np.conj(sc_evecs),
+                                   np.einsum('i,ibk->bk', np.conj(phases),
+                                             resid))
+                coeffs /= sc_evals[:, np.newaxis] - evals[unconverged]
+                corr += np.einsum('i,ak->iak', phases,
+                                  np.einsum('ab,bk->ak', sc_evecs, coeffs))
+            # Expand the basis with the orthogonalised corrections
+            corr = np.reshape(np.real(corr), (len(basis), -1))
+            for _ in range(2):
+                corr -= np.einsum('ij,jk->ik', basis,
+                                  np.einsum('ij,ik->jk', basis, corr))
+                corr = np.linalg.qr(corr)[0]
+            basis = np.hstack((basis, corr))
+            h_basis = np.hstack((h_basis, np.reshape(apply_h(np.reshape(
+                corr, (n_cells_in_sc, n_branches, -1))), (len(basis), -1))))
+        raise Exception('Could not converge acoustic modes')
+
+    def _get_supercell_bloch_modes(self, cell_labels):
+        """
+        Block diagonalise the symmetrised supercell force constants
+        matrix, which is block circulant, using the Bloch waves at the
+        q-points commensurate with the supercell
+
+        Parameters
+        ----------
+        cell_labels : (n_cells_in_sc, 3) int ndarray
+            The integer fractional supercell coordinates of each cell,
+            multiplied by n_cells_in_sc
+
+        Returns
+        -------
+        sc_qpts_m : (n_cells_in_sc, 3) int ndarray
+            The integer vectors sc_matrix @ q for each commensurate
+            q-point q in [0, 1)
+        sc_evals : (n_cells_in_sc, 3*n_atoms) float ndarray
+            The eigenvalues at each q-point. Those of the acoustic
+            modes at gamma are set to infinity
+        sc_evecs : (n_cells_in_sc, 3*n_atoms, 3*n_atoms) complex ndarray
+            The eigenvectors at each q-point
+        """
+        force_constants = self._force_constants
+        sc_matrix = self.sc_matrix
+        n_cells_in_sc, n_branches = force_constants.shape[:2]
+
+        lim = np.stack((np.sum(np.minimum(sc_matrix, 0), axis=1),
+                        np.sum(np.maximum(sc_matrix, 0), axis=1) + 1))
+        sc_qpts_m = np.reshape(np.mgrid[
+            lim[0, 0]:lim[1, 0], lim[0, 1]:lim[1, 1], lim[0, 2]:lim[1, 2]],
+            (3, -1)).T
+        sc_qpts = np.einsum('ij,kj->ki', np.linalg.inv(sc_matrix), sc_qpts_m)
+        tol = 16*n_cells_in_sc*sys.float_info.epsilon
+        sc_qpts_m = sc_qpts_m[np.all(
+            (sc_qpts > -tol) & (sc_qpts < 1 - tol), axis=1)]
+        if len(sc_qpts_m) != n_cells_in_sc:
+            raise Exception('Could not find supercell q-points')
+
+        sc_evals = np.zeros((n_cells_in_sc, n_branches))
+        sc_evecs = np.zeros((n_cells_in_sc, n_branches, n_branches),
+                            dtype=np.complex128)
+        for qi, m in enumerate(sc_qpts_m):
+            dmat = np.einsum('i,iba->ab', _get_cell_phases(cell_labels, m),
+                             force_constants)
+            sc_evals[qi], sc_evecs[qi] = np.linalg.eigh(
+                0.5*(dmat + np.conj(np.transpose(dmat))))
+        gamma_i = np.where(~np.any(sc_qpts_m, axis=1))[0][0]
+        c_of_m_disp_sq = np.sum(np.abs(np.sum(np.reshape(
+            sc_evecs[gamma_i], (-1, 3, n_branches)), axis=0))**2, axis=0)
+        sc_evals[gamma_i, np.argsort(c_of_m_disp_sq)[-3:]] = np.inf
+
+        return sc_qpts_m, sc_evals, sc_evecs
+
+    def _enforce_reciprocal_asr(self, dyn_mat_gamma):
+        """
+        Calculate the correction to the dynamical matrix that would have
+        to be applied to satisfy the acousic sum rule. Diagonalise the
+        gamma-point dynamical matrix, shift the acoustic modes to almost
+        zero then reconstruct the dynamical matrix using the
+        eigenvectors. For more information see section 2.3.4:
+        http://www.tcm.phy.cam.ac.uk/castep/Phonons_Guide/Castep_Phonons.html
+
+        Parameters
+        ----------
+        dyn_mat_gamma : (3*n_atoms, 3*n_atoms) complex ndarray
+            The non mass-weighted dynamical matrix at gamma
+
+        Returns
+        -------
+        dyn_mat : (3*n_atoms, 3*n_atoms) complex ndarray or empty array
+            The corrected, non mass-weighted dynamical matrix at q.
+            Returns empty array (np.array([])) if finding the 3 acoustic
+            modes fails
+        """
+        tol = 5e-15
+
+        try:
+            ac_i, g_evals, g_evecs = self._find_acoustic_modes(
+                dyn_mat_gamma)
+        except Exception:
+            warnings.warn(('\nError correcting for acoustic sum rule, '
+                           'could not find 3 acoustic modes.\nNot '
+                           'correcting dynamical matrix'), stacklevel=2)
+            return np.array([], dtype=np.complex128)
+
+        n_atoms = self.crystal.n_atoms
+        recip_asr_correction = np.zeros((3*n_atoms, 3*n_atoms),
+                                        dtype=np.complex128)
+        for i, ac in enumerate(ac_i):
+            recip_asr_correction -= (tol*i + g_evals[ac])*np.einsum(
+                'i,j->ij', g_evecs[:, ac], g_evecs[:, ac])
+
+        return recip_asr_correction
+
+    def _find_acoustic_modes(self, dyn_mat):
+        """
+        Find the acoustic modes from a dynamical matrix, they should
+        have the sum of c of m amplitude squared = mass (note: have not
+        actually included mass weighting here so assume mass = 1.0)
+
+        Parameters
+        ----------
+        dyn_mat : (3*n_atoms, 3*n_atoms) complex ndarray
+            A dynamical matrix
+
+        Returns
+        -------
+        ac_i : (3,) int ndarray
+            The indices of the acoustic modes
+        evals : (3*n_atoms) float ndarray
+            Dynamical matrix eigenvalues
+        evecs : (3*n_atoms, n_atoms, 3) complex ndarray
+            Dynamical matrix eigenvectors
+        """
+        n_branches = dyn_mat.shape[0]
+        n_atoms = int(n_branches/3)
+
+        evals, evecs = np.linalg.eigh(dyn_mat, UPLO='U')
+        evec_reshape = np.reshape(
+            np.transpose(evecs), (n_branches, n_atoms, 3))
+        # Sum displacements for all ions in each branch
+        c_of_m_disp = np.sum(evec_reshape, axis=1)
+        c_of_m_disp_sq = np.sum(np.abs(c_of_m_disp)**2, axis=1)
+        sensitivity = 0.5
+        sc_mass = 1.0*n_atoms
+        # Check number of acoustic modes
+        if np.sum(c_of_m_disp_sq > sensitivity*sc_mass) < 3:
+            raise Exception('Could not find 3 acoustic modes')
+        # Find idx of acoustic modes (3 largest c of m displacements)
+        ac_i = np.argsort(c_of_m_disp_sq)[-3:]
+
+        return ac_i, evals, evecs
+
+    def _calculate_phases(self, qpts, unique_sc_offsets, unique_sc_i,
+                          unique_cell_origins, unique_cell_i):
+        """
+        Calculate the phase factors for the supercell images and cells
+        for a block of q-points. The unique supercell and cell origins
+        indices are required to minimise expensive exp and power
+        operations
+
+        Parameters
+        ----------
+        qpts : (n_qpts, 3) float ndarray
+            The q-points to calculate the phases for
+        unique_sc_offsets : list of lists of ints
+            A list containing 3 lists of the unique supercell image
+            offsets in each direction. The supercell offset is
+            calculated by multiplying the supercell matrix by the
+            supercell image indices (obtained by _get_all_origins()). A
+            list of lists rather than a Numpy array is used as the 3
+            lists are independent and their size is not known beforehand
+        unique_sc_i : ((2*lim + 1)**3, 3) int ndarray
+            The indices needed to reconstruct sc_offsets from the unique
+            values in unique_sc_offsets
+        unique_cell_origins : list of lists of ints
+            A list containing 3 lists of the unique cell origins in each
+            direction. A list of lists rather than a Numpy array is used
+            as the 3 lists are independent and their size is not known
+            beforehand
+        unique_cell_i : (cell_origins, 3) int ndarray
+            The indices needed to reconstruct cell_origins from the
+            unique values in unique_cell_origins
+
+        Returns
+        -------
+        sc_phases : (n_qpts, unique_sc_i) complex ndarray
+            Phase factors exp(iq.r) for each q-point and supercell image
+            coordinate in sc_offsets
+        cell_phases : (n_qpts, unique_cell_i) complex ndarray
+            Phase factors exp(iq.r) for each q-point and cell coordinate
+            in the supercell
+        """
+
+        # Only calculate exp(iq) once, then raise to power to get the
+        # phase at different supercell/cell coordinates to minimise
+        # expensive exp calculations
+        # exp(iq.r) = exp(iqh.ra)*exp(iqk.rb)*exp(iql.rc)
+        #           = (exp(iqh)^ra)*(exp(iqk)^rb)*(exp(iql)^rc)
+        phase = np.exp(2j*math.pi*qpts)
+        sc_phases = np.ones((len(qpts), len(unique_sc_i)),
+                            dtype=np.complex128)
+        cell_phases = np.ones((len(qpts), len(unique_cell_i)),
+                              dtype=np.complex128)
+        for i in range(3):
+            unique_sc_phases = np.power(
+                phase[:, i, np.newaxis], unique_sc_offsets[i])
+            sc_phases *= unique_sc_phases[:, unique_sc_i[:, i]]
+
+            unique_cell_phases = np.power(
+                phase[:, i, np.newaxis], unique_cell_origins[i])
+            cell_phases *= unique_cell_phases[:, unique_cell_i[:, i]]
+
+        return sc_phases, cell_phases
+
+    def _calculate_supercell_images(self, lim):
+        """
+        For each displacement of ion i in the unit cell and ion j in the
+        supercell, calculate the number of supercell periodic images
+        there are and which supercells they reside in, and sets the
+        _sc_image_i, _sc_image_offsets and _n_sc_images ForceConstants
+        attributes. The images are stored in a compressed layout:
+        _sc_image_i is a 1D array containing the supercell image
+        indices for all cell and ij pairs, and the images for cell nc
+        and ions i, j are
+        _sc_image_i[_sc_image_offsets[k]:_sc_image_offsets[k + 1]]
+        where k = (nc*n_atoms + i)*n_atoms + j
+
+        Parameters
+        ----------
+        lim : int
+            The supercell image limit
+        """
+
+        n_atoms = self.crystal.n_atoms
+        cell_vectors = self.crystal._cell_vectors
+        atom_r = self.crystal.atom_r
+        cell_origins = self.cell_origins
+        n_cells_in_sc = self.n_cells_in_sc
+        sc_matrix = self.sc_matrix
+        ax = np.newaxis
+
+        # List of points defining Wigner-Seitz cell
+        ws_frac = np.array([[0, 0, 0], [0, 0, 1], [0, 1, 0], [0, 1, 1],
+                            [0, 1, -1], [1, 0, 0], [1, 0, 1], [1, 0, -1],
+                            [1, 1, 0], [1, 1, 1], [1, 1, -1], [1, -1, 0],
+                            [1, -1, 1], [1, -1, -1]])
+        cutoff_scale = 1.0
+
+        # Calculate points of WS cell for this supercell
+        sc_vecs = np.dot(sc_matrix, cell_vectors)
+        ws_list = np.dot(ws_frac, sc_vecs)
+        inv_ws_sq = 1.0/np.sum(np.square(ws_list[1:]), axis=1)
+        ws_list_norm = ws_list[1:]*inv_ws_sq[:, ax]
+
+        # Get Cartesian coords of supercell images and ions in supercell
+        sc_image_r = get_all_origins(
+            np.repeat(lim, 3) + 1, min_xyz=-np.repeat(lim, 3))
+        sc_image_cart = np.einsum('ij,jk->ik', sc_image_r, sc_vecs)
+        sc_atom_r = np.einsum('ijk,kl->ijl',
+                             cell_origins[:, ax, :] + atom_r[ax, :, :],
+                             np.linalg.inv(np.transpose(sc_matrix)))
+        sc_ion_cart = np.einsum('ijk,kl->ijl', sc_atom_r, sc_vecs)
+
+        cutoff = 0.5*cutoff_scale + 0.001
+        # For each ion i in the unit cell, check all ions j in the
+        # supercell in all periodic supercell images at once. Only want
+        # to include images where ion < halfway to ALL ws points, so
+        # compare vector to each ws point in turn, removing vectors
+        # that fail each check so later checks are done on fewer vectors
+        sc_keys = []
+        sc_ims = []
+        for i in range(n_atoms):
+            rij = sc_ion_cart[0, i] - sc_ion_cart
+            # Get vectors between j in each sc image and i in unit cell.
+            # The x, y, z components are stored as separate arrays of
+            # shape (n_cells_in_sc, n_atoms, n_sc_images) for efficiency
+            dists = [np.subtract.outer(rij[:, :, k], sc_image_cart[:, k])
+                     for k in range(3)]
+            nc_idx, nj_idx, im_idx = np.nonzero(
+                _ws_dist(dists, ws_list_norm[0]) <= cutoff)
+            dists = [d[nc_idx, nj_idx, im_idx] for d in dists]
+            for wsp in ws_list_norm[1:]:
+                idx = np.nonzero(_ws_dist(dists, wsp) <= cutoff)[0]
+                nc_idx = nc_idx[idx]
+                nj_idx = nj_idx[idx]
+                im_idx = im_idx[idx]
+                dists = [d[idx] for d in dists]
+            # If ion-ion vector has been < halfway to all WS points,
+            # this is a valid image! Save it
+            sc_keys.append((nc_idx*n_atoms + i)*n_atoms + nj_idx)
+            sc_ims.append(im_idx)
+
+        # Sort images by cell and ij pair. A stable sort is used so the
+        # images for each pair remain in increasing image order
+        sc_keys = np.concatenate(sc_keys)
+        sc_ims = np.concatenate(sc_ims)
+        order = np.argsort(sc_keys, kind='stable')
+        self._sc_image_i = sc_ims[order].astype(np.int32)
+        n_sc_images = np.bincount(sc_keys,
+                                  minlength=n_cells_in_sc*n_atoms*n_atoms)
+        self._n_sc_images = np.reshape(
+            n_sc_images, (n_cells_in_sc, n_atoms, n_atoms)).astype(np.int32)
+        self._sc_image_offsets = np.zeros(n_sc_images.size + 1,
+                                          dtype=np.int32)
+        np.cumsum(n_sc_images, out=self._sc_image_offsets[1:])
+
+    def to_dict(self):
+        """
+        Convert to a dictionary. See ForceConstants.from_dict for
+        details on keys/values
+
+        Returns
+        -------
+        dict
+        """
+        dout = _obj_to_dict(self, ['crystal', 'force_constants',
+                                   'n_cells_in_sc', 'sc_matrix',
+                                   'cell_origins', 'born',
+                                   'dielectric'])
+        return dout
+
+    def to_json_file(self, filename):
+        """
+        Write to a JSON file. JSON fields are equivalent to
+        ForceConstants.from_dict keys
+
+        Parameters
+        ----------
+        filename : str
+            Name of the JSON file to write to
+        """
+        _obj_to_json_file(self, filename)
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Convert a dictionary to a ForceConstants object
+
+        Parameters
+        ----------
+        d : dict
+            A dictionary with the following keys/values:
+
+            - 'crystal': dict, see Crystal.from_dict
+            - 'force_constants': (n_cells_in_sc, 3*crystal.n_atoms, 3*crystal.n_atoms) float ndarray
+            - 'force_constants_unit': str
+            - 'sc_matrix': (3,3) int ndarray
+            - 'cell_origins': (n_cells_in_sc, 3) int ndarray
+
+            There are also the following optional keys:
+
+            - 'born': (3*crystal.n_atoms, 3, 3) float ndarray
+            - 'born_unit': str
+            - 'dielectric': (3, 3) float ndarray
+            - 'dielectric_unit': str
+
+        Returns
+        -------
+        ForceConstants
+        """
+        crystal = Crystal.from_dict(d['crystal'])
+        d = _process_dict(
+            d, quantities=['force_constants', 'born', 'dielectric'],
+            optional=['born', 'dielectric'])
+        return ForceConstants(crystal, d['force_constants'], d['sc_matrix'],
+                              d['cell_origins'], d['born'], d['dielectric'])
+
+    @classmethod
+    def from_json_file(cls, filename):
+        """
+        Read from a JSON file. See ForceConstants.from_dict for required
+        fields
+
+        Parameters
+        ----------
+        filename : str
+            The file to read from
+
+        Returns
+        -------
+        ForceConstants
+        """
+        return _obj_from_json_file(cls, filename)
+
+    @classmethod
+    def from_castep(cls, filename):
+        """
+        Reads from a .castep_bin or .check file
+
+        Parameters
+        ----------
+        filename : str
+            The path and name of the file to read
+
+        Returns
+        -------
+        ForceConstants
+        """
+        data = castep._read_interpolation_data(filename)
+        return cls.from_dict(data)
+
+    @classmethod
+    def from_phonopy(cls, path='.', summary_name='phonopy.yaml',
+                     born_name=None, fc_name='FORCE_CONSTANTS',
+                     fc_format=None):
+        """
+        Reads data from the phonopy summary file (default phonopy.yaml)
+        and optionally born and force constants files. Only attempts to
+        read from born or force constants files if these can't be found
+        in the summary file.
+
+        Parameters
+        ----------
+        path : str, optional
+            Path to directory containing the file(s)
+        summary_name : str, optional
+            Filename of phonopy summary file, default phonopy.yaml. By
+            default any information (e.g. force constants) read from
+            this file takes priority
+        born_name : str, optional
+            Name of the Phonopy file containing born charges and
+            dielectric tensor (by convention in Phonopy this would be
+            called BORN). Is only read if Born charges can't be found in
+            the summary_name file
+        fc_name : str, optional
+            Name of file containing force constants. Is only read if
+            force constants can't be found in summary_name
+        fc_format : {'phonopy', 'hdf5'} str, optional
+            Format of file containing force constants data.
+            FORCE_CONSTANTS is type 'phonopy'
+
+        Returns
+        -------
+        ForceConstants
+        """
+        data = phonopy._read_interpolation_data(
+            path=path, summary_name=summary_name, born_name=born_name,
+            fc_name=fc_name, fc_format=fc_format)
+        return cls.from_dict(data)
+
+
+def _ws_dist(dists, wsp):
+    """
+    Get the absolute projection of ion-ion vectors onto a normalised
+    Wigner-Seitz point, where dists contains the separate x, y, z
+    components of the vectors
+    """
+    return np.absolute(dists[0]*wsp[0] + dists[1]*wsp[1] + dists[2]*wsp[2])
+
+
+def _get_cell_phases(cell_labels, m):
+    """
+    Get the Bloch phases exp(2*pi*i*q.R) of each cell in the supercell,
+    at a q-point q commensurate with the supercell, where m is the
+    integer vector sc_matrix @ q and cell_labels are the cell origins in
+    fractional supercell coordinates multiplied by n_cells_in_sc
+    """
+    n_cells_in_sc = len(cell_labels)
+    return np.exp(2j*math.pi*np.mod(
+        np.dot(cell_labels, m), n_cells_in_sc)/n_cells_in_sc)
+
+
+def _get_complex_dtype(dtype):
+    """
+    Check that dtype is a supported precision for the phonon
+    calculation (numpy.float32 or numpy.float64), and return the
+    corresponding complex dtype for the eigenvectors
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.float32:
+        return np.dtype(np.complex64)
+    elif dtype == np.float64:
+        return np.dtype(np.complex128)
+    raise ValueError((
+        f'dtype must be numpy.float32 or numpy.float64, got {dtype}'))
+
+
+if shared_memory is not None:
+    class _SharedMemory(shared_memory.SharedMemory):
+        """
+        A shared memory block that can be closed or garbage collected
+        while arrays created by _shared_array still use it. The memory
+        is then unmapped once the last of those arrays is garbage
+        collected
+        """
+        def close(self):
+            # Arrays created from the buffer have the mmap as their
+            # base, so rather than closing it (which would unmap the
+            # memory while they're still in use) leave it to be
+            # unmapped when it's garbage collected
+            self._mmap = None
+            super().close()
+
+
+def _shared_array(shape, dtype, name=None):
+    """
+    Create a new, zeroed, shared memory block, or attach to an existing
+    one, and create a Numpy array using its buffer
+
+    Parameters
+    ----------
+    shape : tuple of int
+        The shape of the array
+    dtype : numpy.dtype or str
+        The type of the array
+    name : str, optional
+        The name of an existing shared memory block to attach to
+
+    Returns
+    -------
+    shm : _SharedMemory
+        The shared memory block
+    arr : numpy.ndarray
+        The array using the shared memory buffer
+    """
+    dtype = np.dtype(dtype)
+    shape = tuple(shape)
+    if name is None:
+        shm = _SharedMemory(
+            create=True, size=max(int(np.prod(shape))*dtype.itemsize, 1))
+    else:
+        shm = _SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _shared_copy(arr):
+    """
+    Create a new shared memory block containing a copy of arr. Returns
+    the block, and the info used by _open_shared_array to open it in
+    another process
+    """
+    shm, shared_arr = _shared_array(arr.shape, arr.dtype)
+    shared_arr[...] = arr
+    return shm, (shm.name, shared_arr.shape, shared_arr.dtype.str)
+
+
+def _open_shared_array(name, shape, dtype, offset=None):
+    """
+    Open an array in another process, from the name, shape and dtype of
+    a shared memory block, or if offset is given, from the filename,
+    shape, dtype and offset of a numpy.memmap
+    """
+    if offset is None:
+        return _shared_array(shape, dtype, name=name)[1]
+    return np.memmap(name, dtype=dtype, mode='r+', offset=offset,
+                     shape=shape)
+
+
+class _PhononsProcessPool:
+    """
+    A process pool for the Python phonon calculation, with copies of the
+    q-independent arrays from one ForceConstants._calculate_phonons_setup
+    in shared memory. The pool is shut down and the shared memory
+    unlinked by close, or when this object is garbage collected
+
+    Parameters
+    ----------
+    fc : ForceConstants
+        The force constants object the setup is for
+    setup : dict
+        The q-independent values from
+        ForceConstants._calculate_phonons_setup
+    n_procs : int
+        The number of processes in the pool
+    """
+    def __init__(self, fc, setup, n_procs):
+        self.n_procs = n_procs
+        arrays = {'fc_img_weighted': setup['fc_img_weighted'],
+                  '_sc_image_i': fc._sc_image_i,
+                  '_sc_image_offsets': fc._sc_image_offsets,
+                  '_n_sc_images': fc._n_sc_images}
+        attrs = {'crystal': fc.crystal, '_born': fc._born,
+                 '_dielectric': fc._dielectric}
+        for attr, val in setup['dipole_attrs'].items():
+            if isinstance(val, np.ndarray):
+                arrays[attr] = val
+            else:
+                attrs[attr] = val
+        shm_info = {}
+        self.shms = []
+        for name, arr in arrays.items():
+            shm, shm_info[name] = _shared_copy(arr)
+            self.shms.append(shm)
+        args = (setup['unique_sc_offsets'], setup['unique_sc_i'],
+                setup['unique_cell_origins'], setup['unique_cell_i'],
+                setup['recip_asr_correction'], setup['dyn_mat_weighting'],
+                setup['dipole'], setup['asr'])
+        self.executor = ProcessPoolExecutor(
+            max_workers=n_procs, initializer=_init_phonons_worker,
+            initargs=(shm_info, attrs, args))
+        self._finalizer = weakref.finalize(
+            self, _close_phonons_pool, self.executor, self.shms)
+
+    def close(self):
+        self._finalizer()
+
+
+def _close_phonons_pool(executor, shms):
+    executor.shutdown()
+    for shm in shms:
+        shm.close()
+        shm.unlink()
+
+
+# Per-process state for _PhononsProcessPool, set by
+# _init_phonons_worker
+_phonons_worker_state = {}
+
+
+def _init_phonons_worker(shm_info, attrs, args):
+    """
+    Process pool initialiser. Attaches to the shared memory blocks and
+    creates a lightweight ForceConstants object containing only the
+    attributes required to calculate the dynamical matrix
+
+    Parameters
+    ----------
+    shm_info : dict
+        Maps the array names to the arguments to _open_shared_array
+    attrs : dict
+        Small attributes to set on the ForceConstants object, e.g.
+        crystal
+    args : tuple
+        The q-independent arguments after fc_img_weighted, see
+        ForceConstants._calculate_phonons_at_q_block, without splitting
+    """
+    arrays = {name: _open_shared_array(*info)
+              for name, info in shm_info.items()}
+    fc = ForceConstants.__new__(ForceConstants)
+    for name, value in attrs.items():
+        setattr(fc, name, value)
+    for name, arr in arrays.items():
+        if name.startswith('_'):
+            setattr(fc, name, arr)
+    _phonons_worker_state.update(
+        {'fc': fc, 'args': (arrays['fc_img_weighted'],) + args})
+
+
+def _calculate_phonons_worker(call_info, qi, qf, splitting,
+                              return_eigenvectors, dtype=np.float64):
+    """
+    Calculate phonons for reduced q-points qi to qf using the state set
+    by _init_phonons_worker, and write the results into the shared
+    output arrays
+
+    Parameters
+    ----------
+    call_info : dict
+        Maps reduced_qpts, qpts_i, rfreqs and (if return_eigenvectors)
+        reigenvecs to the arguments to _open_shared_array for each
+    """
+    arrays = {name: _open_shared_array(*info)
+              for name, info in call_info.items()}
+    args = ((arrays['reduced_qpts'], arrays['qpts_i'])
+            + _phonons_worker_state['args'] + (splitting,))
+    freqs, evecs = _phonons_worker_state['fc']._calculate_phonons_at_q_block(
+        np.arange(qi, qf), args, return_eigenvectors=return_eigenvectors,
+        dtype=dtype)
+    arrays['rfreqs'][qi:qf] = freqs
+    if return_eigenvectors:
+        arrays['reigenvecs'][qi:qf] = evecs
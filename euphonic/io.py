@@ -1,9 +1,13 @@
 import copy
+import hashlib
 import json
 import os
+import tempfile
+import zipfile
 import numpy as np
 from pint import Quantity
 from euphonic import ureg
+from euphonic.util import _get_array_types
 
 
 def _to_json_dict(dictionary):
@@ -13,8 +17,10 @@ def _to_json_dict(dictionary):
     """
     for key, val in dictionary.items():
         if isinstance(val, np.ndarray):
-            if val.dtype == np.complex128:
-                val = val.view(np.float64).reshape(val.shape + (2,))
+            if np.iscomplexobj(val):
+                # Also converts single precision (complex64) arrays
+                val = val.astype(np.complex128, copy=False).view(
+                    np.float64).reshape(val.shape + (2,))
             dictionary[key] = val.tolist()
         elif isinstance(val, dict):
             dictionary[key] = _to_json_dict(val)
@@ -48,8 +54,9 @@ def _obj_to_dict(obj, attrs):
     dout = {}
     for attr in attrs:
         val = getattr(obj, attr)
-        if isinstance(val, np.ndarray):
-            val = np.copy(val)
+        if isinstance(val, tuple(_get_array_types())):
+            # Also reads any arrays stored on disk into memory
+            val = np.array(val)
         elif isinstance(val, list):
             val = val.copy()
 
@@ -100,3 +107,85 @@ def _obj_from_json_file(cls, filename, type_dict={}):
         obj_dict = json.loads(f.read())
     obj_dict = _from_json_dict(obj_dict, type_dict)
     return cls.from_dict(obj_dict)
+
+
+def _hash_arrays(*arrays):
+    """
+    Get a SHA-256 hex digest of the dtype, shape and content of each
+    array (or None), for use as a cache key
+    """
+    h = hashlib.sha256()
+    for arr in arrays:
+        if arr is None:
+            h.update(b'None')
+        else:
+            arr = np.ascontiguousarray(arr)
+            h.update(str((arr.dtype.str, arr.shape)).encode())
+            h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def _load_cache_npz(cache_dir, key):
+    """
+    Load the arrays stored in cache_dir under key by _save_cache_npz.
+    Returns a dictionary of arrays, or None if there is no valid cache
+    entry
+    """
+    filename = os.path.join(cache_dir, key + '.npz')
+    try:
+        with np.load(filename) as data:
+            arrays = {name: data[name] for name in data.files}
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+        return None
+    # Update the modification time, so the least recently used entries
+    # are evicted first
+    try:
+        os.utime(filename)
+    except OSError:
+        pass
+    return arrays
+
+
+def _save_cache_npz(cache_dir, key, arrays, max_size):
+    """
+    Save a dictionary of arrays to cache_dir under key as a .npz file,
+    then evict the least recently used entries until the total size of
+    the cache is at most max_size bytes
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file then rename, so other processes never
+    # read a partially written entry
+    fd, tmp_filename = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_filename, os.path.join(cache_dir, key + '.npz'))
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+    _evict_cache(cache_dir, max_size)
+
+
+def _evict_cache(cache_dir, max_size):
+    """
+    Remove the least recently used .npz files in cache_dir until their
+    total size is at most max_size bytes
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.npz'):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(entry[1] for entry in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            # May have already been removed by another process
+            pass
+        total_size -= size
@@ -0,0 +1,177 @@
+import numpy as np
+from pint import Quantity
+from euphonic import ureg
+from euphonic.crystal import Crystal
+from euphonic.spectra import Spectrum1D
+from euphonic.util import _check_constructor_inputs
+from euphonic.io import (_obj_to_json_file, _obj_from_json_file,
+                         _obj_to_dict, _process_dict)
+
+
+class QpointFrequencies(object):
+    """
+    A class to store phonon frequencies at specified q-points, without
+    any eigenvectors. This is useful when only the frequencies are
+    required (e.g. for dispersion plots or density of states), as
+    storing the eigenvectors requires a factor of ~n_atoms more memory
+
+    Attributes
+    ----------
+    crystal : Crystal
+        Lattice and atom information
+    n_qpts : int
+        Number of q-points in the object
+    qpts : (n_qpts, 3) float ndarray
+        Q-point coordinates, in fractional coordinates of the reciprocal
+        lattice
+    weights : (n_qpts,) float ndarray
+        The weight for each q-point
+    frequencies : (n_qpts, 3*crystal.n_atoms) float Quantity
+        Phonon frequencies per q-point and mode
+    """
+
+    def __init__(self, crystal, qpts, frequencies, weights=None):
+        """
+        Parameters
+        ----------
+        crystal : Crystal
+            Lattice and atom information
+        qpts : (n_qpts, 3) float ndarray
+            Q-point coordinates
+        frequencies: (n_qpts, 3*crystal.n_atoms) float Quantity
+            Phonon frequencies, ordered according to increasing q-point
+            number. Default units meV
+        weights : (n_qpts,) float ndarray, optional
+            The weight for each q-point. If None, equal weights are
+            assumed
+        """
+        _check_constructor_inputs(
+            [crystal, qpts], [Crystal, np.ndarray], [(), (-1, 3)],
+            ['crystal', 'qpts'])
+        n_at = crystal.n_atoms
+        n_qpts = len(qpts)
+        _check_constructor_inputs(
+            [frequencies, weights],
+            [Quantity, [np.ndarray, type(None)]],
+            [(n_qpts, 3*n_at), (n_qpts,)],
+            ['frequencies', 'weights'])
+        self.crystal = crystal
+        self.qpts = qpts
+        self.n_qpts = n_qpts
+        self._frequencies = frequencies.to(
+            ureg.INTERNAL_ENERGY_UNIT).magnitude
+        self.frequencies_unit = str(frequencies.units)
+
+        if weights is not None:
+            self.weights = weights
+        else:
+            self.weights = np.full(self.n_qpts, 1/self.n_qpts)
+
+    @property
+    def frequencies(self):
+        return self._frequencies*ureg(
+            'INTERNAL_ENERGY_UNIT').to(self.frequencies_unit)
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            if name in ['frequencies_unit']:
+                ureg(getattr(self, name)).to(value)
+        super(QpointFrequencies, self).__setattr__(name, value)
+
+    def calculate_dos(self, dos_bins):
+        """
+        Calculates a density of states
+
+        Parameters
+        ----------
+        dos_bins : (n_ebins + 1,) float Quantity
+            The energy bin edges to use for calculating the DOS
+
+        Returns
+        -------
+        dos : Spectrum1D
+            A spectrum containing the energy bins on the x-axis and dos
+            on the y-axis
+        """
+
+        freqs = self._frequencies
+        dos_bins_unit = dos_bins.units
+        dos_bins = dos_bins.to('INTERNAL_ENERGY_UNIT').magnitude
+        weights = np.repeat(self.weights[:, np.newaxis],
+                            3*self.crystal.n_atoms,
+                            axis=1)
+        dos, _ = np.histogram(freqs, dos_bins, weights=weights)
+
+        return Spectrum1D(
+            dos_bins*ureg('INTERNAL_ENERGY_UNIT').to(dos_bins_unit),
+            dos*ureg('dimensionless'))
+
+    def to_dict(self):
+        """
+        Convert to a dictionary. See QpointFrequencies.from_dict for
+        details on keys/values
+
+        Returns
+        -------
+        dict
+        """
+        dout = _obj_to_dict(self, ['crystal', 'n_qpts', 'qpts', 'frequencies',
+                                   'weights'])
+        return dout
+
+    def to_json_file(self, filename):
+        """
+        Write to a JSON file. JSON fields are equivalent to
+        QpointFrequencies.from_dict keys
+
+        Parameters
+        ----------
+        filename : str
+            Name of the JSON file to write to
+        """
+        _obj_to_json_file(self, filename)
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Convert a dictionary to a QpointFrequencies object
+
+        Parameters
+        ----------
+        d : dict
+            A dictionary with the following keys/values:
+
+            - 'crystal': dict, see Crystal.from_dict
+            - 'qpts': (n_qpts, 3) float ndarray
+            - 'frequencies': (n_qpts, 3*crystal.n_atoms) float ndarray
+            - 'frequencies_unit': str
+
+            There are also the following optional keys:
+
+            - 'weights': (n_qpts,) float ndarray
+
+        Returns
+        -------
+        QpointFrequencies
+        """
+        crystal = Crystal.from_dict(d['crystal'])
+        d = _process_dict(d, quantities=['frequencies'], optional=['weights'])
+        return QpointFrequencies(crystal, d['qpts'], d['frequencies'],
+                                 d['weights'])
+
+    @classmethod
+    def from_json_file(cls, filename):
+        """
+        Read from a JSON file. See QpointFrequencies.from_dict for
+        required fields
+
+        Parameters
+        ----------
+        filename : str
+            The file to read from
+
+        Returns
+        -------
+        QpointFrequencies
+        """
+        return _obj_from_json_file(cls, filename)
@@ -1,4 +1,5 @@
 import math
+import warnings
 import numpy as np
 from pint import Quantity
 from euphonic import ureg
@@ -7,7 +8,7 @@ from euphonic.spectra import Spectrum1D
 from euphonic.debye_waller import DebyeWaller
 from euphonic.structure_factor import StructureFactor
 from euphonic.util import (direction_changed, is_gamma,
-                           _check_constructor_inputs)
+                           _check_constructor_inputs, _get_array_types)
 from euphonic.io import (_obj_to_json_file, _obj_from_json_file,
                          _obj_to_dict, _process_dict)
 from euphonic.readers import castep, phonopy
@@ -31,8 +32,9 @@ class QpointPhononModes(object):
         The weight for each q-point
     frequencies : (n_qpts, 3*crystal.n_atoms) float Quantity
         Phonon frequencies per q-point and mode
-    eigenvectors : (n_qpts, 3*crystal.n_atoms, crystal.n_atoms, 3) complex ndarray
-        Dynamical matrix eigenvectors
+    eigenvectors : (n_qpts, 3*crystal.n_atoms, crystal.n_atoms, 3) complex ndarray or h5py.Dataset
+        Dynamical matrix eigenvectors. May be stored on disk, as a
+        numpy.memmap or h5py.Dataset
     """
 
     def __init__(self, crystal, qpts, frequencies, eigenvectors, weights=None):
@@ -46,8 +48,10 @@ class QpointPhononModes(object):
         frequencies: (n_qpts, 3*crystal.n_atoms) float Quantity
             Phonon frequencies, ordered according to increasing q-point
             number. Default units meV
-        eigenvectors: (n_qpts, 3*crystal.n_atoms, crystal.n_atoms, 3) complex ndarray
-            Dynamical matrix eigenvectors
+        eigenvectors: (n_qpts, 3*crystal.n_atoms, crystal.n_atoms, 3) complex ndarray or h5py.Dataset
+            Dynamical matrix eigenvectors. An h5py.Dataset is not read
+            into memory, the eigenvectors are read in chunks of
+            q-points when required
         weights : (n_qpts,) float ndarray, optional
             The weight for each q-point. If None, equal weights are
             assumed
@@ -59,7 +63,7 @@ class QpointPhononModes(object):
         n_qpts = len(qpts)
         _check_constructor_inputs(
             [frequencies, eigenvectors, weights],
-            [Quantity, np.ndarray, [np.ndarray, type(None)]],
+            [Quantity, _get_array_types(), [np.ndarray, type(None)]],
             [(n_qpts, 3*n_at), (n_qpts, 3*n_at, n_at, 3), (n_qpts,)],
             ['frequencies', 'eigenvectors', 'weights'])
         self.crystal = crystal
@@ -166,10 +170,12 @@ class QpointPhononModes(object):
         # Actually rearrange frequencies/eigenvectors
         for i in range(n_qpts):
             self._frequencies[i] = self._frequencies[i, mode_map[i]]
-            evec_tmp = np.copy(self.eigenvectors[i, mode_map[i]])
+            evec_tmp = np.copy(self.eigenvectors[i][mode_map[i]])
             self.eigenvectors[i] = evec_tmp
 
-    def calculate_structure_factor(self, scattering_lengths, dw=None):
+    def calculate_structure_factor(self, scattering_lengths, dw=None,
+                                   use_c=False, n_threads=1,
+                                   fall_back_on_python=True):
         """
         Calculate the one phonon inelastic scattering for neutrons at
         each q-point
@@ -182,6 +188,17 @@ class QpointPhononModes(object):
             {'O': 5.803*ureg('fm'), 'Zn': 5.680*ureg('fm')}
         dw : DebyeWaller
             A DebyeWaller exponent object
+        use_c : boolean, optional
+            Whether to use C instead of Python to calculate the
+            structure factor. The C implementation calculates each
+            q-point in turn without creating the (n_qpts, 3*n_atoms,
+            n_atoms) intermediate arrays
+        n_threads : int, optional
+            The number of OpenMP threads to use when looping over
+            q-points in C. Only applicable if use_c=True
+        fall_back_on_python : boolean, optional
+            If we cannot use the C extension, fall back on using python
+            if this is true, else raise an ImportCError.
 
         Returns
         -------
@@ -189,6 +206,12 @@ class QpointPhononModes(object):
             An object containing the structure factor for each q-point
             and phonon mode
 
+        Raises
+        ------
+        ImportCError
+            If we have selected not to fall back on Python and cannot
+            use the C extension
+
         Notes
         -----
 
@@ -220,22 +243,12 @@ class QpointPhononModes(object):
         # Calculate normalisation factor
         norm_factor = sl/np.sqrt(self.crystal._atom_mass)
 
-        # Calculate the exp factor for all atoms and qpts. atom_r is in
-        # fractional coords, so Qdotr = 2pi*qh*rx + 2pi*qk*ry...
-        exp_factor = np.exp(1J*2*math.pi*np.einsum(
-            'ij,kj->ik', self.qpts, self.crystal.atom_r))
-
         # Eigenvectors are in Cartesian so need to convert hkl to
         # Cartesian by computing dot with hkl and reciprocal lattice
         recip = self.crystal.reciprocal_cell().to(
             '1/INTERNAL_LENGTH_UNIT').magnitude
         Q = np.einsum('ij,jk->ik', self.qpts, recip)
 
-        # Calculate dot product of Q and eigenvectors for all branches
-        # atoms and q-points
-        eigenv_dot_q = np.einsum('ijkl,il->ijk', np.conj(self.eigenvectors), Q)
-
-        # Calculate Debye-Waller factors
         temperature = None
         if dw:
             temperature = dw.temperature
@@ -244,16 +257,78 @@ class QpointPhononModes(object):
                     'The DebyeWaller object used as dw is not '
                     'compatible with the QPointPhononModes object (they'
                     ' have a different number of atoms)'))
-            dw_factor = np.exp(-np.einsum('jkl,ik,il->ij',
-                                          dw._debye_waller, Q, Q))
-            exp_factor *= dw_factor
-
-        # Multiply Q.eigenvector, exp factor and normalisation factor
-        term = np.einsum('ijk,ik,k->ij', eigenv_dot_q, exp_factor, norm_factor)
 
-        # Take mod squared and divide by frequency to get intensity
-        sf = np.real(
-            np.absolute(term*np.conj(term))/np.absolute(self._frequencies))
+        if dw:
+            dw_exponent = dw._debye_waller
+        else:
+            dw_exponent = np.zeros((self.crystal.n_atoms, 3, 3))
+        sf = np.zeros(self._frequencies.shape)
+        # The eigenvectors may be stored on disk, so only read a chunk
+        # of q-points at a time
+        chunk = 1000
+        try:
+            if use_c:
+                try:
+                    import euphonic._euphonic as euphonic_c
+                    from euphonic.util import _ensure_contiguous_args
+                except ImportError:
+                    warnings.warn((
+                        'use_c=True is set, but the Euphonic\'s C '
+                        'extension couldn\'t be imported, it may not '
+                        'have been installed. Attempting to fall back '
+                        'to pure Python calculation'), stacklevel=2)
+                    raise
+            else:
+                raise ImportError
+            atom_r, norm_factor, dw_exponent = _ensure_contiguous_args(
+                self.crystal.atom_r, norm_factor, dw_exponent)
+            for qi in range(0, self.n_qpts, chunk):
+                qf = min(qi + chunk, self.n_qpts)
+                qpts, Q_chunk, freqs, eigenvecs = _ensure_contiguous_args(
+                    self.qpts[qi:qf], Q[qi:qf], self._frequencies[qi:qf],
+                    self.eigenvectors[qi:qf])
+                euphonic_c.calculate_structure_factor(
+                    qpts, Q_chunk, atom_r, norm_factor, freqs, eigenvecs,
+                    dw_exponent, 1 if dw else 0, sf[qi:qf], n_threads)
+        except ImportError:
+            if not fall_back_on_python:
+                from euphonic.force_constants import ImportCError
+                raise ImportCError((
+                    'use_c=True is set, but the Euphonic\'s C extension'
+                    ' couldn\'t be imported, it may not have been '
+                    'installed. You have selected not to fall back on '
+                    'Python, therefore we cannot complete the '
+                    'calculation.'))
+            for qi in range(0, self.n_qpts, chunk):
+                qf = min(qi + chunk, self.n_qpts)
+                # Calculate the exp factor for all atoms and qpts.
+                # atom_r is in fractional coords, so
+                # Qdotr = 2pi*qh*rx + 2pi*qk*ry...
+                exp_factor = np.exp(1J*2*math.pi*np.einsum(
+                    'ij,kj->ik', self.qpts[qi:qf], self.crystal.atom_r))
+
+                # Calculate dot product of Q and eigenvectors for all
+                # branches atoms and q-points
+                eigenv_dot_q = np.einsum('ijkl,il->ijk',
+                                         np.conj(self.eigenvectors[qi:qf]),
+                                         Q[qi:qf])
+
+                # Calculate Debye-Waller factors
+                if dw:
+                    dw_factor = np.exp(-np.einsum(
+                        'jkl,ik,il->ij', dw_exponent, Q[qi:qf], Q[qi:qf]))
+                    exp_factor *= dw_factor
+
+                # Multiply Q.eigenvector, exp factor and normalisation
+                # factor
+                term = np.einsum('ijk,ik,k->ij', eigenv_dot_q, exp_factor,
+                                 norm_factor)
+
+                # Take mod squared and divide by frequency to get
+                # intensity
+                sf[qi:qf] = np.real(
+                    np.absolute(term*np.conj(term))/np.absolute(
+                        self._frequencies[qi:qf]))
 
         return StructureFactor(
             self.crystal, self.qpts, self.frequencies,
@@ -261,7 +336,8 @@ class QpointPhononModes(object):
                 self.crystal.cell_vectors.units**2),
             temperature=temperature)
 
-    def calculate_debye_waller(self, temperature):
+    def calculate_debye_waller(self, temperature, use_c=False,
+                               n_threads=1, fall_back_on_python=True):
         """
         Calculate the 3 x 3 Debye-Waller exponent for each atom over the
         q-points contained in this object
@@ -270,6 +346,15 @@ class QpointPhononModes(object):
         ----------
         temperature : float Quantity
             Temperature
+        use_c : boolean, optional
+            Whether to use C instead of Python to calculate the
+            Debye-Waller exponent
+        n_threads : int, optional
+            The number of OpenMP threads to use when looping over
+            q-points in C. Only applicable if use_c=True
+        fall_back_on_python : boolean, optional
+            If we cannot use the C extension, fall back on using python
+            if this is true, else raise an ImportCError.
 
         Returns
         -------
@@ -277,6 +362,12 @@ class QpointPhononModes(object):
             An object containing the 3x3 Debye-Waller exponent for each
             atom
 
+        Raises
+        ------
+        ImportCError
+            If we have selected not to fall back on Python and cannot
+            use the C extension
+
         Notes
         -----
 
@@ -336,23 +427,55 @@ class QpointPhononModes(object):
             freq_term = 1/(freqs*np.tanh(x))
         else:
             freq_term = 1/(freqs)
+        # Weight for the e.e* term of each q-point and mode
+        coeffs = weights[:, np.newaxis]*freq_term*freq_mask
         dw = np.zeros((n_atoms, 3, 3))
-        # Calculating the e.e* term is expensive, do in chunks
         chunk = 1000
-        for i in range(int((len(qpts) - 1)/chunk) + 1):
-            qi = i*chunk
-            qf = min((i + 1)*chunk, len(qpts))
-
-            evec_term = np.real(
-                np.einsum('ijkl,ijkm->ijklm',
-                          evecs[qi:qf],
-                          np.conj(evecs[qi:qf])))
-
-            dw += (np.einsum('i,k,ij,ij,ijklm->klm',
-                             weights[qi:qf], mass_term, freq_term[qi:qf],
-                             freq_mask[qi:qf], evec_term))
-
-        dw = dw/np.sum(weights)
+        try:
+            if use_c:
+                try:
+                    import euphonic._euphonic as euphonic_c
+                    from euphonic.util import _ensure_contiguous_args
+                except ImportError:
+                    warnings.warn((
+                        'use_c=True is set, but the Euphonic\'s C '
+                        'extension couldn\'t be imported, it may not '
+                        'have been installed. Attempting to fall back '
+                        'to pure Python calculation'), stacklevel=2)
+                    raise
+            else:
+                raise ImportError
+            # The eigenvectors may be stored on disk, so only read a
+            # chunk of q-points at a time. The C function adds each
+            # chunk's contribution to dw
+            for qi in range(0, len(qpts), chunk):
+                qf = min(qi + chunk, len(qpts))
+                evec_chunk, coeff_chunk = _ensure_contiguous_args(
+                    evecs[qi:qf], coeffs[qi:qf])
+                euphonic_c.calculate_debye_waller(evec_chunk, coeff_chunk,
+                                                  dw, n_threads)
+        except ImportError:
+            if not fall_back_on_python:
+                from euphonic.force_constants import ImportCError
+                raise ImportCError((
+                    'use_c=True is set, but the Euphonic\'s C extension'
+                    ' couldn\'t be imported, it may not have been '
+                    'installed. You have selected not to fall back on '
+                    'Python, therefore we cannot complete the '
+                    'calculation.'))
+            # Sum e.e* over modes and q-points in chunks, as a batched
+            # matrix product over atoms of (3, n_modes) eigenvector
+            # components, to avoid creating the outer product of the
+            # eigenvectors for every mode
+            for qi in range(0, len(qpts), chunk):
+                qf = min(qi + chunk, len(qpts))
+                evec_chunk = evecs[qi:qf].reshape(
+                    -1, n_atoms, 3).transpose(1, 2, 0)
+                dw += np.real(np.matmul(
+                    evec_chunk*coeffs[qi:qf].reshape(-1),
+                    np.conj(evec_chunk).transpose(0, 2, 1)))
+
+        dw = mass_term[:, np.newaxis, np.newaxis]*dw/np.sum(weights)
         dw *= ureg('INTERNAL_LENGTH_UNIT**2').to(
             self.crystal.cell_vectors_unit + '**2')
 
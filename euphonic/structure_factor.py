@@ -170,14 +170,14 @@ class StructureFactor(object):
         freqs = self._frequencies
         e_bins_internal = e_bins.to('INTERNAL_ENERGY_UNIT').magnitude
 
-        # Create initial sqw_map with an extra an energy bin either
-        # side, for any branches that fall outside the energy bin range
-        sqw_map = np.zeros((self.n_qpts, len(e_bins) + 1))
         sf = self._structure_factors
         if calc_bose and temperature is not None:
-            p_intensity = sf*_bose_factor(freqs, temperature.to('K').magnitude)
-            n_intensity = sf*_bose_factor(
-                -freqs, temperature.to('K').magnitude)
+            # The Bose factors for freqs and -freqs only differ by which
+            # modes have the +1, so only calculate the occupation once
+            occupation = _bose_factor(-np.absolute(freqs),
+                                      temperature.to('K').magnitude)
+            p_intensity = sf*(occupation + (freqs > 0))
+            n_intensity = sf*(occupation + (freqs < 0))
         else:
             p_intensity = sf
             n_intensity = sf
@@ -185,11 +185,19 @@ class StructureFactor(object):
         p_bin = np.digitize(freqs, e_bins_internal)
         n_bin = np.digitize(-freqs, e_bins_internal)
 
-        # Sum intensities into bins
-        first_index = np.transpose(
-            np.tile(range(self.n_qpts), (3*self.crystal.n_atoms, 1)))
-        np.add.at(sqw_map, (first_index, p_bin), p_intensity)
-        np.add.at(sqw_map, (first_index, n_bin), n_intensity)
+        # Sum intensities into bins for both energy branches with a
+        # single bincount, using a flat index into a sqw_map with an
+        # extra energy bin either side, for any branches that fall
+        # outside the energy bin range
+        n_map_bins = len(e_bins) + 1
+        q_offset = n_map_bins*np.arange(self.n_qpts)[:, np.newaxis]
+        sqw_map = np.bincount(
+            np.concatenate(((p_bin + q_offset).ravel(),
+                            (n_bin + q_offset).ravel())),
+            weights=np.concatenate((p_intensity.ravel(),
+                                    n_intensity.ravel())),
+            minlength=self.n_qpts*n_map_bins).reshape(
+                self.n_qpts, n_map_bins)
         # Exclude values outside ebin range
         sqw_map = sqw_map[:, 1:-1]*ureg('INTERNAL_LENGTH_UNIT**2').to(
             self.structure_factors_unit)
@@ -1,4 +1,5 @@
 import math
+import sys
 import numpy as np
 import seekpath
 from euphonic import ureg
@@ -401,6 +402,26 @@ def _distribution_2d(xbins, ybins, xwidth, ywidth, shape='gauss', extent=3.0):
     return dist
 
 
+def _get_array_types():
+    """
+    Get the types that can be used for large arrays which may be
+    stored on disk (e.g. eigenvectors). numpy.ndarray includes
+    numpy.memmap. h5py.Dataset is only included if h5py has already
+    been imported, as a Dataset can't exist otherwise, and h5py is
+    imported as late as possible (see euphonic.readers.phonopy)
+
+    Returns
+    -------
+    types : list of types
+        The accepted array types
+    """
+    types = [np.ndarray]
+    h5py = sys.modules.get('h5py')
+    if h5py is not None:
+        types.append(h5py.Dataset)
+    return types
+
+
 def _check_constructor_inputs(objs, types, shapes, names):
     """
     Make sure all the inputs are all the expected type, and if they are
@@ -494,7 +515,9 @@ def _ensure_contiguous_args(*args):
     """
     Make sure all arguments are C Contiguous and of the correct type
     (int32, float64, complex128). This should only be used internally,
-    and called before any calls to Euphonic C extension functions
+    and called before any calls to Euphonic C extension functions.
+    complex64 arrays (e.g. single precision eigenvectors) are kept as
+    complex64, so the C function must check their type
     Example use: arr1, arr2 = _ensure_contiguous_args(arr1, arr2)
 
     Parameters
@@ -532,6 +555,8 @@ def _get_dtype(arr):
        return np.int32
    elif np.issubdtype(arr.dtype, np.floating):
        return np.float64
+   elif arr.dtype == np.complex64:
+       return np.complex64
    elif np.issubdtype(arr.dtype, np.complexfloating):
        return np.complex128
    return None
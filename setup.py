@@ -27,7 +27,8 @@ def get_c_extension():
     import subprocess
     include_dirs = [np.get_include(), 'c']
     sources = ['c/_euphonic.c', 'c/dyn_mat.c', 'c/util.c', 'c/py_util.c',
-               'c/load_libs.c']
+               'c/load_libs.c', 'c/structure_factor.c',
+               'c/debye_waller.c']
     if platform == 'win32':
         # Windows - assume MSVC compiler
         compile_args = ['/openmp']
@@ -89,6 +90,7 @@ def run_setup(build_c=True):
             'numpy>=1.9.1',
             'scipy>=1.0.0',
             'seekpath>=1.1.0',
+            'spglib>=1.9.4',
             'pint>=0.10.1'
         ],
         extras_require={
@@ -334,3 +334,25 @@ class TestObjectMethods:
             vol.to('angstrom**3').magnitude,
             expected_vol.to('angstrom**3').magnitude
         )
+
+    @pytest.mark.parametrize("crystal,expected_n_ops", [
+        (get_quartz_crystal(), 6),
+        (get_lzo_crystal(), 48)
+    ])
+    def test_get_symmetry_operations(self, crystal, expected_n_ops):
+        rotations, translations = crystal.get_symmetry_operations()
+        assert rotations.shape == (expected_n_ops, 3, 3)
+        assert translations.shape == (expected_n_ops, 3)
+        assert np.any(np.all(rotations == np.identity(3), axis=(1, 2)))
+        # Every operation should map the atoms onto atoms of the same
+        # type
+        for rot, trans in zip(rotations, translations):
+            atom_r_rot = np.einsum('ij,kj->ki', rot, crystal.atom_r) + trans
+            dr = atom_r_rot[:, np.newaxis] - crystal.atom_r
+            dr -= np.rint(dr)
+            match = np.argmin(np.linalg.norm(dr, axis=-1), axis=-1)
+            npt.assert_allclose(
+                np.linalg.norm(dr[np.arange(crystal.n_atoms), match],
+                               axis=-1), 0, atol=1e-5)
+            npt.assert_array_equal(crystal.atom_type[match],
+                                   crystal.atom_type)
@@ -1,8 +1,14 @@
 import pytest
 import numpy as np
 import numpy.testing as npt
-from euphonic import ureg, ForceConstants
+from euphonic import ureg, ForceConstants, QpointFrequencies
+from euphonic import force_constants
+from euphonic.util import mp_grid, _calc_abscissa
+import mmap
 import os
+import sys
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 from tests_and_analysis.test.utils import get_data_path
 import json
 
@@ -327,3 +333,952 @@ class TestCalculateQPointPhononModes:
             test_expected_freqs.to('hartree').magnitude,
             atol=atol
         )
+
+
+@pytest.mark.integration
+class TestIterQPointPhononModes:
+
+    @pytest.fixture(params=[
+        ("quartz", {"asr": "reciprocal", "splitting": True},
+         quartz_split_qpts),
+        ("quartz", {"asr": "reciprocal", "splitting": True,
+                    "use_c": True, "fall_back_on_python": False},
+         quartz_split_qpts),
+        ("quartz", {"asr": "reciprocal", "splitting": True,
+                    "insert_gamma": True},
+         quartz_split_qpts_insert_gamma),
+        ("graphite", {}, lzo_and_graphite_materials[1]["qpts"])])
+    def create_fc_and_kwargs(self, request):
+        material, kwargs, qpts = request.param
+        filename = os.path.join(
+            get_data_path(), "force_constants", material,
+            f"{material}_force_constants.json")
+        fc = ForceConstants.from_json_file(filename)
+        return fc, kwargs, qpts
+
+    @pytest.mark.parametrize("chunk_size", [1, 2, 5, 100])
+    def test_iter_chunks_equal_calculate_qpoint_phonon_modes(
+            self, create_fc_and_kwargs, chunk_size):
+        fc, kwargs, qpts = create_fc_and_kwargs
+        expected = fc.calculate_qpoint_phonon_modes(qpts, **kwargs)
+        chunks = list(fc.iter_qpoint_phonon_modes(
+            qpts, chunk_size=chunk_size, **kwargs))
+        assert all(chunk.n_qpts <= chunk_size for chunk in chunks)
+        npt.assert_allclose(
+            np.concatenate([chunk.qpts for chunk in chunks]), expected.qpts)
+        npt.assert_allclose(
+            np.concatenate([chunk.frequencies.to('hartree').magnitude
+                            for chunk in chunks]),
+            expected.frequencies.to('hartree').magnitude,
+            atol=1e-10)
+        npt.assert_allclose(
+            np.concatenate([chunk.weights for chunk in chunks]),
+            expected.weights)
+
+
+@pytest.mark.integration
+class TestCalculateQPointFrequencies:
+
+    @pytest.fixture(
+        params=lzo_and_graphite_test_data + quartz_test_data + nacl_test_data
+    )
+    def create_fc_and_formulate_args(self, request):
+        test_data = request.param
+        kwargs = dict(test_data["kwargs"])
+        kwargs["qpts"] = test_data["qpts"]
+        filename = os.path.join(get_data_path(), test_data["json_file"])
+        fc = ForceConstants.from_json_file(filename)
+        return fc, kwargs, test_data["atol"]
+
+    def test_fc_calculate_qpoint_frequencies_same_as_phonon_modes(
+            self, create_fc_and_formulate_args):
+        fc, kwargs, atol = create_fc_and_formulate_args
+        qpoint_frequencies = fc.calculate_qpoint_frequencies(**kwargs)
+        qpoint_phonon_modes = fc.calculate_qpoint_phonon_modes(**kwargs)
+        assert isinstance(qpoint_frequencies, QpointFrequencies)
+        npt.assert_allclose(qpoint_frequencies.qpts, qpoint_phonon_modes.qpts)
+        npt.assert_allclose(
+            qpoint_frequencies.frequencies.to('hartree').magnitude,
+            qpoint_phonon_modes.frequencies.to('hartree').magnitude,
+            atol=atol
+        )
+
+
+@pytest.mark.integration
+class TestCalculateQPointPhononModesBlocks:
+
+    @pytest.fixture(params=[
+        ("quartz", {"asr": "reciprocal", "splitting": True},
+         quartz_split_qpts),
+        ("quartz", {"asr": "realspace", "dipole": False},
+         quartz_split_qpts),
+        ("graphite", {}, lzo_and_graphite_materials[1]["qpts"])])
+    def create_fc_and_kwargs(self, request):
+        material, kwargs, qpts = request.param
+        filename = os.path.join(
+            get_data_path(), "force_constants", material,
+            f"{material}_force_constants.json")
+        fc = ForceConstants.from_json_file(filename)
+        return fc, kwargs, qpts
+
+    @pytest.mark.parametrize("block_size", [1, 3])
+    def test_python_blocks_equal_single_block(
+            self, create_fc_and_kwargs, block_size, monkeypatch):
+        fc, kwargs, qpts = create_fc_and_kwargs
+        expected = fc.calculate_qpoint_phonon_modes(qpts, **kwargs)
+        monkeypatch.setattr(ForceConstants, '_get_qpt_block_size',
+                            lambda self, *args: block_size)
+        qpt_ph_modes = fc.calculate_qpoint_phonon_modes(qpts, **kwargs)
+        npt.assert_allclose(
+            qpt_ph_modes.frequencies.to('hartree').magnitude,
+            expected.frequencies.to('hartree').magnitude,
+            atol=1e-10)
+
+
+@pytest.mark.integration
+class TestCalculateQPointPhononModesNProcs:
+
+    @pytest.fixture(params=[
+        ("quartz", {"asr": "reciprocal", "splitting": True},
+         quartz_split_qpts),
+        ("graphite", {"asr": "realspace"},
+         lzo_and_graphite_materials[1]["qpts"])])
+    def create_fc_and_kwargs(self, request):
+        material, kwargs, qpts = request.param
+        filename = os.path.join(
+            get_data_path(), "force_constants", material,
+            f"{material}_force_constants.json")
+        with ForceConstants.from_json_file(filename) as fc:
+            yield fc, kwargs, qpts
+
+    @staticmethod
+    def dyn_mats(qpt_ph_modes):
+        freqs = qpt_ph_modes.frequencies.to('hartree').magnitude
+        evecs = np.reshape(qpt_ph_modes.eigenvectors,
+                           (qpt_ph_modes.n_qpts, freqs.shape[1], -1))
+        return np.einsum('qm,qmi,qmj->qij', freqs*np.abs(freqs),
+                         evecs, np.conj(evecs))
+
+    def test_n_procs_phonon_modes_equal_single_process(
+            self, create_fc_and_kwargs):
+        fc, kwargs, qpts = create_fc_and_kwargs
+        expected = fc.calculate_qpoint_phonon_modes(qpts, **kwargs)
+        qpt_ph_modes = fc.calculate_qpoint_phonon_modes(
+            qpts, n_procs=2, **kwargs)
+        npt.assert_allclose(
+            qpt_ph_modes.frequencies.to('hartree').magnitude,
+            expected.frequencies.to('hartree').magnitude,
+            atol=1e-10)
+        # Eigenvectors of degenerate modes are not unique, so compare
+        # the dynamical matrices reconstructed from the eigenvectors
+        npt.assert_allclose(self.dyn_mats(qpt_ph_modes),
+                            self.dyn_mats(expected), atol=1e-10)
+
+    def test_n_procs_frequencies_equal_single_process(
+            self, create_fc_and_kwargs):
+        fc, kwargs, qpts = create_fc_and_kwargs
+        expected = fc.calculate_qpoint_frequencies(qpts, **kwargs)
+        qpt_freqs = fc.calculate_qpoint_frequencies(
+            qpts, n_procs=2, **kwargs)
+        npt.assert_allclose(
+            qpt_freqs.frequencies.to('hartree').magnitude,
+            expected.frequencies.to('hartree').magnitude,
+            atol=1e-10)
+
+    def test_n_procs_process_pool_is_reused(self, create_fc_and_kwargs):
+        fc, kwargs, qpts = create_fc_and_kwargs
+        fc.calculate_qpoint_frequencies(qpts, n_procs=2, **kwargs)
+        pools = [setup['process_pool'] for setup in fc._setup_cache.values()]
+        assert len(pools) == 1
+        list(fc.iter_qpoint_phonon_modes(qpts, chunk_size=2, n_procs=2,
+                                         **kwargs))
+        fc.calculate_qpoint_phonon_modes(qpts, chunk_size=3, n_procs=2,
+                                         **kwargs)
+        assert [setup['process_pool'] for setup in
+                fc._setup_cache.values()] == pools
+
+    def test_n_procs_eigenvectors_are_not_copied(
+            self, create_fc_and_kwargs):
+        fc, kwargs, qpts = create_fc_and_kwargs
+        qpt_ph_modes = fc.calculate_qpoint_phonon_modes(
+            qpts, n_procs=2, reduce_qpts=False, **kwargs)
+        assert isinstance(qpt_ph_modes.eigenvectors.base, mmap.mmap)
+
+    def test_close_unlinks_shared_memory(self, create_fc_and_kwargs):
+        fc, kwargs, qpts = create_fc_and_kwargs
+        fc.calculate_qpoint_frequencies(qpts, **kwargs)
+        setup, = fc._setup_cache.values()
+        fc_img_weighted = setup['fc_img_weighted']
+        with fc:
+            fc.calculate_qpoint_frequencies(qpts, n_procs=2, **kwargs)
+            names = [shm.name for shm in setup['process_pool'].shms]
+        assert setup['fc_img_weighted'] is fc_img_weighted
+        assert 'process_pool' not in setup
+        for name in names:
+            with pytest.raises(FileNotFoundError):
+                force_constants.shared_memory.SharedMemory(name=name)
+        # A new pool is created if the object is used after closing
+        qpt_freqs = fc.calculate_qpoint_frequencies(qpts, n_procs=2,
+                                                    **kwargs)
+        assert 'process_pool' in setup
+        fc.close()
+        assert np.all(np.isfinite(qpt_freqs.frequencies.magnitude))
+
+    def test_n_procs_memmap_out(self, create_fc_and_kwargs, tmpdir):
+        fc, kwargs, qpts = create_fc_and_kwargs
+        expected = fc.calculate_qpoint_phonon_modes(
+            qpts, reduce_qpts=False, **kwargs)
+        out = np.memmap(str(tmpdir.join('evecs.dat')), dtype=np.complex128,
+                        mode='w+', shape=expected.eigenvectors.shape)
+        qpt_ph_modes = fc.calculate_qpoint_phonon_modes(
+            qpts, n_procs=2, reduce_qpts=False, out=out, **kwargs)
+        assert qpt_ph_modes.eigenvectors is out
+        npt.assert_allclose(self.dyn_mats(qpt_ph_modes),
+                            self.dyn_mats(expected), atol=1e-10)
+
+    def test_n_procs_without_shared_memory_warns(
+            self, create_fc_and_kwargs, monkeypatch):
+        fc, kwargs, qpts = create_fc_and_kwargs
+        monkeypatch.setattr(force_constants, 'shared_memory', None)
+        with pytest.warns(UserWarning):
+            fc.calculate_qpoint_frequencies(qpts, n_procs=2, **kwargs)
+
+
+@pytest.mark.unit
+class TestCalculateSupercellImages:
+
+    fc_files = {
+        'LZO': os.path.join('force_constants', 'LZO',
+                            'lzo_force_constants.json'),
+        'graphite': os.path.join('force_constants', 'graphite',
+                                 'graphite_force_constants.json'),
+        'quartz': os.path.join('force_constants', 'quartz',
+                               'quartz_force_constants.json'),
+        'NaCl': os.path.join('phonopy_data', 'NaCl', 'force_constants',
+                             'phonopy-yaml.json')}
+
+    @pytest.fixture(params=['LZO', 'graphite', 'quartz', 'NaCl'])
+    def create_fc(self, request):
+        filename = os.path.join(get_data_path(), self.fc_files[request.param])
+        fc = ForceConstants.from_json_file(filename)
+        fc._calculate_supercell_images(2)
+        return fc
+
+    @pytest.mark.parametrize('material', ['LZO', 'graphite', 'NaCl'])
+    def test_sc_images_equal_expected(self, material):
+        filename = os.path.join(get_data_path(), self.fc_files[material])
+        fc = ForceConstants.from_json_file(filename)
+        fc._calculate_supercell_images(2)
+        with open(os.path.join(get_data_path(), 'force_constants',
+                               'expected_sc_images.json')) as f:
+            expected = json.load(f)[material]
+        npt.assert_array_equal(fc._n_sc_images, expected['n_sc_images'])
+        npt.assert_array_equal(fc._sc_image_i, expected['sc_image_i'])
+
+    def test_sc_image_offsets_consistent_with_n_sc_images(self, create_fc):
+        fc = create_fc
+        assert fc._sc_image_offsets[0] == 0
+        npt.assert_array_equal(np.diff(fc._sc_image_offsets),
+                               fc._n_sc_images.ravel())
+        assert fc._sc_image_offsets[-1] == len(fc._sc_image_i)
+
+    def test_sc_image_i_in_range(self, create_fc):
+        fc = create_fc
+        assert np.all(fc._sc_image_i >= 0)
+        assert np.all(fc._sc_image_i < 5**3)
+        assert np.all(fc._n_sc_images > 0)
+
+
+@pytest.mark.integration
+class TestCalculateQPointPhononModesCache:
+
+    @pytest.fixture(params=[
+        ("quartz", {"asr": "reciprocal", "eta_scale": 0.75},
+         quartz_split_qpts),
+        ("graphite", {"asr": "realspace"},
+         lzo_and_graphite_materials[1]["qpts"])])
+    def create_fc_filename_and_kwargs(self, request):
+        material, kwargs, qpts = request.param
+        filename = os.path.join(
+            get_data_path(), "force_constants", material,
+            f"{material}_force_constants.json")
+        return filename, kwargs, qpts
+
+    def test_cached_setup_is_reused_and_gives_same_result(
+            self, create_fc_filename_and_kwargs, tmpdir, monkeypatch):
+        filename, kwargs, qpts = create_fc_filename_and_kwargs
+        expected = ForceConstants.from_json_file(
+            filename).calculate_qpoint_phonon_modes(qpts, **kwargs)
+        ForceConstants.from_json_file(filename).calculate_qpoint_phonon_modes(
+            qpts, cache_dir=str(tmpdir), **kwargs)
+        assert len(tmpdir.listdir()) > 0
+
+        def fail(*args, **kwargs):
+            raise AssertionError('Should have been read from cache')
+        for method in ['_calculate_supercell_images',
+                       '_dipole_correction_init', '_enforce_realspace_asr']:
+            monkeypatch.setattr(ForceConstants, method, fail)
+        qpt_ph_modes = ForceConstants.from_json_file(
+            filename).calculate_qpoint_phonon_modes(
+                qpts, cache_dir=str(tmpdir), **kwargs)
+        npt.assert_allclose(qpt_ph_modes.frequencies.magnitude,
+                            expected.frequencies.magnitude)
+
+    def test_different_eta_scale_not_read_from_cache(self, tmpdir):
+        filename = os.path.join(get_data_path(), "force_constants", "quartz",
+                                "quartz_force_constants.json")
+        for eta_scale in [0.75, 1.0]:
+            fc = ForceConstants.from_json_file(filename)
+            fc.calculate_qpoint_frequencies(
+                quartz_split_qpts, eta_scale=eta_scale, cache_dir=str(tmpdir))
+        fnames = [f.basename for f in tmpdir.listdir()]
+        assert sum('_dipole_' in fname for fname in fnames) == 2
+
+    def test_cache_max_size_evicts_entries(
+            self, create_fc_filename_and_kwargs, tmpdir):
+        filename, kwargs, qpts = create_fc_filename_and_kwargs
+        fc = ForceConstants.from_json_file(filename)
+        fc.calculate_qpoint_frequencies(
+            qpts, cache_dir=str(tmpdir), cache_max_size=0, **kwargs)
+        assert len(tmpdir.listdir()) == 0
+
+
+@pytest.mark.integration
+class TestCalculateQPointPhononModesSetupReuse:
+
+    @pytest.fixture
+    def quartz_fc(self):
+        filename = os.path.join(get_data_path(), "force_constants", "quartz",
+                                "quartz_force_constants.json")
+        return ForceConstants.from_json_file(filename)
+
+    def test_repeated_calls_reuse_setup(self, quartz_fc, monkeypatch):
+        fc = quartz_fc
+        kwargs = {'asr': 'reciprocal', 'eta_scale': 0.75}
+        expected = fc.calculate_qpoint_phonon_modes(quartz_split_qpts,
+                                                    **kwargs)
+
+        def fail(*args, **kwargs):
+            raise AssertionError('Setup should have been reused')
+        for method in ['_calculate_supercell_images',
+                       '_dipole_correction_init', '_enforce_reciprocal_asr']:
+            monkeypatch.setattr(ForceConstants, method, fail)
+        qpt_ph_modes = fc.calculate_qpoint_phonon_modes(quartz_split_qpts,
+                                                        **kwargs)
+        npt.assert_allclose(qpt_ph_modes.frequencies.magnitude,
+                            expected.frequencies.magnitude)
+
+    def test_alternating_eta_scale_gives_same_result_as_new_object(
+            self, quartz_fc):
+        fc = quartz_fc
+        for eta_scale in [0.75, 1.0, 0.75]:
+            qpt_freqs = fc.calculate_qpoint_frequencies(
+                quartz_split_qpts, eta_scale=eta_scale)
+            assert fc._eta_scale == eta_scale
+            expected = ForceConstants.from_json_file(
+                os.path.join(get_data_path(), "force_constants", "quartz",
+                             "quartz_force_constants.json")
+            ).calculate_qpoint_frequencies(
+                quartz_split_qpts, eta_scale=eta_scale)
+            npt.assert_allclose(qpt_freqs.frequencies.magnitude,
+                                expected.frequencies.magnitude)
+
+
+@pytest.mark.unit
+class TestCalculateDipoleCorrections:
+
+    @pytest.fixture(params=[0.75, 1.0])
+    def quartz_fc(self, request):
+        filename = os.path.join(get_data_path(), "force_constants", "quartz",
+                                "quartz_force_constants.json")
+        fc = ForceConstants.from_json_file(filename)
+        fc._dipole_correction_init(eta_scale=request.param)
+        return fc
+
+    def test_batched_equals_single_qpt(self, quartz_fc):
+        fc = quartz_fc
+        qpts = np.concatenate((quartz_split_qpts,
+                               [[0.1, -0.2, 1.3], [1., 0., -1.]]))
+        corrs = fc._calculate_dipole_corrections(qpts)
+        assert corrs.shape == (len(qpts), 3*fc.crystal.n_atoms,
+                               3*fc.crystal.n_atoms)
+        for qpt, corr in zip(qpts, corrs):
+            npt.assert_allclose(corr, fc._calculate_dipole_correction(qpt),
+                                atol=1e-14)
+
+    @pytest.mark.parametrize('qpt', [[1 + 1e-16, 0., 0.],
+                                     [1 + 2e-16, 0., 0.],
+                                     [-2e-16, 0., 1.]])
+    def test_qpt_within_rounding_of_gamma_equals_gamma(self, quartz_fc, qpt):
+        qpts = np.array([qpt, [0., 0., 0.]])
+        qpt_ph_modes = quartz_fc.calculate_qpoint_phonon_modes(
+            qpts, splitting=False, reduce_qpts=False)
+        npt.assert_allclose(qpt_ph_modes.frequencies[0].magnitude,
+                            qpt_ph_modes.frequencies[1].magnitude,
+                            atol=1e-8)
+
+    def test_corrections_are_hermitian_and_finite(self, quartz_fc):
+        corrs = quartz_fc._calculate_dipole_corrections(quartz_split_qpts)
+        assert np.all(np.isfinite(corrs))
+        npt.assert_allclose(corrs, np.conj(np.transpose(corrs, (0, 2, 1))),
+                            atol=1e-14)
+
+
+@pytest.mark.unit
+class TestEnforceRealspaceAsr:
+
+    @staticmethod
+    def get_fc(material):
+        return ForceConstants.from_json_file(os.path.join(
+            get_data_path(), TestCalculateSupercellImages.fc_files[material]))
+
+    @staticmethod
+    def dense_realspace_asr(fc):
+        # Reference implementation, shifting the acoustic modes of the
+        # full supercell force constants matrix
+        n_cells = fc.n_cells_in_sc
+        n = 3*fc.crystal.n_atoms
+        origins = np.einsum('ij,kj->ik', fc.cell_origins,
+                            np.linalg.inv(np.transpose(fc.sc_matrix)))
+        # rel[i, j] is the cell equivalent to origin j - origin i
+        diff = (origins[np.newaxis, :, np.newaxis]
+                - origins[:, np.newaxis, np.newaxis]
+                - origins[np.newaxis, np.newaxis])
+        diff -= np.rint(diff)
+        rel = np.argmin(np.sum(np.abs(diff), axis=-1), axis=-1)
+        sq_fc = np.reshape(
+            np.transpose(fc._force_constants[rel], (0, 3, 1, 2)),
+            (n_cells*n, n_cells*n))
+        evals, evecs = np.linalg.eigh(sq_fc, UPLO='U')
+        c_of_m_disp_sq = np.sum(np.abs(np.sum(
+            np.reshape(evecs, (-1, 3, n_cells*n)), axis=0))**2, axis=0)
+        fc_tol = 1e-8*np.min(np.abs(evals))
+        for ac in np.argsort(c_of_m_disp_sq)[-3:]:
+            sq_fc -= (fc_tol + evals[ac])*np.outer(evecs[:, ac],
+                                                   evecs[:, ac])
+        return np.reshape(sq_fc[:, :n], (n_cells, n, n))
+
+    # The NaCl force constants aren't symmetric, so only the upper
+    # triangle of the supercell matrix is used
+    @pytest.mark.parametrize('material', ['LZO', 'graphite', 'NaCl'])
+    def test_equals_dense_supercell_correction(self, material):
+        fc = self.get_fc(material)
+        expected = self.dense_realspace_asr(fc)
+        npt.assert_allclose(fc._enforce_realspace_asr(), expected,
+                            atol=1e-12*np.max(np.abs(expected)))
+
+    @pytest.mark.parametrize('material', ['LZO', 'graphite'])
+    def test_acoustic_modes_are_zero_at_gamma(self, material):
+        fc = self.get_fc(material)
+        fc_asr = fc._enforce_realspace_asr()
+        evals = np.linalg.eigvalsh(np.sum(fc_asr, axis=0))
+        max_eval = np.max(np.abs(evals))
+        assert np.sum(np.abs(evals) < 1e-10*max_eval) == 3
+
+
+@pytest.mark.integration
+class TestCalculateQPointPhononModesAutoEta:
+
+    @pytest.fixture
+    def quartz_fc(self):
+        filename = os.path.join(get_data_path(), "force_constants", "quartz",
+                                "quartz_force_constants.json")
+        return ForceConstants.from_json_file(filename)
+
+    def test_auto_eta_scale_gives_same_result(self, quartz_fc):
+        fc = quartz_fc
+        qpt_ph_modes = fc.calculate_qpoint_phonon_modes(
+            quartz_split_qpts, asr='reciprocal', eta_scale='auto')
+        assert fc._auto_eta_scale['python'] in force_constants._AUTO_ETA_SCALES
+        assert fc._eta_scale == fc._auto_eta_scale['python']
+        expected = ForceConstants.from_json_file(
+            os.path.join(get_data_path(), "force_constants", "quartz",
+                         "quartz_force_constants.json")
+        ).calculate_qpoint_phonon_modes(quartz_split_qpts, asr='reciprocal')
+        # Acoustic frequencies at gamma depend slightly on eta_scale
+        npt.assert_allclose(qpt_ph_modes.frequencies.magnitude,
+                            expected.frequencies.magnitude, atol=1e-2)
+
+    def test_auto_eta_scale_is_only_calibrated_once(
+            self, quartz_fc, monkeypatch):
+        fc = quartz_fc
+        fc.calculate_qpoint_frequencies(quartz_split_qpts, eta_scale='auto')
+        # Calibrating again would fail with no eta_scales to try
+        monkeypatch.setattr(force_constants, '_AUTO_ETA_SCALES', ())
+        fc.calculate_qpoint_frequencies(quartz_split_qpts, eta_scale='auto')
+
+    def test_auto_eta_scale_read_from_cache_dir(
+            self, quartz_fc, tmpdir, monkeypatch):
+        cache_dir = str(tmpdir)
+        quartz_fc.calculate_qpoint_frequencies(
+            quartz_split_qpts, eta_scale='auto', cache_dir=cache_dir)
+        eta_scale = quartz_fc._auto_eta_scale['python']
+        monkeypatch.setattr(force_constants, '_AUTO_ETA_SCALES', ())
+        fc = ForceConstants.from_json_file(
+            os.path.join(get_data_path(), "force_constants", "quartz",
+                         "quartz_force_constants.json"))
+        fc.calculate_qpoint_frequencies(
+            quartz_split_qpts, eta_scale='auto', cache_dir=cache_dir)
+        assert fc._eta_scale == eta_scale
+
+
+@pytest.mark.integration
+class TestCalculateQPointPhononModesSymmetry:
+
+    grid_qpts = np.reshape(np.stack(np.meshgrid(
+        *3*[np.arange(-2, 2)/4], indexing='ij'), axis=-1), (-1, 3))
+
+    @pytest.fixture(params=[
+        ("LZO", {}, 1e-6, 1e-8),
+        ("graphite", {}, 1e-6, 1e-8),
+        ("NaCl", {}, 1e-6, 1e-8),
+        ("quartz", {"dipole": False}, 1e-6, 1e-8),
+        # The Born charges are only symmetric to ~1e-5
+        ("quartz", {"asr": "reciprocal"}, 1e-2, 1e-4),
+        ("quartz", {"asr": "realspace"}, 1e-2, 1e-4)])
+    def create_fc_and_kwargs(self, request):
+        material, kwargs, freq_atol, dyn_mat_rtol = request.param
+        fc = ForceConstants.from_json_file(os.path.join(
+            get_data_path(), TestCalculateSupercellImages.fc_files[material]))
+        return fc, kwargs, freq_atol, dyn_mat_rtol
+
+    @pytest.mark.parametrize("qpts", [
+        grid_qpts, np.concatenate((quartz_split_qpts, grid_qpts))])
+    def test_symmetry_reduced_equal_unreduced(
+            self, create_fc_and_kwargs, qpts):
+        fc, kwargs, freq_atol, dyn_mat_rtol = create_fc_and_kwargs
+        expected = fc.calculate_qpoint_phonon_modes(qpts, **kwargs)
+        qpt_ph_modes = fc.calculate_qpoint_phonon_modes(
+            qpts, use_symmetry=True, **kwargs)
+        npt.assert_allclose(qpt_ph_modes.frequencies.to('meV').magnitude,
+                            expected.frequencies.to('meV').magnitude,
+                            atol=freq_atol)
+        # Compare dynamical matrices rather than eigenvectors, as
+        # eigenvectors of degenerate modes are not unique
+        dyn_mats = TestCalculateQPointPhononModesNProcs.dyn_mats
+        expected_dyn_mats = dyn_mats(expected)
+        npt.assert_allclose(
+            dyn_mats(qpt_ph_modes), expected_dyn_mats,
+            atol=dyn_mat_rtol*np.amax(np.abs(expected_dyn_mats)))
+
+    def test_symmetry_reduces_qpts(self, create_fc_and_kwargs):
+        fc = create_fc_and_kwargs[0]
+        keep = np.zeros(len(self.grid_qpts), dtype=bool)
+        ir_qpts, ir_i, sym_i, _ = fc._reduce_qpts_symmetry(
+            self.grid_qpts, keep)
+        assert len(ir_qpts) < len(self.grid_qpts)
+        npt.assert_array_equal(np.unique(ir_i), np.arange(len(ir_qpts)))
+
+
+@pytest.mark.integration
+class TestCalculateQPointPhononModesTimeReversal:
+
+    @pytest.fixture(params=[
+        ("LZO", {}),
+        ("graphite", {}),
+        ("quartz", {"dipole": False}),
+        ("quartz", {"splitting": False})])
+    def create_fc_and_kwargs(self, request):
+        material, kwargs = request.param
+        fc = ForceConstants.from_json_file(os.path.join(
+            get_data_path(), TestCalculateSupercellImages.fc_files[material]))
+        return fc, kwargs
+
+    @pytest.mark.parametrize("use_c", [False, True])
+    def test_reduced_equal_unreduced(self, create_fc_and_kwargs, use_c):
+        fc, kwargs = create_fc_and_kwargs
+        qpts = mp_grid([4, 3, 2])
+        expected = fc.calculate_qpoint_phonon_modes(
+            qpts, reduce_qpts=False, use_c=use_c, **kwargs)
+        qpt_ph_modes = fc.calculate_qpoint_phonon_modes(
+            qpts, use_c=use_c, **kwargs)
+        npt.assert_allclose(qpt_ph_modes.frequencies.to('hartree').magnitude,
+                            expected.frequencies.to('hartree').magnitude,
+                            atol=1e-10)
+        dyn_mats = TestCalculateQPointPhononModesNProcs.dyn_mats
+        npt.assert_allclose(dyn_mats(qpt_ph_modes), dyn_mats(expected),
+                            atol=1e-12)
+
+    def test_only_one_of_each_pair_calculated(
+            self, create_fc_and_kwargs, monkeypatch):
+        fc, kwargs = create_fc_and_kwargs
+        qpts = np.array([[0.1, 0.2, 0.3], [-0.1, -0.2, -0.3],
+                         [0.0, -0.25, 0.5], [0.0, 0.25, -0.5],
+                         [0.0, 0.0, 0.0]])
+        n_calculated = []
+        calculate_phonons_at_q_block = (
+            ForceConstants._calculate_phonons_at_q_block)
+
+        def count_qpts(self, q_block, *args, **kwargs):
+            n_calculated.append(len(q_block))
+            return calculate_phonons_at_q_block(self, q_block, *args,
+                                                **kwargs)
+        monkeypatch.setattr(ForceConstants, '_calculate_phonons_at_q_block',
+                            count_qpts)
+        qpt_ph_modes = fc.calculate_qpoint_phonon_modes(qpts, **kwargs)
+        assert sum(n_calculated) == 3
+        npt.assert_allclose(qpt_ph_modes.eigenvectors[1],
+                            np.conj(qpt_ph_modes.eigenvectors[0]))
+
+
+@pytest.mark.integration
+class TestCalculateAdaptiveQPointPhononModes:
+
+    @pytest.fixture(params=[
+        ("graphite", {}, np.array([[0., 0., 0.], [0.5, 0., 0.],
+                                   [1/3, 1/3, 0.], [0., 0., 0.],
+                                   [0., 0., 0.5]])),
+        ("quartz", {"asr": "reciprocal"}, np.array([[0.5, 0., 0.],
+                                                    [0., 0., 0.],
+                                                    [0., 0., 0.5]]))])
+    def create_fc_kwargs_and_path(self, request):
+        material, kwargs, path = request.param
+        fc = ForceConstants.from_json_file(os.path.join(
+            get_data_path(), TestCalculateSupercellImages.fc_files[material]))
+        return fc, kwargs, path
+
+    def test_adaptive_qpts_interpolate_dense_path(
+            self, create_fc_kwargs_and_path):
+        fc, kwargs, path = create_fc_kwargs_and_path
+        freq_tol = 0.1*ureg('meV')
+        qpt_ph_modes = fc.calculate_adaptive_qpoint_phonon_modes(
+            path, freq_tol=freq_tol, **kwargs)
+        npt.assert_allclose(qpt_ph_modes.qpts[[0, -1]], path[[0, -1]])
+        n_dense = 401
+        assert qpt_ph_modes.n_qpts < n_dense
+        # insert_gamma duplicates gamma points between segments in the
+        # same way as the adaptive calculation if there is splitting
+        dense = fc.calculate_qpoint_phonon_modes(
+            ForceConstants._qpts_along_path(
+                path, np.linspace(0, len(path) - 1, n_dense)),
+            insert_gamma=True, **kwargs)
+        # Both are along the same path, so the distance along the path
+        # can be used to interpolate the adaptive frequencies, between
+        # any duplicated gamma points
+        adaptive_x = _calc_abscissa(fc.crystal, qpt_ph_modes.qpts).magnitude
+        dense_x = _calc_abscissa(fc.crystal, dense.qpts).magnitude
+        adaptive_split = np.where(np.diff(adaptive_x) == 0)[0] + 1
+        dense_split = np.where(np.diff(dense_x) == 0)[0] + 1
+        npt.assert_allclose(adaptive_x[adaptive_split],
+                            dense_x[dense_split])
+        adaptive_freqs = qpt_ph_modes.frequencies.to('meV').magnitude
+        dense_freqs = dense.frequencies.to('meV').magnitude
+        for ax, af, dx, df in zip(
+                np.split(adaptive_x, adaptive_split),
+                np.split(adaptive_freqs, adaptive_split),
+                np.split(dense_x, dense_split),
+                np.split(dense_freqs, dense_split)):
+            assert np.all(np.diff(ax) > 0)
+            interp_freqs = np.stack(
+                [np.interp(dx, ax, af[:, i]) for i in range(af.shape[1])],
+                axis=1)
+            npt.assert_allclose(interp_freqs, df,
+                                atol=2*freq_tol.to('meV').magnitude)
+
+    @pytest.mark.parametrize('splitting', [True, False])
+    def test_adaptive_qpts_not_bisected_towards_split_gamma(
+            self, splitting):
+        fc = ForceConstants.from_json_file(os.path.join(
+            get_data_path(), TestCalculateSupercellImages.fc_files['quartz']))
+        path = np.array([[0.5, 0., 0.], [0., 0., 0.], [0., 0., 0.5]])
+        n_initial, max_depth = 4, 8
+        qpt_ph_modes = fc.calculate_adaptive_qpoint_phonon_modes(
+            path, n_initial=n_initial, max_depth=max_depth, asr='reciprocal',
+            splitting=splitting)
+        dist = np.linalg.norm(qpt_ph_modes.qpts, axis=1)
+        # The smallest possible interval is 0.5/(n_initial*2**max_depth)
+        assert np.amin(dist[dist > 0]) > 0.5/(n_initial*2**(max_depth - 2))
+        gamma_i = np.where(dist == 0)[0]
+        if splitting:
+            # Each gamma point is split in the direction of its segment
+            assert len(gamma_i) == 2
+            expected = fc.calculate_qpoint_phonon_modes(
+                path[[0, 1, 1, 2]], asr='reciprocal', reduce_qpts=False)
+            npt.assert_allclose(
+                qpt_ph_modes.frequencies[gamma_i].magnitude,
+                expected.frequencies[1:3].magnitude, atol=1e-6)
+        else:
+            assert len(gamma_i) == 1
+
+    @pytest.mark.parametrize('unsupported_kwargs', [
+        {'insert_gamma': True}, {'chunk_size': 10},
+        {'out': np.zeros((10, 36, 12, 3), dtype=np.complex128)}])
+    def test_unsupported_kwargs_raise_value_error(
+            self, create_fc_kwargs_and_path, unsupported_kwargs):
+        fc, kwargs, path = create_fc_kwargs_and_path
+        with pytest.raises(ValueError):
+            fc.calculate_adaptive_qpoint_phonon_modes(
+                path, **unsupported_kwargs, **kwargs)
+
+
+class TestCalculateQPointPhononModesOut:
+
+    @pytest.fixture
+    def quartz_fc(self):
+        return ForceConstants.from_json_file(os.path.join(
+            get_data_path(), TestCalculateSupercellImages.fc_files['quartz']))
+
+    @pytest.mark.parametrize("use_c", [False, True])
+    @pytest.mark.parametrize("reduce_qpts", [False, True])
+    def test_out_is_returned_eigenvectors_and_gives_same_result(
+            self, quartz_fc, use_c, reduce_qpts):
+        qpts = mp_grid([2, 2, 3])
+        expected = quartz_fc.calculate_qpoint_phonon_modes(
+            qpts, reduce_qpts=reduce_qpts, use_c=use_c)
+        out = np.zeros(expected.eigenvectors.shape, dtype=np.complex128)
+        qpt_ph_modes = quartz_fc.calculate_qpoint_phonon_modes(
+            qpts, reduce_qpts=reduce_qpts, use_c=use_c, out=out)
+        assert qpt_ph_modes.eigenvectors is out
+        npt.assert_allclose(qpt_ph_modes.frequencies.magnitude,
+                            expected.frequencies.magnitude)
+        npt.assert_allclose(out, expected.eigenvectors)
+
+    @pytest.mark.parametrize("use_c", [False, True])
+    @pytest.mark.parametrize("reduce_qpts", [False, True])
+    def test_reused_out_gives_same_result(self, quartz_fc, use_c,
+                                          reduce_qpts):
+        qpts = mp_grid([2, 2, 3])
+        expected = quartz_fc.calculate_qpoint_phonon_modes(
+            qpts, reduce_qpts=reduce_qpts, use_c=use_c)
+        out = np.full(expected.eigenvectors.shape, 1 + 1j)
+        quartz_fc.calculate_qpoint_phonon_modes(
+            qpts[::-1], reduce_qpts=reduce_qpts, use_c=use_c, out=out)
+        quartz_fc.calculate_qpoint_phonon_modes(
+            qpts, reduce_qpts=reduce_qpts, use_c=use_c, out=out)
+        npt.assert_allclose(out, expected.eigenvectors)
+
+    @pytest.mark.parametrize("use_c", [False, True])
+    def test_memmap_out(self, quartz_fc, use_c, tmpdir):
+        qpts = np.array([[0.1, 0.2, 0.3], [0.4, 0.0, 0.5],
+                         [0.1, 0.2, 0.3], [-0.4, 0.0, -0.5]])
+        expected = quartz_fc.calculate_qpoint_phonon_modes(qpts, use_c=use_c)
+        out = np.memmap(str(tmpdir.join('evecs.dat')), dtype=np.complex128,
+                        mode='w+', shape=expected.eigenvectors.shape)
+        qpt_ph_modes = quartz_fc.calculate_qpoint_phonon_modes(
+            qpts, use_c=use_c, out=out)
+        assert qpt_ph_modes.eigenvectors is out
+        out.flush()
+        npt.assert_allclose(
+            np.fromfile(str(tmpdir.join('evecs.dat')),
+                        dtype=np.complex128).reshape(out.shape),
+            expected.eigenvectors)
+
+    @pytest.mark.parametrize("use_c", [False, True])
+    @pytest.mark.parametrize("reduce_qpts", [False, True])
+    def test_chunked_memmap_out(self, quartz_fc, use_c, reduce_qpts,
+                                tmpdir):
+        qpts = np.concatenate((mp_grid([2, 2, 3]), -mp_grid([2, 2, 3])))
+        expected = quartz_fc.calculate_qpoint_phonon_modes(
+            qpts, reduce_qpts=reduce_qpts, use_c=use_c)
+        out = np.memmap(str(tmpdir.join('evecs.dat')), dtype=np.complex128,
+                        mode='w+', shape=expected.eigenvectors.shape)
+        qpt_ph_modes = quartz_fc.calculate_qpoint_phonon_modes(
+            qpts, reduce_qpts=reduce_qpts, use_c=use_c, out=out,
+            chunk_size=5)
+        assert qpt_ph_modes.eigenvectors is out
+        npt.assert_allclose(qpt_ph_modes.frequencies.magnitude,
+                            expected.frequencies.magnitude)
+        # Eigenvectors of degenerate modes may differ, so compare the
+        # reconstructed dynamical matrices
+        dyn_mats = TestCalculateQPointPhononModesNProcs.dyn_mats
+        npt.assert_allclose(dyn_mats(qpt_ph_modes), dyn_mats(expected),
+                            atol=1e-12)
+
+    @pytest.mark.parametrize("use_c", [False, True])
+    def test_hdf5_out(self, quartz_fc, use_c, tmpdir):
+        h5py = pytest.importorskip('h5py')
+        qpts = mp_grid([2, 2, 3])
+        expected = quartz_fc.calculate_qpoint_phonon_modes(qpts, use_c=use_c)
+        filename = str(tmpdir.join('evecs.hdf5'))
+        with h5py.File(filename, 'w') as f:
+            out = f.create_dataset(
+                'eigenvectors', shape=expected.eigenvectors.shape,
+                dtype=np.complex128,
+                chunks=(4,) + expected.eigenvectors.shape[1:])
+            qpt_ph_modes = quartz_fc.calculate_qpoint_phonon_modes(
+                qpts, use_c=use_c, out=out, chunk_size=5)
+            assert qpt_ph_modes.eigenvectors is out
+            npt.assert_allclose(qpt_ph_modes.frequencies.magnitude,
+                                expected.frequencies.magnitude)
+        with h5py.File(filename, 'r') as f:
+            npt.assert_allclose(f['eigenvectors'][()], expected.eigenvectors)
+
+    @pytest.mark.parametrize("use_c", [False, True])
+    def test_hdf5_out_structure_factor_and_debye_waller(
+            self, quartz_fc, use_c, tmpdir):
+        h5py = pytest.importorskip('h5py')
+        qpts = mp_grid([2, 2, 3])
+        fm = ureg('fm')
+        sl = {'Si': 4.1491*fm, 'O': 5.803*fm}
+        expected = quartz_fc.calculate_qpoint_phonon_modes(qpts)
+        expected_dw = expected.calculate_debye_waller(100*ureg('K'))
+        expected_sf = expected.calculate_structure_factor(sl, dw=expected_dw)
+        with h5py.File(str(tmpdir.join('evecs.hdf5')), 'w') as f:
+            out = f.create_dataset('eigenvectors',
+                                   shape=expected.eigenvectors.shape,
+                                   dtype=np.complex128)
+            qpt_ph_modes = quartz_fc.calculate_qpoint_phonon_modes(
+                qpts, out=out)
+            dw = qpt_ph_modes.calculate_debye_waller(
+                100*ureg('K'), use_c=use_c, fall_back_on_python=not use_c)
+            sf = qpt_ph_modes.calculate_structure_factor(
+                sl, dw=dw, use_c=use_c, fall_back_on_python=not use_c)
+        npt.assert_allclose(dw.debye_waller.magnitude,
+                            expected_dw.debye_waller.magnitude, rtol=1e-10,
+                            atol=1e-16)
+        npt.assert_allclose(sf.structure_factors.magnitude,
+                            expected_sf.structure_factors.magnitude,
+                            rtol=1e-8, atol=1e-10*np.max(
+                                expected_sf.structure_factors.magnitude))
+
+    def test_read_only_hdf5_out_raises_value_error(self, quartz_fc, tmpdir):
+        h5py = pytest.importorskip('h5py')
+        qpts = mp_grid([1, 1, 4])
+        filename = str(tmpdir.join('evecs.hdf5'))
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('eigenvectors', shape=(4, 54, 9, 3),
+                             dtype=np.complex128)
+        with h5py.File(filename, 'r') as f:
+            with pytest.raises(ValueError):
+                quartz_fc.calculate_qpoint_phonon_modes(
+                    qpts, out=f['eigenvectors'])
+
+    @pytest.mark.parametrize("out_shape, dtype, order", [
+        ((3, 54, 9, 3), np.complex128, 'C'),
+        ((4, 54, 9, 3), np.complex64, 'C'),
+        ((4, 54, 9, 3), np.complex128, 'F')])
+    def test_invalid_out_raises_value_error(
+            self, quartz_fc, out_shape, dtype, order):
+        qpts = mp_grid([1, 1, 4])
+        out = np.zeros(out_shape, dtype=dtype, order=order)
+        with pytest.raises(ValueError):
+            quartz_fc.calculate_qpoint_phonon_modes(qpts, out=out)
+
+
+class TestCExtensionLapackLibrary:
+
+    def test_lapack_library_is_loaded_on_import(self):
+        euphonic_c = pytest.importorskip('euphonic._euphonic')
+        lapack_lib = euphonic_c.get_lapack_library()
+        assert lapack_lib is not None
+        assert os.path.isfile(lapack_lib)
+
+
+class TestCExtensionReferenceCounts:
+
+    @pytest.mark.parametrize('dipole, missing_attr', [
+        (0, 'cell_origins'), (1, '_dielectric'), (0, 'atom_r')])
+    def test_missing_attributes_release_references(self, dipole,
+                                                   missing_attr):
+        euphonic_c = pytest.importorskip('euphonic._euphonic')
+        # Only has some of the attributes, so the attributes that are
+        # read before the missing one must be released
+        attrs = {'_sc_image_offsets': np.zeros(1, dtype=np.int32),
+                 '_sc_image_i': np.zeros(1, dtype=np.int32),
+                 'cell_origins': np.zeros((1, 3), dtype=np.int32),
+                 '_born': np.zeros((1, 3, 3)),
+                 '_dielectric': np.identity(3), '_eta': 1.0,
+                 '_H_ab': np.zeros(1), '_cells': np.zeros(1),
+                 '_gvec_phases': np.zeros(1), '_gvecs_cart': np.zeros(1),
+                 '_dipole_q0': np.zeros(1)}
+        crystal_attrs = {'n_atoms': 1, 'atom_r': np.zeros((1, 3))}
+        attrs.pop(missing_attr, None)
+        crystal_attrs.pop(missing_attr, None)
+        idata = SimpleNamespace(crystal=SimpleNamespace(**crystal_attrs),
+                                **attrs)
+        objs = [idata.crystal] + [val for val in (
+            list(attrs.values()) + list(crystal_attrs.values()))
+            if isinstance(val, np.ndarray)]
+        n_refs = [sys.getrefcount(obj) for obj in objs]
+        arr = np.zeros(1)
+        for _ in range(10):
+            with pytest.raises(RuntimeError):
+                euphonic_c.calculate_phonons(
+                    idata, arr, arr, arr, arr, arr, arr, arr, arr, dipole,
+                    0, 0, arr, arr, 1)
+        assert [sys.getrefcount(obj) for obj in objs] == n_refs
+
+
+class TestCalculateQPointPhononModesPythonThreads:
+
+    @pytest.fixture(params=['quartz', 'graphite'])
+    def create_fc(self, request):
+        return ForceConstants.from_json_file(os.path.join(
+            get_data_path(), TestCalculateSupercellImages.fc_files[
+                request.param]))
+
+    def test_concurrent_c_calls_equal_serial(self, create_fc):
+        pytest.importorskip('euphonic._euphonic')
+        fc = create_fc
+        qpts = [np.random.RandomState(i).rand(20, 3) for i in range(4)]
+
+        def calculate(q):
+            return fc.calculate_qpoint_phonon_modes(
+                q, use_c=True, fall_back_on_python=False, n_threads=2)
+        expected = [calculate(q) for q in qpts]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(calculate, qpts))
+        dyn_mats = TestCalculateQPointPhononModesNProcs.dyn_mats
+        for res, exp in zip(results, expected):
+            npt.assert_allclose(res.frequencies.magnitude,
+                                exp.frequencies.magnitude)
+            npt.assert_allclose(dyn_mats(res), dyn_mats(exp), atol=1e-12)
+
+
+@pytest.mark.integration
+class TestCalculateQPointPhononModesSinglePrecision:
+
+    @pytest.fixture(params=['quartz', 'LZO', 'graphite'])
+    def create_fc(self, request):
+        return ForceConstants.from_json_file(os.path.join(
+            get_data_path(), TestCalculateSupercellImages.fc_files[
+                request.param]))
+
+    @pytest.mark.parametrize("use_c", [False, True])
+    def test_single_precision_close_to_double(self, create_fc, use_c):
+        fc = create_fc
+        qpts = np.random.RandomState(0).rand(20, 3)
+        expected = fc.calculate_qpoint_phonon_modes(qpts, use_c=use_c)
+        qpt_ph_modes = fc.calculate_qpoint_phonon_modes(
+            qpts, use_c=use_c, dtype=np.float32)
+        assert qpt_ph_modes.eigenvectors.dtype == np.complex64
+        assert qpt_ph_modes.frequencies.magnitude.dtype == np.float64
+        npt.assert_allclose(qpt_ph_modes.frequencies.to('meV').magnitude,
+                            expected.frequencies.to('meV').magnitude,
+                            atol=1e-3)
+        # Degenerate eigenvectors may differ, so compare the dynamical
+        # matrices reconstructed from the eigenvectors
+        dyn_mats = TestCalculateQPointPhononModesNProcs.dyn_mats
+        expected_dyn_mats = dyn_mats(expected)
+        npt.assert_allclose(
+            dyn_mats(qpt_ph_modes), expected_dyn_mats,
+            atol=1e-5*np.max(np.abs(expected_dyn_mats)))
+
+    @pytest.mark.parametrize("use_c", [False, True])
+    def test_single_precision_frequencies_close_to_double(
+            self, create_fc, use_c):
+        fc = create_fc
+        qpts = np.random.RandomState(1).rand(20, 3)
+        expected = fc.calculate_qpoint_frequencies(qpts, use_c=use_c)
+        qpt_freqs = fc.calculate_qpoint_frequencies(
+            qpts, use_c=use_c, dtype=np.float32)
+        npt.assert_allclose(qpt_freqs.frequencies.to('meV').magnitude,
+                            expected.frequencies.to('meV').magnitude,
+                            atol=1e-3)
+
+    @pytest.mark.parametrize("use_c", [False, True])
+    def test_single_precision_out(self, create_fc, use_c):
+        fc = create_fc
+        qpts = mp_grid([2, 2, 2])
+        n_atoms = fc.crystal.n_atoms
+        out = np.zeros((len(qpts), 3*n_atoms, n_atoms, 3),
+                       dtype=np.complex64)
+        qpt_ph_modes = fc.calculate_qpoint_phonon_modes(
+            qpts, use_c=use_c, dtype=np.float32, out=out)
+        assert qpt_ph_modes.eigenvectors is out
+
+    @pytest.mark.parametrize("dtype", [np.float16, np.complex128, int])
+    def test_invalid_dtype_raises_value_error(self, create_fc, dtype):
+        with pytest.raises(ValueError):
+            create_fc.calculate_qpoint_phonon_modes(
+                mp_grid([1, 1, 2]), dtype=dtype)
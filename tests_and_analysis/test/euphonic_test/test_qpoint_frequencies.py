@@ -0,0 +1,52 @@
+import os
+import pytest
+import numpy as np
+import numpy.testing as npt
+from euphonic import ureg, ForceConstants, QpointFrequencies
+from tests_and_analysis.test.utils import get_data_path
+
+
+@pytest.fixture
+def quartz_phonons():
+    filename = os.path.join(get_data_path(), "force_constants", "quartz",
+                            "quartz_force_constants.json")
+    fc = ForceConstants.from_json_file(filename)
+    qpts = np.array([[0.00, 0.00, 0.50],
+                     [-0.25, 0.50, 0.50],
+                     [-0.151515, 0.575758, 0.5]])
+    return (fc.calculate_qpoint_frequencies(qpts, asr='reciprocal'),
+            fc.calculate_qpoint_phonon_modes(qpts, asr='reciprocal'))
+
+
+@pytest.mark.unit
+class TestQpointFrequencies:
+
+    def test_calculate_dos_same_as_phonon_modes(self, quartz_phonons):
+        qpoint_frequencies, qpoint_phonon_modes = quartz_phonons
+        dos_bins = np.arange(0, 160, 0.5)*ureg('meV')
+        dos = qpoint_frequencies.calculate_dos(dos_bins)
+        expected_dos = qpoint_phonon_modes.calculate_dos(dos_bins)
+        npt.assert_allclose(dos.x_data.magnitude,
+                            expected_dos.x_data.magnitude)
+        npt.assert_allclose(dos.y_data.magnitude,
+                            expected_dos.y_data.magnitude)
+
+    def test_to_from_json_file(self, quartz_phonons, tmpdir):
+        qpoint_frequencies, _ = quartz_phonons
+        filename = str(tmpdir.join('qpoint_frequencies.json'))
+        qpoint_frequencies.to_json_file(filename)
+        read_frequencies = QpointFrequencies.from_json_file(filename)
+        npt.assert_allclose(read_frequencies.qpts, qpoint_frequencies.qpts)
+        npt.assert_allclose(read_frequencies.weights,
+                            qpoint_frequencies.weights)
+        npt.assert_allclose(read_frequencies.frequencies.magnitude,
+                            qpoint_frequencies.frequencies.magnitude)
+        assert (read_frequencies.frequencies_unit
+                == qpoint_frequencies.frequencies_unit)
+
+    def test_wrong_frequencies_shape_raises_value_error(self, quartz_phonons):
+        qpoint_frequencies, _ = quartz_phonons
+        with pytest.raises(ValueError):
+            QpointFrequencies(qpoint_frequencies.crystal,
+                              qpoint_frequencies.qpts,
+                              qpoint_frequencies.frequencies[:, :3])
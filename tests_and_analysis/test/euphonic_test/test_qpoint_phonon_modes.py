@@ -0,0 +1,141 @@
+import os
+import pytest
+import numpy as np
+import numpy.testing as npt
+from euphonic import ureg, ForceConstants, QpointPhononModes
+from euphonic.util import mp_grid
+from tests_and_analysis.test.utils import get_data_path
+
+
+fm = ureg('fm')
+scattering_lengths = {
+    'quartz': {'Si': 4.1491*fm, 'O': 5.803*fm},
+    'LZO': {'La': 8.24*fm, 'Zr': 7.16*fm, 'O': 5.803*fm},
+    'graphite': {'C': 6.646*fm}}
+fc_files = {
+    'quartz': os.path.join('force_constants', 'quartz',
+                           'quartz_force_constants.json'),
+    'LZO': os.path.join('force_constants', 'LZO',
+                        'lzo_force_constants.json'),
+    'graphite': os.path.join('force_constants', 'graphite',
+                             'graphite_force_constants.json')}
+
+
+@pytest.fixture(params=['quartz', 'LZO', 'graphite'])
+def phonons_and_dw(request):
+    material = request.param
+    fc = ForceConstants.from_json_file(os.path.join(
+        get_data_path(), fc_files[material]))
+    qpts = np.random.RandomState(0).rand(10, 3)*2 - 1
+    phonons = fc.calculate_qpoint_phonon_modes(qpts, asr='reciprocal')
+    dw = fc.calculate_qpoint_phonon_modes(
+        mp_grid([2, 2, 2]), asr='reciprocal').calculate_debye_waller(
+            100*ureg('K'))
+    return phonons, dw, scattering_lengths[material]
+
+
+@pytest.mark.unit
+class TestQpointPhononModesCalculateStructureFactor:
+
+    @pytest.mark.parametrize('use_dw', [False, True])
+    @pytest.mark.parametrize('n_threads', [1, 2])
+    def test_c_equals_python(self, phonons_and_dw, use_dw, n_threads):
+        pytest.importorskip('euphonic._euphonic')
+        phonons, dw, sl = phonons_and_dw
+        if not use_dw:
+            dw = None
+        expected = phonons.calculate_structure_factor(sl, dw=dw)
+        sf = phonons.calculate_structure_factor(
+            sl, dw=dw, use_c=True, fall_back_on_python=False,
+            n_threads=n_threads)
+        assert sf.structure_factors.units == expected.structure_factors.units
+        npt.assert_allclose(sf.structure_factors.magnitude,
+                            expected.structure_factors.magnitude,
+                            rtol=1e-10)
+        if use_dw:
+            assert sf.temperature == expected.temperature
+        else:
+            assert sf.temperature is None
+
+    @pytest.mark.parametrize('n_threads', [1, 2])
+    def test_single_precision_eigenvectors_c_equals_python(
+            self, phonons_and_dw, n_threads):
+        pytest.importorskip('euphonic._euphonic')
+        phonons, dw, sl = phonons_and_dw
+        phonons.eigenvectors = phonons.eigenvectors.astype(np.complex64)
+        expected = phonons.calculate_structure_factor(sl, dw=dw)
+        sf = phonons.calculate_structure_factor(
+            sl, dw=dw, use_c=True, fall_back_on_python=False,
+            n_threads=n_threads)
+        npt.assert_allclose(sf.structure_factors.magnitude,
+                            expected.structure_factors.magnitude,
+                            rtol=1e-10)
+
+
+@pytest.mark.unit
+class TestQpointPhononModesCalculateDebyeWaller:
+
+    @pytest.fixture(params=['quartz', 'LZO', 'graphite'])
+    def grid_phonons(self, request):
+        fc = ForceConstants.from_json_file(os.path.join(
+            get_data_path(), fc_files[request.param]))
+        return fc.calculate_qpoint_phonon_modes(mp_grid([3, 3, 2]),
+                                                asr='reciprocal')
+
+    @staticmethod
+    def outer_product_dw(phonons, temperature):
+        # Reference implementation using the full e.e* outer product
+        kB = (1*ureg.k).to('hartree/K').magnitude
+        freqs = phonons._frequencies
+        freq_mask = np.ones(freqs.shape)
+        freq_mask[np.sum(np.square(phonons.qpts), axis=1) < 1e-8, :3] = 0
+        freq_term = 1/(freqs*np.tanh(freqs/(2*kB*temperature)))
+        evec_term = np.real(np.einsum('ijkl,ijkm->ijklm',
+                                      phonons.eigenvectors,
+                                      np.conj(phonons.eigenvectors)))
+        dw = np.einsum('i,k,ij,ij,ijklm->klm', phonons.weights,
+                       1/(4*phonons.crystal._atom_mass), freq_term,
+                       freq_mask, evec_term)
+        return dw/np.sum(phonons.weights)
+
+    @pytest.mark.parametrize('use_c, n_threads', [
+        (False, 1), (True, 1), (True, 2)])
+    def test_dw_equals_outer_product(self, grid_phonons, use_c, n_threads):
+        if use_c:
+            pytest.importorskip('euphonic._euphonic')
+        dw = grid_phonons.calculate_debye_waller(
+            100*ureg('K'), use_c=use_c, n_threads=n_threads,
+            fall_back_on_python=not use_c)
+        npt.assert_allclose(
+            dw.debye_waller.to('bohr**2').magnitude,
+            self.outer_product_dw(grid_phonons, 100), rtol=1e-10,
+            atol=1e-16)
+
+    @pytest.mark.parametrize('use_c', [False, True])
+    def test_single_precision_eigenvectors_close_to_double(
+            self, grid_phonons, use_c):
+        if use_c:
+            pytest.importorskip('euphonic._euphonic')
+        expected = grid_phonons.calculate_debye_waller(
+            100*ureg('K'), use_c=use_c, fall_back_on_python=not use_c)
+        grid_phonons.eigenvectors = grid_phonons.eigenvectors.astype(
+            np.complex64)
+        dw = grid_phonons.calculate_debye_waller(
+            100*ureg('K'), use_c=use_c, fall_back_on_python=not use_c)
+        npt.assert_allclose(dw.debye_waller.magnitude,
+                            expected.debye_waller.magnitude, rtol=1e-5,
+                            atol=1e-6*np.max(np.abs(
+                                expected.debye_waller.magnitude)))
+
+
+@pytest.mark.unit
+class TestQpointPhononModesSinglePrecisionSerialisation:
+
+    def test_single_precision_to_json_file(self, phonons_and_dw, tmpdir):
+        phonons, _, _ = phonons_and_dw
+        evecs = phonons.eigenvectors.astype(np.complex64)
+        phonons.eigenvectors = evecs
+        filename = str(tmpdir.join('phonons.json'))
+        phonons.to_json_file(filename)
+        phonons_json = QpointPhononModes.from_json_file(filename)
+        npt.assert_array_equal(phonons_json.eigenvectors, evecs)
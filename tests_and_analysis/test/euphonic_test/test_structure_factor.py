@@ -0,0 +1,62 @@
+import os
+import pytest
+import numpy as np
+import numpy.testing as npt
+from euphonic import ureg, ForceConstants
+from euphonic.util import _bose_factor
+from tests_and_analysis.test.utils import get_data_path
+
+
+@pytest.fixture
+def quartz_structure_factor():
+    fc = ForceConstants.from_json_file(os.path.join(
+        get_data_path(), 'force_constants', 'quartz',
+        'quartz_force_constants.json'))
+    qpts = np.random.RandomState(0).rand(10, 3)
+    phonons = fc.calculate_qpoint_phonon_modes(
+        np.concatenate(([[0., 0., 0.]], qpts)), asr='reciprocal')
+    fm = ureg('fm')
+    return phonons.calculate_structure_factor(
+        {'Si': 4.1491*fm, 'O': 5.803*fm})
+
+
+def add_at_sqw_map(sf, e_bins, temperature):
+    # Reference implementation using np.add.at
+    freqs = sf._frequencies
+    e_bins = e_bins.to('hartree').magnitude
+    sqw_map = np.zeros((sf.n_qpts, len(e_bins) + 1))
+    p_intensity = sf._structure_factors
+    n_intensity = sf._structure_factors
+    if temperature is not None:
+        p_intensity = p_intensity*_bose_factor(freqs, temperature)
+        n_intensity = n_intensity*_bose_factor(-freqs, temperature)
+    first_index = np.transpose(
+        np.tile(range(sf.n_qpts), (freqs.shape[1], 1)))
+    np.add.at(sqw_map, (first_index, np.digitize(freqs, e_bins)),
+              p_intensity)
+    np.add.at(sqw_map, (first_index, np.digitize(-freqs, e_bins)),
+              n_intensity)
+    return sqw_map[:, 1:-1]
+
+
+@pytest.mark.unit
+class TestStructureFactorCalculateSqwMap:
+
+    @pytest.mark.parametrize('e_bins', [
+        np.arange(-150, 150, 0.7)*ureg('meV'),
+        np.arange(-60, 20, 1.)*ureg('meV'),
+        np.arange(0, 100, 1.)*ureg('meV')])
+    @pytest.mark.parametrize('temperature', [None, 0, 5, 300])
+    def test_sqw_map_equals_add_at(self, quartz_structure_factor, e_bins,
+                                   temperature):
+        sf = quartz_structure_factor
+        if temperature is None:
+            sqw_map = sf.calculate_sqw_map(e_bins, calc_bose=False)
+        else:
+            sqw_map = sf.calculate_sqw_map(
+                e_bins, temperature=temperature*ureg('K'))
+        expected = add_at_sqw_map(sf, e_bins, temperature)
+        npt.assert_allclose(
+            sqw_map.z_data.to(sf.structure_factors.units).magnitude,
+            expected*ureg('bohr**2').to(sf.structure_factors.units).magnitude,
+            rtol=1e-12)